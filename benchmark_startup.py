@@ -0,0 +1,133 @@
+import os, sys, json, subprocess, logging
+from argparse import ArgumentParser
+from collections import OrderedDict
+
+# the code run in a fresh interpreter for each entry mode
+ENTRY_MODES = OrderedDict([
+    ('help', """
+import io, runpy, contextlib
+sys.argv = ['run_and_save_model.py', '--help']
+with contextlib.redirect_stdout(io.StringIO()):
+    try:
+        runpy.run_path('run_and_save_model.py', run_name = '__main__')
+    except SystemExit:
+        pass
+"""),
+    # everything a --predict run imports before loading the models
+    ('predict', """
+import run_and_save_model
+from eduanalytics import model_data, reporting, ledger
+"""),
+    # a --fit run also imports the estimators and the search
+    ('fit', """
+import run_and_save_model
+from sklearn import ensemble, feature_selection, preprocessing
+from sklearn.model_selection import GridSearchCV, RandomizedSearchCV
+"""),
+    ('service', """
+from eduanalytics import scoring_service
+"""),
+    ])
+
+# import time budgets in seconds, override with --budget
+BUDGETS = OrderedDict([('help', 1.5), ('predict', 1.5), ('fit', 3.0),
+    ('service', 1.5)])
+
+# optional or heavy modules an entry mode should not import
+FORBIDDEN = ['matplotlib', 'lime', 'sklearn.ensemble', 'sklearn.model_selection']
+ALLOWED = {'fit': ['sklearn.ensemble', 'sklearn.model_selection']}
+
+TIMED_RUN = """
+import sys, time, json
+start_time = time.time()
+{code}
+print(json.dumps({{'seconds': time.time() - start_time,
+    'modules': len(sys.modules),
+    'loaded': [name for name in {forbidden!r} if name in sys.modules]}}))
+"""
+
+def time_entry_mode(mode, python = sys.executable, cwd = None):
+    """Times the imports of an entry mode in a fresh interpreter, so that
+    nothing is already loaded from an earlier mode.
+
+    Args:
+        mode (str): one of ENTRY_MODES
+        python (str): the python executable to time
+        cwd (str): the repository directory, defaults to the directory of
+            this script
+    Returns:
+        dict: the import time in seconds, the number of modules loaded, and
+            the forbidden modules that were loaded
+    """
+    forbidden = [name for name in FORBIDDEN
+        if name not in ALLOWED.get(mode, [])]
+    code = TIMED_RUN.format(code = ENTRY_MODES[mode], forbidden = forbidden)
+    output = subprocess.check_output([python, '-c', code],
+        cwd = cwd or os.path.dirname(os.path.abspath(__file__)))
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def benchmark_startup(modes, budgets, n_repeats = 3, python = sys.executable):
+    """Times each entry mode n_repeats times and compares the best time with
+    its budget.
+
+    Args:
+        modes (list[str]): the entry modes to time
+        budgets (dict): import time budget in seconds of each mode
+        n_repeats (int): number of timed runs of each mode, the best is kept
+        python (str): the python executable to time
+    Returns:
+        list[dict]: for each mode, its best import time, budget, number of
+            modules loaded, forbidden modules loaded, and whether it passed
+    """
+    results = []
+    for mode in modes:
+        runs = [time_entry_mode(mode, python = python)
+            for _ in range(n_repeats)]
+        best = min(runs, key = lambda run: run['seconds'])
+        results.append({'mode': mode, 'seconds': best['seconds'],
+            'budget': budgets[mode], 'modules': best['modules'],
+            'loaded': best['loaded'],
+            'ok': best['seconds'] <= budgets[mode] and not best['loaded']})
+    return results
+
+
+def main(args = None):
+    parser = ArgumentParser(description = 'Times the imports of each entry '
+        'mode of run_and_save_model.py and the scoring service, and exits '
+        'with an error when a mode is over its budget or imports plotting, '
+        'explanation or training code it does not need.')
+    parser.add_argument('--modes', dest = 'modes', nargs = '*',
+        default = list(ENTRY_MODES), choices = list(ENTRY_MODES),
+        help = 'Entry modes to time (all by default)')
+    parser.add_argument('--budget', dest = 'budgets', nargs = '*',
+        default = [], metavar = 'MODE=SECONDS',
+        help = 'Import time budgets overriding the defaults')
+    parser.add_argument('--repeat', dest = 'n_repeats', type = int,
+        default = 3, help = 'Number of timed runs of each mode')
+    parser.add_argument('--python', dest = 'python',
+        default = sys.executable, help = 'Python executable to time')
+    args = parser.parse_args(args)
+    logging.basicConfig(format = '%(asctime)s %(message)s',
+        level = logging.INFO)
+
+    budgets = OrderedDict(BUDGETS)
+    for budget in args.budgets:
+        mode, seconds = budget.split('=')
+        if mode not in ENTRY_MODES:
+            parser.error('unknown entry mode: {}'.format(mode))
+        budgets[mode] = float(seconds)
+
+    results = benchmark_startup(args.modes, budgets,
+        n_repeats = args.n_repeats, python = args.python)
+    for result in results:
+        logging.info('{mode:<8} {seconds:6.3f}s (budget {budget:.1f}s) '
+            '{modules:5d} modules {status}'.format(
+                status = 'ok' if result['ok'] else 'FAILED' + (
+                    ', imports ' + ', '.join(result['loaded'])
+                    if result['loaded'] else ''),
+                **result))
+    return 0 if all(result['ok'] for result in results) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,212 @@
+import pandas as pd
+import numpy as np
+import logging
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+def get_test_predictions(conn, algorithm_ids, tbl_name = 'screening_train_val'):
+    """Reads the held-out test set predictions of a set of algorithms.
+
+    Args:
+        conn (sqlalchemy.Engine): a connection to the MySQL database
+        algorithm_ids (list[int]): the algorithms to read
+        tbl_name (str): the name of the table written by
+            reporting.output_predictions, without the out$predictions$ prefix
+    Returns:
+        Pandas.DataFrame: one row per test prediction, with the algorithm_id,
+            outcome and predicted_{class_name} columns
+    """
+    test_query = """select * from `out$predictions${tbl_name}`
+    where `set` = 'test'
+    and algorithm_id in ({ids})""".format(tbl_name = tbl_name,
+        ids = ", ".join(str(int(alg_id)) for alg_id in algorithm_ids))
+    return pd.read_sql_query(test_query, conn)
+
+
+def resample_weights(n_rows, n_resamples, random_state = None):
+    """Draws bootstrap resamples as a matrix of row indices, and counts how
+    often each row is drawn in each resample.
+
+    Args:
+        n_rows (int): number of rows in the sample
+        n_resamples (int): number of resamples to draw
+        random_state (int or numpy.random.RandomState): seed for the draws
+    Returns:
+        numpy.ndarray: n_resamples x n_rows matrix of draw counts
+    """
+    rng = random_state if isinstance(random_state, np.random.RandomState) \
+        else np.random.RandomState(random_state)
+    indices = rng.randint(0, n_rows, size = (n_resamples, n_rows))
+    offsets = (np.arange(n_resamples) * n_rows)[:, np.newaxis]
+    return np.bincount((indices + offsets).ravel(),
+        minlength = n_resamples * n_rows).reshape(
+        n_resamples, n_rows).astype(float)
+
+
+def sort_scores(y_true, y_score):
+    """Sorts the scores once for all resamples, grouping tied scores.
+
+    Args:
+        y_true (numpy.ndarray): binary labels
+        y_score (numpy.ndarray): scores for the positive class
+    Returns:
+        (numpy.ndarray, numpy.ndarray, numpy.ndarray): the row order that
+            sorts the scores ascending, the labels in that order, and the
+            position where each run of tied scores starts
+    """
+    order = np.argsort(y_score, kind = 'mergesort')
+    score = np.asarray(y_score)[order]
+    tie_starts = np.flatnonzero(np.concatenate([[True],
+        score[1:] != score[:-1]]))
+    return order, np.asarray(y_true, dtype = float)[order], tie_starts
+
+
+def weighted_auc(true, tie_starts, weights):
+    """Computes the area under the ROC curve of each resample, counting tied
+    scores as half, as roc_auc_score does.
+
+    Args:
+        true (numpy.ndarray): binary labels in ascending score order
+        tie_starts (numpy.ndarray): the position where each run of tied
+            scores starts (see sort_scores)
+        weights (numpy.ndarray): n_resamples x n_rows draw counts in
+            ascending score order
+    Returns:
+        numpy.ndarray: the AUC of each resample
+    """
+    positive = np.add.reduceat(weights * true, tie_starts, axis = 1)
+    negative = np.add.reduceat(weights * (1 - true), tie_starts, axis = 1)
+    negative_below = np.cumsum(negative, axis = 1) - negative
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return (positive * (negative_below + .5 * negative)).sum(axis = 1) \
+            / (positive.sum(axis = 1) * negative.sum(axis = 1))
+
+
+def weighted_precision_at_k(true, tie_starts, weights, k):
+    """Computes the precision of each resample when the top k fraction of the
+    resample is classified as positive, with the cutoff of
+    evaluation.precision_recall_at_k (tied scores are never split).
+
+    Args:
+        true (numpy.ndarray): binary labels in ascending score order
+        tie_starts (numpy.ndarray): the position where each run of tied
+            scores starts (see sort_scores)
+        weights (numpy.ndarray): n_resamples x n_rows draw counts in
+            ascending score order
+        k (list[float]): fractions of the population classified as positive
+    Returns:
+        numpy.ndarray: n_resamples x len(k) precisions
+    """
+    # runs of tied scores from the highest score down
+    total = np.add.reduceat(weights, tie_starts, axis = 1)[:, ::-1]
+    positive = np.add.reduceat(weights * true, tie_starts, axis = 1)[:, ::-1]
+    padding = np.zeros((weights.shape[0], 1))
+    cum_total = np.hstack([padding, np.cumsum(total, axis = 1)])
+    cum_positive = np.hstack([padding, np.cumsum(positive, axis = 1)])
+
+    rows = np.arange(weights.shape[0])[:, np.newaxis]
+    rank = np.floor(weights.shape[1] * np.asarray(k, dtype = float) + 1e-9)
+    # the runs ranked entirely above the cutoff rank
+    n_runs = (cum_total[:, 1:, np.newaxis] <= rank).sum(axis = 1)
+    selected = cum_total[rows, n_runs]
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return np.where(selected > 0,
+            cum_positive[rows, n_runs] / selected, np.nan)
+
+
+def _bootstrap_shard(order, true, tie_starts, k, n_resamples, seed):
+    """Computes the metrics of one shard of resamples."""
+    weights = resample_weights(order.size, n_resamples, seed)[:, order]
+    return np.column_stack([weighted_auc(true, tie_starts, weights),
+        weighted_precision_at_k(true, tie_starts, weights, k)])
+
+
+def bootstrap_metrics(y_true, y_score, k = (.05, .1, .2), n_resamples = 2000,
+        alpha = .05, random_state = 1100, shard_size = 250, n_jobs = 1):
+    """Bootstraps the AUC and precision at k of a set of predictions.
+
+    Resamples are drawn in shards of shard_size, each with its own seed
+    derived from random_state, so the intervals are reproducible whatever
+    the number of processes.
+
+    Usage:
+        intervals = bootstrap_metrics(test.outcome == 'yes',
+            test.predicted_yes, n_resamples = 5000, n_jobs = 4)
+
+    Args:
+        y_true (numpy.ndarray): binary labels
+        y_score (numpy.ndarray): scores for the positive class
+        k (list[float]): fractions of the population classified as positive
+        n_resamples (int): number of bootstrap resamples
+        alpha (float): the intervals cover 1 - alpha of the resampled values
+        random_state (int): seed for the resamples
+        shard_size (int): number of resamples computed at a time, bounding
+            the memory used for the draw counts
+        n_jobs (int): number of processes computing shards
+    Returns:
+        Pandas.DataFrame: indexed by metric, with the estimate on the full
+            sample, the standard deviation over the resamples, and the lower
+            and upper percentile interval bounds
+    """
+    order, true, tie_starts = sort_scores(y_true, y_score)
+    n_shards = int(np.ceil(n_resamples / float(shard_size)))
+    seeds = np.random.RandomState(random_state).randint(
+        np.iinfo(np.int32).max, size = n_shards)
+    sizes = [min(shard_size, n_resamples - shard * shard_size)
+        for shard in range(n_shards)]
+    args = [[order] * n_shards, [true] * n_shards, [tie_starts] * n_shards,
+        [k] * n_shards, sizes, seeds]
+    if n_jobs == 1:
+        shards = list(map(_bootstrap_shard, *args))
+    else:
+        with ProcessPoolExecutor(max_workers = n_jobs) as executor:
+            shards = list(executor.map(_bootstrap_shard, *args))
+    resampled = np.vstack(shards)
+    full_sample = np.ones((1, order.size))
+    estimate = np.column_stack([
+        weighted_auc(true, tie_starts, full_sample),
+        weighted_precision_at_k(true, tie_starts, full_sample, k)])[0]
+
+    lower, upper = np.nanpercentile(resampled,
+        [100 * alpha / 2, 100 * (1 - alpha / 2)], axis = 0)
+    metrics = ['auc'] + ['precision_at_{}'.format(cutoff) for cutoff in k]
+    return pd.DataFrame(OrderedDict([('estimate', estimate),
+        ('std', np.nanstd(resampled, axis = 0)),
+        ('lower', lower), ('upper', upper)]),
+        index = pd.Index(metrics, name = 'metric'))
+
+
+def bootstrap_by_algorithm(results, k = (.05, .1, .2), n_resamples = 2000,
+        alpha = .05, random_state = 1100, shard_size = 250, n_jobs = 1):
+    """Bootstraps the AUC and precision at k of each algorithm's test set
+    predictions, one-vs-rest for each class of multiclass algorithms.
+
+    Usage:
+        test = get_test_predictions(conn, [101, 102])
+        intervals = bootstrap_by_algorithm(test, n_jobs = 4)
+
+    Args:
+        results (Pandas.DataFrame): predictions as read by
+            get_test_predictions, with algorithm_id, outcome and
+            predicted_{class_name} columns
+        k, n_resamples, alpha, random_state, shard_size, n_jobs: see
+            bootstrap_metrics
+    Returns:
+        Pandas.DataFrame: indexed by algorithm_id, class name and metric,
+            with the estimate, standard deviation and interval bounds
+    """
+    intervals = OrderedDict()
+    for alg_id, predictions in results.groupby('algorithm_id'):
+        for col in predictions.columns:
+            if not col.startswith('predicted_') \
+                    or predictions[col].isnull().all():
+                continue
+            class_name = col[len('predicted_'):]
+            logging.info("bootstrapping algorithm {} class {}".format(
+                alg_id, class_name))
+            intervals[(alg_id, class_name)] = bootstrap_metrics(
+                predictions.outcome.astype(str) == class_name,
+                predictions[col].values, k = k, n_resamples = n_resamples,
+                alpha = alpha, random_state = random_state,
+                shard_size = shard_size, n_jobs = n_jobs)
+    return pd.concat(intervals, names = ['algorithm_id', 'class_name'])
@@ -0,0 +1,165 @@
+import sqlalchemy
+import pandas as pd
+import os, logging, tempfile, time
+from contextlib import contextmanager
+
+@contextmanager
+def begin(connectable):
+    """Yields a connection within a transaction: a new transaction on an
+    engine, or the given connection, whose transaction the caller manages.
+
+    Args:
+        connectable (sqlalchemy.Engine or sqlalchemy.Connection): the engine,
+            or an open connection within a transaction
+    Yields:
+        sqlalchemy.Connection: the connection to execute on
+    """
+    if isinstance(connectable, sqlalchemy.engine.Connection):
+        yield connectable
+    else:
+        with connectable.begin() as conn:
+            yield conn
+
+
+def frame_to_records(frame):
+    """Converts a dataframe to a list of row lists of plain Python values
+    with None for missing values, as expected by the database driver.
+
+    Args:
+        frame (pandas.DataFrame): the data to convert, without an index
+    Returns:
+        list[list]: one list of values per row
+    """
+    records = frame.astype(object).where(pd.notnull(frame), None)
+    records = records.values.tolist()
+    datetime_cols = [index for index, dtype in enumerate(frame.dtypes)
+        if dtype.kind == 'M']
+    for row in records:
+        for index in datetime_cols:
+            row[index] = row[index].to_pydatetime() \
+                if pd.notnull(row[index]) else None
+    return records
+
+
+def insert_batches(frame, name, conn, batch_size = 1000):
+    """Inserts the rows of a dataframe with one multi-row insert statement
+    per batch (the driver's executemany).
+
+    Args:
+        frame (pandas.DataFrame): the data to insert, without an index
+        name (str): the name of an existing table with matching columns
+        conn (sqlalchemy.Connection): an open connection within a transaction
+        batch_size (int): number of rows sent in each insert statement
+    """
+    columns = [sqlalchemy.column(col) for col in frame.columns]
+    insert = sqlalchemy.table(name, *columns).insert()
+    for start in range(0, frame.shape[0], batch_size):
+        batch = frame.iloc[start:start + batch_size]
+        conn.execute(insert, [dict(zip(frame.columns, row))
+            for row in frame_to_records(batch)])
+
+
+# characters LOAD DATA reads escaped with a backslash
+INFILE_ESCAPES = [('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'),
+    ('\r', '\\r'), ('\0', '\\0')]
+
+def format_infile_value(value):
+    """Formats one value for a tab-separated LOAD DATA file: None as the
+    unescaped NULL marker \\N, booleans as 1 or 0, and strings with
+    backslashes, tabs and line breaks escaped.
+
+    Args:
+        value: a plain Python value from frame_to_records()
+    Returns:
+        str: the field as written to the file
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return str(int(value))
+    value = str(value)
+    for char, escaped in INFILE_ESCAPES:
+        value = value.replace(char, escaped)
+    return value
+
+
+def write_infile(frame, f):
+    """Writes the rows of a dataframe to a file in the format read by
+    load_data_infile(), one line per row.
+
+    Args:
+        frame (pandas.DataFrame): the data to write, without an index
+        f (file): a file open for writing text
+    """
+    for row in frame_to_records(frame):
+        f.write("\t".join(format_infile_value(value) for value in row))
+        f.write("\n")
+
+
+def load_data_infile(frame, name, conn):
+    """Loads the rows of a dataframe through a temporary tab-separated file
+    with LOAD DATA LOCAL INFILE. The engine must be created with
+    local_infile enabled (see model_data.connect_to_database).
+
+    Args:
+        frame (pandas.DataFrame): the data to load, without an index
+        name (str): the name of an existing table with matching columns
+        conn (sqlalchemy.Connection): an open connection within a transaction
+    """
+    with tempfile.NamedTemporaryFile('w', suffix = '.tsv',
+            delete = False, newline = '') as f:
+        write_infile(frame, f)
+    try:
+        load = """load data local infile '{path}'
+        into table `{name}`
+        fields terminated by '\\t' escaped by '\\\\'
+        lines terminated by '\\n'
+        ({columns})""".format(
+            path = f.name.replace('\\', '/'),
+            name = name,
+            columns = ", ".join("`{}`".format(col) for col in frame.columns))
+        conn.execute(sqlalchemy.text(load))
+    finally:
+        os.remove(f.name)
+
+
+def write_frame(frame, name, engine, method = 'insert', batch_size = 1000,
+        index = True):
+    """Appends a dataframe to a database table in a single transaction,
+    creating the table from the dataframe's columns if it does not exist.
+
+    Usage:
+        write_frame(results, 'out$predictions$screening_train_val', engine,
+            method = 'insert', batch_size = 5000)
+
+    Args:
+        frame (pandas.DataFrame): the data to write
+        name (str): the name of the table to append to
+        engine (sqlalchemy.Engine): a connection to the database (any
+            dialect for method 'insert', MySQL for method 'infile'), or a
+            connection within a transaction to write in that transaction
+        method (str): 'insert' for batched multi-row inserts or 'infile' for
+            LOAD DATA LOCAL INFILE from a temporary file
+        batch_size (int): number of rows in each insert statement
+        index (bool): whether to write the (Multi-)index as columns
+    Returns:
+        float: the number of rows written per second
+    """
+    if index:
+        frame = frame.reset_index()
+
+    start_time = time.time()
+    with begin(engine) as conn:
+        frame.head(0).to_sql(name, conn, index = False, if_exists = 'append')
+        if method == 'infile':
+            load_data_infile(frame, name, conn)
+        elif method == 'insert':
+            insert_batches(frame, name, conn, batch_size = batch_size)
+        else:
+            raise ValueError("unknown write method: {}".format(method))
+    elapsed = max(time.time() - start_time, 1e-6)
+
+    rows_per_sec = frame.shape[0] / elapsed
+    logging.info("wrote {n} rows to {name} ({rate:.0f} rows/sec)".format(
+        n = frame.shape[0], name = name, rate = rows_per_sec))
+    return rows_per_sec
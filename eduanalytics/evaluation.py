@@ -1,5 +1,7 @@
-import matplotlib.pyplot as plt
-from sklearn.metrics import confusion_matrix, precision_recall_curve, roc_auc_score
+from sklearn.metrics import confusion_matrix, roc_auc_score
+from sklearn.pipeline import Pipeline
+from sklearn.externals import joblib
+from eduanalytics import pipeline_tools
 from collections import OrderedDict
 import numpy as np
 import pandas as pd
@@ -39,7 +41,7 @@ def build_confusion_matrix(true, predicted, class_names,
 
 
 def plot_confusion_matrix(cm, class_names, title,
-        cmap = plt.cm.Blues):
+        cmap = None):
     """Plots the confusion matrix with color gradients.
 
     Args:
@@ -48,8 +50,11 @@ def plot_confusion_matrix(cm, class_names, title,
         class_names (list[str]): list of names of the classes, in order
         title (str): plot title
         cmap (pyplot.colors): colors for plot (see more colors at
-            https://matplotlib.org/examples/color/colormaps_reference.html)
+            https://matplotlib.org/examples/color/colormaps_reference.html),
+            defaults to Blues
     """
+    import matplotlib.pyplot as plt
+    cmap = cmap or plt.cm.Blues
     plt.imshow(cm, interpolation = 'nearest', cmap = cmap)
     plt.title(title)
     plt.colorbar()
@@ -101,6 +106,98 @@ def compute_feature_importances_ensemble(clf, transformed_columns,
     return importances, std, indices
 
 
+def score_predictions(y_true, proba):
+    """Scores predicted probabilities with the ROC AUC used for the grid
+    search, averaged over the classes of multiclass models.
+
+    Args:
+        y_true (numpy.ndarray): true outcome transformed with lb.transform
+        proba (numpy.ndarray or list[numpy.ndarray]): the output of
+            predict_proba
+    Returns:
+        float: the AUC
+    """
+    if isinstance(proba, list):
+        proba = np.column_stack([p[:, 1] for p in proba])
+    elif np.ndim(y_true) == 1:
+        proba = proba[:, 1]
+    return roc_auc_score(y_true, proba)
+
+
+def _permutation_scores(downstream, encoded, y, group, seeds, scoring):
+    """Scores the model with the encoded columns of one raw feature permuted
+    once per seed, permuting a working copy of the encoded data in place."""
+    permuted = np.array(encoded)
+    scores = []
+    for seed in seeds:
+        order = np.random.RandomState(seed).permutation(encoded.shape[0])
+        permuted[:, group] = encoded[order][:, group]
+        scores.append(scoring(y, downstream.predict_proba(permuted)))
+    permuted[:, group] = encoded[:, group]
+    return scores
+
+
+def compute_permutation_importances(cv_pipeline, X, y, n_repeats = 5,
+        scoring = score_predictions, n_jobs = 1, random_state = 1100,
+        print_output = True):
+    """Returns the drop in score when each raw feature is randomly permuted
+    in held-out data, and its variability over the permutations.
+
+    Unlike impurity importances, these do not favor categorical features
+    with many levels, since the dummies and NA indicator of a categorical
+    feature are permuted together. The data is encoded once, and each
+    permutation only reorders the encoded columns of one feature before the
+    steps after the encoder and the model are applied.
+
+    Usage:
+        importances, std, indices, features = \
+            compute_permutation_importances(clf, X_test, y_test, n_jobs = 4)
+        plot_feature_importances(importances, std, indices, features)
+
+    Args:
+        cv_pipeline (sklearn.GridSearchCV or sklearn.Pipeline): a fitted
+            search or its best pipeline, with a DummyEncoder first
+        X (Pandas.DataFrame): held-out features, as passed to the pipeline
+        y (numpy.ndarray): held-out outcome transformed with lb.transform
+        n_repeats (int): number of permutations of each feature
+        scoring (callable): a function of y and the predicted probabilities
+            giving a score to maximize
+        n_jobs (int): number of processes scoring features
+        random_state (int): seed for the permutations
+        print_output (bool): whether or not to print the feature importances
+            for all features along with their scores in descending order
+    Returns:
+        list[float]: unranked list of the feature importances
+        list[float]: unranked list of standard deviation of the
+            feature importances across permutations
+        list[int]: indices for ranking features in descending order
+        pandas.Index: unranked names of the raw features
+    """
+    steps = pipeline_tools.get_best_pipeline(cv_pipeline).steps
+    encoder = steps[0][1]
+    downstream = Pipeline(steps[1:])
+    encoded = encoder.transform_array(X) \
+        if hasattr(encoder, 'category_mapping_') \
+        else encoder.transform(X).values
+    groups = pipeline_tools.get_feature_groups(encoder)
+    seeds = np.random.RandomState(random_state).randint(
+        np.iinfo(np.int32).max, size = (len(groups), n_repeats))
+
+    baseline = scoring(y, downstream.predict_proba(encoded))
+    scores = joblib.Parallel(n_jobs = n_jobs)(
+        joblib.delayed(_permutation_scores)(downstream, encoded, y, group,
+            feature_seeds, scoring)
+        for group, feature_seeds in zip(groups.values(), seeds))
+    drops = baseline - np.array(scores)
+    importances, std = drops.mean(axis = 1), drops.std(axis = 1)
+    indices = np.argsort(importances)[::-1] # descending order
+    feature_names = pd.Index(list(groups.keys()))
+
+    if print_output:
+        print_feature_importances(importances, feature_names, indices)
+    return importances, std, indices, feature_names
+
+
 def print_feature_importances(importances, column_labels, indices):
     """Prints the feature importances ranked in descending order along with
     their rank and importance score.
@@ -131,6 +228,7 @@ def plot_feature_importances(importances, std, indices,
         transformed_columns (list[str]): unranked list of names of the features
         top_n (int): how many features should be included in the plot
     """
+    import matplotlib.pyplot as plt
     top_n = min( len(importances), top_n)
     top_n_indices = indices[:top_n]
     plt.title("Feature importances")
@@ -150,13 +248,116 @@ def generate_binary_at_k(y_scores, k):
         k (float): a specified percentage to classify as class 1
     Returns:
         numpy.ndarray: binary hard predictions with k percent in class 1
+            (every score when k is 100 percent)
     """
+    y_scores = np.asarray(y_scores)
     k = k / 100.0 if k >= 1 else k
-    cutoff_index = int(len(y_scores) * k)
-    indices = np.argsort(y_scores)[::-1]
-    cutoff = y_scores[indices][cutoff_index]
-    test_predictions_binary = [1 if y > cutoff else 0 for y in y_scores]
-    return test_predictions_binary
+    # rounded as in precision_recall_at_k
+    rank = int(np.floor(len(y_scores) * k + 1e-9))
+    if rank >= len(y_scores):
+        return np.ones(len(y_scores), dtype = int)
+    # the cutoff is the (rank + 1)-th largest score
+    cutoff_index = len(y_scores) - 1 - rank
+    cutoff = np.partition(y_scores, cutoff_index)[cutoff_index]
+    return (y_scores > cutoff).astype(int)
+
+
+def precision_recall_at_k(y_true, y_score, k = None, groups = None):
+    """Computes precision, recall and lift when the top k fraction of the
+    population is classified as positive, for a whole grid of k at once.
+
+    As in generate_binary_at_k, the rows classified as positive at k are those
+    scored strictly above the score ranked int(n * k), so tied scores are
+    never split. The scores are sorted once (within each group), and every
+    k is then read from cumulative counts of true positives.
+
+    Usage:
+        # one row per (algorithm_id, k)
+        metrics = precision_recall_at_k(test_results.true,
+            test_results.pred_prob, k = [.05, .1, .2],
+            groups = test_results.algorithm_id)
+        # one-vs-rest for each class of a multiclass model
+        metrics = precision_recall_at_k(lb.transform(y_test),
+            clf.predict_proba(X_test), k = [.05, .1, .2])
+
+    Args:
+        y_true (numpy.ndarray): binary labels, either one column shared by
+            every column of y_score or one column per column of y_score
+        y_score (numpy.ndarray or Pandas.DataFrame): scores, one column per
+            algorithm or class (the DataFrame column names label the output)
+        k (list[float]): fractions of the population classified as positive,
+            defaults to every percent from 1 to 100
+        groups (numpy.ndarray): a group label for each row of a single score
+            column (e.g. the algorithm_id of each prediction), to compute the
+            metrics within each group
+    Returns:
+        Pandas.DataFrame: indexed by k, or by (group or column label, k),
+            with the score cutoff, the number and fraction of the population
+            classified as positive, precision, recall and lift
+    """
+    k = np.arange(1, 101) / 100. if k is None else np.atleast_1d(
+        np.asarray(k, dtype = float))
+    labels = None
+    if isinstance(y_score, pd.DataFrame):
+        labels = list(y_score.columns)
+    y_score = np.asarray(y_score, dtype = float)
+    y_true = np.asarray(y_true, dtype = float)
+
+    if y_score.ndim == 2:
+        # stack the columns into one long column grouped by column number
+        n_rows, n_cols = y_score.shape
+        labels = labels or list(range(n_cols))
+        y_true = np.broadcast_to(y_true.reshape(n_rows, -1), y_score.shape)
+        score, true = y_score.T.ravel(), y_true.T.ravel()
+        codes = np.repeat(np.arange(n_cols), n_rows)
+    elif groups is not None:
+        labels, codes = np.unique(np.asarray(groups), return_inverse = True)
+        score, true = y_score, y_true
+    else:
+        score, true = y_score, y_true
+        codes = np.zeros(score.size, dtype = int)
+
+    order = np.lexsort((-score, codes))
+    score, true, codes = score[order], true[order], codes[order]
+    counts = np.bincount(codes)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    cum_true = np.concatenate([[0.], np.cumsum(true)])
+
+    # the first row of each run of tied scores within a group
+    is_new = np.ones(score.size, dtype = bool)
+    is_new[1:] = (score[1:] != score[:-1]) | (codes[1:] != codes[:-1])
+    tie_start = np.maximum.accumulate(
+        np.where(is_new, np.arange(score.size), 0))
+
+    # n_groups x n_k arrays from here on
+    rank = np.floor(counts[:, np.newaxis] * k + 1e-9).astype(int)
+    in_range = rank < counts[:, np.newaxis]
+    cutoff_row = np.where(in_range, starts[:, np.newaxis] + rank, 0)
+    end = np.where(in_range, tie_start[cutoff_row],
+        (starts + counts)[:, np.newaxis])
+    n_selected = end - starts[:, np.newaxis]
+    true_positives = cum_true[end] - cum_true[starts][:, np.newaxis]
+    n_positive = (cum_true[starts + counts] - cum_true[starts])[:, np.newaxis]
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        precision = np.where(n_selected > 0,
+            true_positives / n_selected, np.nan)
+        recall = true_positives / n_positive
+        lift = precision / (n_positive / counts[:, np.newaxis])
+
+    metrics = pd.DataFrame(OrderedDict([
+        ('threshold', np.where(in_range, score[cutoff_row], -np.inf).ravel()),
+        ('n_selected', n_selected.ravel()),
+        ('population_fraction', (n_selected / counts[:, np.newaxis]).ravel()),
+        ('precision', precision.ravel()),
+        ('recall', recall.ravel()),
+        ('lift', lift.ravel())]))
+    if labels is None:
+        metrics.index = pd.Index(k, name = 'k')
+    else:
+        metrics.index = pd.MultiIndex.from_product([labels, k],
+            names = ['label', 'k'])
+    return metrics
 
 
 def plot_precision_recall_n(y_true, y_score, model_name):
@@ -168,28 +369,21 @@ def plot_precision_recall_n(y_true, y_score, model_name):
         y_score (numpy.ndarray): predicted probabilities for class 1
         model_name (str): title for the plot
     """
-    precision, recall, thresholds = precision_recall_curve(
-        y_true, y_score)
-
-    precision = precision[:-1]
-    recall = recall[:-1]
-
-    pct_positive_at_thresh = []
+    import matplotlib.pyplot as plt
     number_scored = len(y_score)
-
-    for threshold in thresholds:
-        num_above_thresh = len( y_score[y_score >= threshold] )
-        pct_above_thresh = num_above_thresh / float(number_scored)
-        pct_positive_at_thresh.append( pct_above_thresh )
-    pct_positive_at_thresh = np.array( pct_positive_at_thresh )
+    # every rank, which gives a point at each distinct score
+    metrics = precision_recall_at_k(y_true, y_score,
+        k = np.arange(1, number_scored + 1) / float(number_scored))
+    metrics = metrics[metrics.n_selected > 0].drop_duplicates('n_selected')
+    pct_positive_at_thresh = metrics.population_fraction.values
 
     plt.clf()
     fig, ax1 = plt.subplots()
-    ax1.plot( pct_positive_at_thresh, precision, 'b' )
+    ax1.plot( pct_positive_at_thresh, metrics.precision.values, 'b' )
     ax1.set_xlabel('percent of population')
     ax1.set_ylabel('positive predictive value', color='b')
     ax2 = ax1.twinx()
-    ax2.plot( pct_positive_at_thresh, recall, 'r' )
+    ax2.plot( pct_positive_at_thresh, metrics.recall.values, 'r' )
     ax2.set_ylabel('true positive rate', color='r')
     ax1.set_ylim([0,1])
     ax1.set_ylim([0,1])
@@ -0,0 +1,198 @@
+import pandas as pd
+import numpy as np
+import os, json, hashlib, logging
+from collections import OrderedDict
+from sklearn.externals import joblib
+
+def cache_key(feature_tbl, subquery, dtypes = None):
+    """Builds the filename stem identifying a cached feature table pull.
+
+    Args:
+        feature_tbl (str): full name of the feature table or view
+        subquery (str): the subquery giving the aamc_id and application_year
+            of the applicants of interest (the cohort specification)
+        dtypes (dict): the dtypes the table is read with (see
+            schema.resolve_dtypes, including any overrides), or None for the
+            dtypes pandas reads
+    Returns:
+        str: a hex digest unique to the feature table, cohort specification
+            and dtypes
+    """
+    spec = "{}\n{}\n{}".format(feature_tbl, " ".join(subquery.split()),
+        json.dumps(None if dtypes is None else list(dtypes.items())))
+    return hashlib.sha1(spec.encode('utf-8')).hexdigest()
+
+
+def get_schema_checksum(engine, feature_tbl):
+    """Checksums the declared columns of a feature table or view and, for a
+    view, its definition, so that redefining a view changes the checksum.
+
+    Args:
+        engine (sqlalchemy.Engine): a connection to the MySQL database
+        feature_tbl (str): full name of the feature table or view
+    Returns:
+        str: a hex digest of the column names and types and view definition
+    """
+    columns_query = """select column_name, column_type
+    from information_schema.columns
+    where table_schema = database()
+    and table_name = '{feature_tbl}'
+    order by ordinal_position""".format(feature_tbl = feature_tbl)
+    view_query = """select view_definition
+    from information_schema.views
+    where table_schema = database()
+    and table_name = '{feature_tbl}'""".format(feature_tbl = feature_tbl)
+    columns = pd.read_sql_query(columns_query, engine)
+    view = pd.read_sql_query(view_query, engine)
+    spec = json.dumps({'columns': columns.astype(str).values.tolist(),
+        'view_definition': [str(value) for value in view.iloc[:,0]]})
+    return hashlib.sha1(spec.encode('utf-8')).hexdigest()
+
+
+def get_fingerprint(engine, feature_tbl, subquery, key_tbl = None):
+    """Runs a cheap freshness query against a feature table for the applicants
+    returned by the subquery. The fingerprint changes whenever applicants are
+    added to or removed from the table for that cohort, or when the table's
+    columns or view definition change (see get_schema_checksum).
+
+    Args:
+        engine (sqlalchemy.Engine): a connection to the MySQL database
+        feature_tbl (str): full name of the feature table or view
+        subquery (str): the subquery giving the aamc_id and application_year
+            of the applicants of interest
+        key_tbl (str): optional name of a table holding the materialized keys
+            of the subquery, joined in place of the subquery
+    Returns:
+        dict: row count, maximum key values, a checksum over the keys, and
+            the schema checksum
+    """
+    fingerprint_query = """select count(*) as n_rows,
+        max(aamc_id) as max_aamc_id,
+        max(application_year) as max_application_year,
+        bit_xor(crc32(concat_ws('-', aamc_id, application_year))) as checksum
+        from `{feature_tbl}`
+        where (aamc_id, application_year) in ({query})""".format(
+            feature_tbl = feature_tbl,
+            query = "select aamc_id, application_year from `{}`".format(
+                key_tbl) if key_tbl else subquery)
+    fingerprint = pd.read_sql_query(fingerprint_query, engine).iloc[0]
+    fingerprint = {key: None if pd.isnull(value) else str(value)
+        for key, value in fingerprint.items()}
+    fingerprint['schema'] = get_schema_checksum(engine, feature_tbl)
+    return fingerprint
+
+
+def write_cache(feature_data, cache_dir, key, fingerprint):
+    """Writes a feature table to the cache as one uncompressed 2-D array per
+    numeric dtype, laid out as pandas holds its blocks, so the file can be
+    memory-mapped when read back. Other columns (categoricals, strings) are
+    pickled one by one.
+
+    Args:
+        feature_data (pandas.DataFrame): the features pulled from the database
+            with Multi-index of aamc id and application year
+        cache_dir (str): path to the directory holding the cached tables
+        key (str): filename stem for the cached table from cache_key()
+        fingerprint (dict): the freshness fingerprint from get_fingerprint()
+    Returns:
+        str: the path to the cached data file
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    blocks, other = OrderedDict(), OrderedDict()
+    for col in feature_data:
+        dtype = feature_data[col].dtype
+        if dtype.kind in 'biuf':
+            blocks.setdefault(dtype.name, []).append(col)
+        else:
+            other[col] = feature_data[col].values
+    columnar = {'columns': list(feature_data.columns),
+        'blocks': [(cols, np.asfortranarray(feature_data[cols].values))
+            for cols in blocks.values()],
+        'other': other,
+        'index_names': list(feature_data.index.names),
+        'index': [feature_data.index.get_level_values(level).values
+            for level in range(feature_data.index.nlevels)]}
+    data_path = os.path.join(cache_dir, "{}.pkl".format(key))
+    joblib.dump(columnar, data_path)
+    with open(os.path.join(cache_dir, "{}.json".format(key)), 'w') as f:
+        json.dump(fingerprint, f)
+    return data_path
+
+
+def read_cache(cache_dir, key, mmap_mode = 'c'):
+    """Reads a feature table written by write_cache().
+
+    A table whose columns all share one numeric dtype is built on the mapped
+    array without copying it, so only the pages that are used are read from
+    disk. Tables mixing dtypes (or holding categoricals or strings) are
+    copied into memory as their blocks are put together.
+
+    Args:
+        cache_dir (str): path to the directory holding the cached tables
+        key (str): filename stem for the cached table from cache_key()
+        mmap_mode (str): passed to joblib.load, memory-maps the arrays
+            (copy-on-write by default, so the frame can still be modified)
+    Returns:
+        pandas.DataFrame: the cached features with Multi-index of aamc id
+            and application year
+    """
+    columnar = joblib.load(os.path.join(cache_dir, "{}.pkl".format(key)),
+        mmap_mode = mmap_mode)
+    index = pd.MultiIndex.from_arrays(columnar['index'],
+        names = columnar['index_names'])
+    frames = [pd.DataFrame(values, index = index, columns = cols,
+        copy = False) for cols, values in columnar['blocks']]
+    if columnar['other']:
+        frames.append(pd.DataFrame(columnar['other'], index = index,
+            columns = list(columnar['other'])))
+    if len(frames) == 1:
+        return frames[0]
+    feature_data = pd.concat(frames, axis = 1) if frames \
+        else pd.DataFrame(index = index)
+    return feature_data[columnar['columns']]
+
+
+def read_through(cache_dir, engine, feature_tbl, subquery, fetch,
+        key_tbl = None, dtypes = None):
+    """Returns a feature table from the local cache if its fingerprint still
+    matches the database, otherwise pulls it with fetch() and caches it.
+
+    Note that the fingerprint only covers the (aamc_id, application_year) keys
+    and the table's columns and view definition, so delete the cache
+    directory after feature values are regenerated in place for existing
+    applicants.
+
+    Args:
+        cache_dir (str): path to the directory holding the cached tables
+        engine (sqlalchemy.Engine): a connection to the MySQL database
+        feature_tbl (str): full name of the feature table or view
+        subquery (str): the subquery giving the aamc_id and application_year
+            of the applicants of interest
+        fetch (callable): a function with no arguments that pulls the full
+            feature table from the database on a cache miss
+        key_tbl (str): optional name of a table holding the materialized keys
+            of the subquery, used for the fingerprint query
+        dtypes (dict): the dtypes fetch() reads the table with, or None for
+            the dtypes pandas reads, so tables cached with other dtypes are
+            not returned
+    Returns:
+        pandas.DataFrame: the features for all the applicants returned by the
+            subquery, with Multi-index of aamc id and application year
+    """
+    key = cache_key(feature_tbl, subquery, dtypes)
+    fingerprint = get_fingerprint(engine, feature_tbl, subquery, key_tbl)
+
+    fingerprint_path = os.path.join(cache_dir, "{}.json".format(key))
+    if os.path.exists(fingerprint_path):
+        with open(fingerprint_path) as f:
+            cached_fingerprint = json.load(f)
+        if cached_fingerprint == fingerprint:
+            logging.info("cache hit for {}".format(feature_tbl))
+            return read_cache(cache_dir, key)
+
+    logging.info("cache miss for {}, pulling from database".format(
+        feature_tbl))
+    feature_data = fetch()
+    write_cache(feature_data, cache_dir, key, fingerprint)
+    return feature_data
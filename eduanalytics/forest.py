@@ -0,0 +1,452 @@
+from eduanalytics import pipeline_tools
+import pandas as pd
+import numpy as np
+import scipy.sparse
+import logging, time
+from collections import OrderedDict
+
+class CompiledForest(object):
+    """A fitted random forest (or extra trees) classifier flattened into
+    contiguous node arrays, evaluated for a whole batch of rows at once.
+
+    The nodes of every tree are concatenated into one set of arrays, with
+    leaves pointing back to themselves, so each traversal step moves every
+    (row, tree) pair down one level with a few vectorized lookups and no
+    branching. Thresholds are rounded down to float32 so that comparing the
+    float32 data gives exactly the splits of the sklearn trees. Leaf values
+    are stored as class probabilities. The arrays pickle as plain numpy
+    arrays, so a compiled forest saved with joblib can be loaded with
+    mmap_mode and shared between processes.
+
+    With traversal = 'native', the leaves are found with each sklearn tree's
+    own compiled apply instead, and only the leaf values are read from the
+    flat arrays. The vectorized traversal (the default) always takes
+    max_depth steps, so very deep forests may score faster natively; use
+    benchmark() to compare the two on a given model.
+
+    Usage:
+        compiled = CompiledForest(
+            pipeline_tools.extract_model_from_pipeline(grid_search))
+        proba = compiled.predict_proba(X_transformed)
+
+    Args:
+        forest (sklearn.ensemble.RandomForestClassifier): the fitted forest
+        batch_size (int): number of rows traversed at a time, bounding the
+            memory used for the (row, tree) node arrays
+        traversal (str): 'vectorized' or 'native'
+    """
+    def __init__(self, forest, batch_size = 4096, traversal = 'vectorized'):
+        if traversal not in ('vectorized', 'native'):
+            raise ValueError("unknown traversal: {}".format(traversal))
+        self.batch_size = batch_size
+        self.traversal = traversal
+        self.n_outputs = forest.n_outputs_
+        self.n_features = forest.n_features_ if hasattr(forest,
+            'n_features_') else forest.n_features_in_
+        self.n_classes = np.atleast_1d(forest.n_classes_).astype(int)
+        self.trees = [estimator.tree_ for estimator in forest.estimators_] \
+            if traversal == 'native' else None
+
+        trees = [estimator.tree_ for estimator in forest.estimators_]
+        offsets = np.cumsum([0] + [tree.node_count for tree in trees])
+        self.roots = offsets[:-1].astype(np.intp)
+        self.max_depth = max(tree.max_depth for tree in trees)
+        nodes = np.arange(offsets[-1])
+        is_leaf = np.concatenate([tree.children_left < 0 for tree in trees])
+
+        # row i at node j moves to children[2 * j + (X[i, feature[j]] >
+        # threshold[j])], and leaves (threshold inf) to themselves
+        self.feature = np.where(is_leaf, 0,
+            np.concatenate([tree.feature for tree in trees])).astype(np.intp)
+        threshold = np.concatenate([tree.threshold for tree in trees])
+        threshold32 = threshold.astype(np.float32)
+        rounded_up = threshold32.astype(np.float64) > threshold
+        threshold32[rounded_up] = np.nextafter(threshold32[rounded_up],
+            np.float32(-np.inf))
+        threshold32[is_leaf] = np.inf
+        self.threshold = threshold32
+        self.children = np.empty(2 * nodes.size, dtype = np.intp)
+        self.children[0::2] = np.where(is_leaf, nodes, np.concatenate(
+            [tree.children_left + offset
+            for tree, offset in zip(trees, offsets)]))
+        self.children[1::2] = np.where(is_leaf, nodes, np.concatenate(
+            [tree.children_right + offset
+            for tree, offset in zip(trees, offsets)]))
+
+        value = np.concatenate([tree.value for tree in trees]).astype(
+            np.float64)
+        normalizer = value.sum(axis = -1, keepdims = True)
+        normalizer[normalizer == 0] = 1
+        self.value = value / normalizer
+        self._deltas = None
+
+    @property
+    def n_trees(self):
+        return self.roots.size
+
+    def apply(self, X):
+        """Finds the leaf reached by each row in each tree.
+
+        Args:
+            X (numpy.ndarray): the transformed data, n_rows x n_features
+        Returns:
+            numpy.ndarray: indices into the concatenated node arrays,
+                n_rows x n_trees
+        """
+        X = np.ascontiguousarray(X, dtype = np.float32)
+        if self.traversal == 'native':
+            return np.column_stack([tree.apply(X)
+                for tree in self.trees]) + self.roots
+
+        n_rows, n_features = X.shape
+        flat = X.ravel()
+        row_start = (np.arange(n_rows) * n_features)[:, np.newaxis]
+        nodes = np.tile(self.roots, (n_rows, 1))
+        for _ in range(self.max_depth):
+            x = flat[row_start + self.feature[nodes]]
+            nodes = self.children[2 * nodes + (x > self.threshold[nodes])]
+        return nodes
+
+    def decision_path(self, X):
+        """Finds the nodes each row passes through in each tree.
+
+        Args:
+            X (numpy.ndarray): the transformed data, n_rows x n_features
+        Returns:
+            scipy.sparse.csr_matrix: n_rows x n_nodes indicator of the
+                visited nodes of the concatenated node arrays
+        """
+        X = np.ascontiguousarray(X, dtype = np.float32)
+        if self.traversal == 'native':
+            return scipy.sparse.hstack([tree.decision_path(X)
+                for tree in self.trees]).tocsr()
+
+        n_rows, n_features = X.shape
+        flat = X.ravel()
+        row_start = (np.arange(n_rows) * n_features)[:, np.newaxis]
+        nodes = np.tile(self.roots, (n_rows, 1))
+        visited = [nodes]
+        for _ in range(self.max_depth):
+            x = flat[row_start + self.feature[nodes]]
+            nodes = self.children[2 * nodes + (x > self.threshold[nodes])]
+            visited.append(nodes)
+        visited = np.stack(visited, axis = 1).reshape(n_rows, -1)
+        rows = np.repeat(np.arange(n_rows), visited.shape[1])
+        # leaves are revisited once reached, count them once
+        paths = scipy.sparse.csr_matrix((np.ones(rows.size), (rows,
+            visited.ravel())), shape = (n_rows, self.value.shape[0]))
+        paths.sum_duplicates()
+        paths.data[:] = 1
+        return paths
+
+    def _node_deltas(self):
+        """The change in class probabilities from each node's parent, and
+        the feature the parent splits on (0 for the roots, which have no
+        change)."""
+        if getattr(self, '_deltas', None) is None:
+            is_leaf = np.isinf(self.threshold)
+            internal = np.flatnonzero(~is_leaf)
+            parent = np.full(self.value.shape[0], -1, dtype = np.intp)
+            parent[self.children[2 * internal]] = internal
+            parent[self.children[2 * internal + 1]] = internal
+            has_parent = parent >= 0
+            split_feature = np.zeros(parent.size, dtype = np.intp)
+            split_feature[has_parent] = self.feature[parent[has_parent]]
+            delta = np.zeros_like(self.value)
+            delta[has_parent] = self.value[has_parent] \
+                - self.value[parent[has_parent]]
+            self._deltas = (split_feature, delta)
+        return self._deltas
+
+    def predict_contributions(self, X, feature_map = None, n_groups = None):
+        """Splits each prediction into the bias (the average class
+        probabilities at the roots) and a contribution of each feature: the
+        changes in class probabilities at each split along the row's path
+        through each tree, credited to the split feature and averaged over
+        the trees. The bias plus the contributions is exactly the
+        predict_proba output.
+
+        Args:
+            X (numpy.ndarray): the transformed data, n_rows x n_features
+            feature_map (numpy.ndarray): a group number for each feature, to
+                sum the contributions of features within groups
+            n_groups (int): the number of groups in feature_map
+        Returns:
+            numpy.ndarray: the bias, n_outputs x n_classes
+            numpy.ndarray: the contributions, n_rows x n_features (or
+                n_groups) x n_outputs x n_classes
+        """
+        split_feature, delta = self._node_deltas()
+        n_columns = self.n_features
+        if feature_map is not None:
+            split_feature, n_columns = feature_map[split_feature], n_groups
+        n_nodes = delta.shape[0]
+        delta = delta.reshape(n_nodes, -1) / self.n_trees
+        node_index = np.arange(n_nodes)
+        credit = [scipy.sparse.csr_matrix((delta[:, k],
+            (node_index, split_feature)), shape = (n_nodes, n_columns))
+            for k in range(delta.shape[1])]
+
+        contributions = np.empty((X.shape[0], n_columns, delta.shape[1]))
+        for start in range(0, X.shape[0], self.batch_size):
+            paths = self.decision_path(X[start:start + self.batch_size])
+            for k, matrix in enumerate(credit):
+                contributions[start:start + self.batch_size, :, k] = \
+                    (paths * matrix).toarray()
+        bias = self.value[self.roots].mean(axis = 0)
+        return bias, contributions.reshape(X.shape[0], n_columns,
+            *self.value.shape[1:])
+
+    def predict_proba(self, X):
+        """Averages the leaf class probabilities over the trees, as
+        RandomForestClassifier.predict_proba does.
+
+        Args:
+            X (numpy.ndarray): the transformed data, n_rows x n_features
+        Returns:
+            numpy.ndarray or list[numpy.ndarray]: n_rows x n_classes
+                probabilities, or a list with one such array per output for
+                multi-output forests
+        """
+        proba = np.zeros((X.shape[0], self.n_outputs, self.value.shape[-1]))
+        for start in range(0, X.shape[0], self.batch_size):
+            leaves = self.apply(X[start:start + self.batch_size])
+            batch = proba[start:start + self.batch_size]
+            for tree_leaves in leaves.T:
+                batch += self.value[tree_leaves]
+        proba /= self.n_trees
+        outputs = [proba[:, k, :n_classes]
+            for k, n_classes in enumerate(self.n_classes)]
+        return outputs[0] if self.n_outputs == 1 else outputs
+
+
+class CompiledPipeline(object):
+    """A fitted DummyEncoder -> Imputer -> VarianceThreshold -> random forest
+    pipeline with the preprocessing composed into a single column map and
+    the forest compiled into a CompiledForest. A drop-in replacement for the
+    pipeline in reporting.get_results and write_current_predictions.
+
+    The encoder writes the dense encoded array directly (see
+    DummyEncoder.transform_array), the columns kept by the imputer and the
+    variance threshold are taken from it in one step, and only the columns
+    the forest splits on are imputed.
+
+    Usage:
+        clf, lb = reporting.load_model(pkl_path, alg_id)
+        results = reporting.get_results(forest.CompiledPipeline(clf),
+            X, y = None, lb = lb)
+
+    Args:
+        cv_pipeline (sklearn.GridSearchCV or sklearn.Pipeline): the fitted
+            search or its best pipeline
+        batch_size (int): number of rows traversed at a time
+        traversal (str): 'vectorized' or 'native' (see CompiledForest)
+    """
+    def __init__(self, cv_pipeline, batch_size = 4096,
+            traversal = 'vectorized'):
+        steps = pipeline_tools.get_best_pipeline(cv_pipeline).steps
+        self.encoder = steps[0][1]
+        if not isinstance(self.encoder, pipeline_tools.DummyEncoder):
+            raise ValueError("the first pipeline step must be a DummyEncoder")
+        self.forest = CompiledForest(steps[-1][1], batch_size = batch_size,
+            traversal = traversal)
+
+        n_encoded = len(self.encoder.transformed_columns)
+        columns = np.arange(n_encoded)
+        fill = np.full(n_encoded, np.nan)
+        for name, step in steps[1:-1]:
+            if hasattr(step, 'statistics_'):
+                columns, fill = compose_imputer(step, columns, fill)
+            elif hasattr(step, 'get_support'):
+                support = step.get_support()
+                columns, fill = columns[support], fill[support]
+            else:
+                raise ValueError("cannot compile pipeline step {}".format(name))
+        self.columns = columns
+
+        # leaves have feature 0 in the compiled forest, which is harmless
+        used = np.unique(self.forest.feature)
+        self.impute_columns = used[~np.isnan(fill[used])]
+        self.impute_values = fill[self.impute_columns].astype(np.float32)
+
+        # the raw feature of each forest feature, for contributions
+        groups = pipeline_tools.get_feature_groups(self.encoder)
+        raw_feature = np.zeros(n_encoded, dtype = np.intp)
+        for index, group in enumerate(groups.values()):
+            raw_feature[group] = index
+        self.feature_names = list(groups.keys())
+        self.feature_map = raw_feature[columns]
+
+    def transform(self, X):
+        """Encodes, selects and imputes the data as the pipeline steps before
+        the forest do.
+
+        Args:
+            X (Pandas.DataFrame): the features, as passed to the pipeline
+        Returns:
+            numpy.ndarray: float32 array, n_rows x the number of features of
+                the forest (columns the forest never splits on are not
+                imputed)
+        """
+        if hasattr(self.encoder, 'category_mapping_'):
+            encoded = self.encoder.transform_array(X)
+        else:
+            # encoders fitted before the dense output mode existed
+            encoded = self.encoder.transform(X).values
+        transformed = encoded[:, self.columns].astype(np.float32, copy = False)
+        values = transformed[:, self.impute_columns]
+        missing = np.isnan(values)
+        if missing.any():
+            values[missing] = np.broadcast_to(self.impute_values,
+                values.shape)[missing]
+            transformed[:, self.impute_columns] = values
+        return transformed
+
+    def predict_proba(self, X):
+        return self.forest.predict_proba(self.transform(X))
+
+    def predict_contributions(self, X):
+        """Splits each prediction into the bias and a contribution of each
+        raw feature (a categorical feature gets the contributions of all its
+        dummies and NA indicator). See CompiledForest.predict_contributions.
+
+        Args:
+            X (Pandas.DataFrame): the features, as passed to the pipeline
+        Returns:
+            numpy.ndarray: the bias, n_outputs x n_classes
+            numpy.ndarray: the contributions, n_rows x len(feature_names) x
+                n_outputs x n_classes
+        """
+        return self.forest.predict_contributions(self.transform(X),
+            self.feature_map, len(self.feature_names))
+
+    def explain(self, X, lb, n_features = 5):
+        """Lists the raw features contributing most to the predicted
+        probability of each applicant, in the layout of
+        lime.explain_cohort, so they can be written with
+        lime.write_explanations.
+
+        Usage:
+            explanations = forest.CompiledPipeline(clf).explain(
+                current_data, lb)
+            lime.write_explanations(explanations, engine, alg_id)
+
+        Args:
+            X (Pandas.DataFrame): the features, with Multi-index of aamc id
+                and application year
+            lb (sklearn.LabelBinarizer): the label binarizer of the model
+            n_features (int): number of features kept per applicant
+        Returns:
+            Pandas.DataFrame: one row per applicant, class and feature rank
+                with the aamc_id, application_year, class_name, rank,
+                feature, condition (the feature's value) and weight (its
+                contribution to the probability of the class)
+        """
+        bias, contributions = self.predict_contributions(X)
+        # the positive class of a binary model, or each class of a
+        # multiclass model (one output per class)
+        if self.forest.n_outputs == 1:
+            labels = [(0, lb.classes_[1])]
+        else:
+            labels = list(enumerate(lb.classes_))
+        n_rows, n_features = X.shape[0], min(n_features,
+            len(self.feature_names))
+        feature_names = np.array(self.feature_names, dtype = object)
+        values = X[self.feature_names].astype(object).values
+        rows = np.arange(n_rows)[:, np.newaxis]
+
+        explanations = []
+        for output, class_name in labels:
+            weights = contributions[:, :, output, 1]
+            top = np.argsort(-np.abs(weights), axis = 1,
+                kind = 'mergesort')[:, :n_features]
+            explanation = pd.DataFrame(OrderedDict([
+                ('class_name', class_name),
+                ('rank', np.tile(np.arange(1, n_features + 1), n_rows)),
+                ('feature', feature_names[top].ravel()),
+                ('condition', ['{}={}'.format(feature, value)
+                    for feature, value in zip(feature_names[top].ravel(),
+                    values[rows, top].ravel())]),
+                ('weight', weights[rows, top].ravel())]),
+                index = X.index.repeat(n_features))
+            explanations.append(explanation)
+        return pd.concat(explanations).reset_index()
+
+
+def compose_imputer(imputer, columns, fill):
+    """Composes a fitted mean/median/most frequent imputer (imputing NaN
+    along columns) with the column map of the steps before it. Columns with
+    no statistic (all missing in training) are dropped, as the imputer does.
+
+    Args:
+        imputer (sklearn.preprocessing.Imputer): the fitted imputer
+        columns (numpy.ndarray): the encoded column of each input column
+        fill (numpy.ndarray): the fill value of each input column, NaN where
+            none is set yet
+    Returns:
+        (numpy.ndarray, numpy.ndarray): the encoded column and the fill value
+            of each output column
+    """
+    missing_values = getattr(imputer, 'missing_values', 'NaN')
+    if getattr(imputer, 'axis', 0) != 0 or not (missing_values == 'NaN'
+            or (isinstance(missing_values, float) and np.isnan(missing_values))):
+        raise ValueError("can only compile imputers of NaN along columns")
+    statistics = np.asarray(imputer.statistics_, dtype = np.float64)
+    keep = ~np.isnan(statistics)
+    if getattr(imputer, 'keep_empty_features', False):
+        keep[:] = True
+    fill = np.where(np.isnan(fill), statistics, fill)
+    return columns[keep], fill[keep]
+
+
+def benchmark(cv_pipeline, X, n_repeats = 3, batch_size = 4096):
+    """Times the stock pipeline's predict_proba against the compiled pipeline
+    with each traversal on the same data, and checks that the probabilities
+    agree.
+
+    Usage:
+        clf, lb = reporting.load_model(pkl_path, alg_id)
+        forest.benchmark(clf, current_data)
+
+    Args:
+        cv_pipeline (sklearn.GridSearchCV or sklearn.Pipeline): the fitted
+            search or its best pipeline
+        X (Pandas.DataFrame): the features, as passed to the pipeline
+        n_repeats (int): number of timed runs of each, the best is kept
+        batch_size (int): number of rows traversed at a time
+    Returns:
+        pandas.DataFrame: for the stock pipeline and each traversal, the
+            compile time, best predict time in seconds, speedup over the
+            stock pipeline, and largest absolute difference from the stock
+            probabilities
+    """
+    pipeline = pipeline_tools.get_best_pipeline(cv_pipeline)
+
+    def best_time(predict_proba):
+        times = []
+        for _ in range(n_repeats):
+            start_time = time.time()
+            proba = predict_proba(X)
+            times.append(time.time() - start_time)
+        return min(times), proba if isinstance(proba, list) else [proba]
+
+    stock_seconds, stock = best_time(pipeline.predict_proba)
+    results = OrderedDict([('stock', {'compile_seconds': 0.,
+        'predict_seconds': stock_seconds, 'speedup': 1., 'max_abs_diff': 0.})])
+    for traversal in ['vectorized', 'native']:
+        start_time = time.time()
+        compiled = CompiledPipeline(pipeline, batch_size = batch_size,
+            traversal = traversal)
+        compile_seconds = time.time() - start_time
+        predict_seconds, proba = best_time(compiled.predict_proba)
+        results[traversal] = {'compile_seconds': compile_seconds,
+            'predict_seconds': predict_seconds,
+            'speedup': stock_seconds / max(predict_seconds, 1e-9),
+            'max_abs_diff': max(np.abs(a - b).max()
+                for a, b in zip(stock, proba))}
+
+    results = pd.DataFrame.from_dict(results, orient = 'index')[
+        ['compile_seconds', 'predict_seconds', 'speedup', 'max_abs_diff']]
+    logging.info("scoring benchmark for {} rows:\n{}".format(
+        X.shape[0], results.to_string()))
+    return results
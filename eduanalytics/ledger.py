@@ -0,0 +1,106 @@
+import sqlalchemy
+import logging
+from eduanalytics import bulk_write
+
+def ledger_name(prediction_tbl):
+    """Names the ledger table kept alongside a prediction table.
+
+    Args:
+        prediction_tbl (str): the name of the table where predictions are
+            written, e.g. 'out$predictions$screening_current_cohort'
+    Returns:
+        str: the name of the ledger table, e.g.
+            'out$ledger$screening_current_cohort'
+    """
+    return "out$ledger${}".format(prediction_tbl.split('$')[-1])
+
+
+def ensure_ledger(engine, prediction_tbl):
+    """Creates the scoring ledger for a prediction table if it does not exist
+    yet, seeded with every (algorithm_id, aamc_id, application_year) already
+    in the prediction table.
+
+    The ledger only holds the keys, with a primary key on all three columns,
+    so finding the applicants an algorithm has not scored is an index lookup
+    per eligible applicant rather than a scan of the prediction history. The
+    lookup still visits every eligible applicant, not only the new ones:
+    applicant keys are not assigned in increasing order, so no watermark
+    separates the applicants already scored from the new ones. Drop the
+    ledger table to rebuild it from the prediction table (for instance after
+    deleting predictions).
+
+    Args:
+        engine (sqlalchemy.Engine): a connection to the MySQL database
+        prediction_tbl (str): the name of the table where predictions are
+            written
+    Returns:
+        str: the name of the ledger table
+    """
+    ledger_tbl = ledger_name(prediction_tbl)
+    with engine.begin() as conn:
+        if engine.dialect.has_table(conn, ledger_tbl):
+            return ledger_tbl
+        if engine.dialect.has_table(conn, prediction_tbl):
+            # copies the key column types of the prediction table
+            conn.execute(sqlalchemy.text("""create table `{ledger_tbl}`
+            (primary key (algorithm_id, aamc_id, application_year))
+            select distinct algorithm_id, aamc_id, application_year
+            from `{prediction_tbl}`""".format(
+                ledger_tbl = ledger_tbl,
+                prediction_tbl = prediction_tbl)))
+            logging.info("created {} from {}".format(ledger_tbl,
+                prediction_tbl))
+        else:
+            conn.execute(sqlalchemy.text("""create table `{ledger_tbl}` (
+            algorithm_id bigint not null,
+            aamc_id bigint not null,
+            application_year bigint not null,
+            primary key (algorithm_id, aamc_id, application_year))""".format(
+                ledger_tbl = ledger_tbl)))
+    return ledger_tbl
+
+
+def find_ledger(engine, prediction_tbl):
+    """Finds the scoring ledger of a prediction table, if it has one.
+
+    Args:
+        engine (sqlalchemy.Engine): a connection to the MySQL database
+        prediction_tbl (str): the name of the table where predictions are
+            written
+    Returns:
+        str: the name of the ledger table, or None if it does not exist
+    """
+    ledger_tbl = ledger_name(prediction_tbl)
+    with engine.connect() as conn:
+        if engine.dialect.has_table(conn, ledger_tbl):
+            return ledger_tbl
+    return None
+
+
+def record_scored(engine, results, ledger_tbl, batch_size = 1000):
+    """Adds the applicants in a set of written predictions to the ledger.
+    Pass the connection that writes the predictions, so the predictions and
+    their ledger entries are committed together.
+
+    Args:
+        engine (sqlalchemy.Engine or sqlalchemy.Connection): a connection to
+            the MySQL database, or a connection within the transaction that
+            writes the predictions
+        results (pandas.DataFrame): predictions with Multi-index of aamc id
+            and application year and an algorithm_id column
+        ledger_tbl (str): the name of the ledger table from ensure_ledger()
+        batch_size (int): number of keys in each insert statement
+    Returns:
+        int: the number of applicants recorded
+    """
+    keys = results.reset_index()[
+        ['algorithm_id', 'aamc_id', 'application_year']]
+    insert = sqlalchemy.table(ledger_tbl,
+        *[sqlalchemy.column(col) for col in keys.columns]
+        ).insert().prefix_with('IGNORE')
+    records = [dict(zip(keys.columns, row))
+        for row in keys.astype(object).values.tolist()]
+    with bulk_write.begin(engine) as conn:
+        for start in range(0, len(records), batch_size):
+            conn.execute(insert, records[start:start + batch_size])
+    return len(records)
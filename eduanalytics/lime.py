@@ -1,22 +1,62 @@
 import eduanalytics
-from eduanalytics import model_data, pipeline_tools, reporting
-from lime import lime_tabular
+from eduanalytics import model_data, pipeline_tools, reporting, bulk_write
 import pandas as pd
+import numpy as np
+import os, fnmatch, logging, multiprocessing, time
+import yaml
 from sklearn import preprocessing
-from collections import namedtuple
+from sklearn.externals import joblib
+from collections import namedtuple, OrderedDict
+
+ColInfo = namedtuple('ColInfo', ['colnames', 'mapping', 'index'])
+
+# the explainer and predict_fn of each explanation worker process
+_WORKER = {}
+
+# explainer artifacts loaded in this process, by path and modification time
+_EXPLAINER_CACHE = {}
 
 ## Read in model, model data, outcomes, and predictions
 
-def load_model_and_results(tbl_name,
+def load_model_and_results(alg_id, filename = None,
             cred_path = eduanalytics.credentials_path,
             cred_group = eduanalytics.credentials_group,
-    pkl_path = '/Volumes/IIME/EDS/data/admissions/pkls'):
-
+            pkl_path = eduanalytics.pkl_path,
+            tbl_name = 'screening_train_val'):
+    """Loads a trained model with its train and test predictions, and
+    optionally the model data it was trained on.
+
+    The model data is only needed to build a new explainer; explanations of
+    models saved with an explainer (see save_explainer) only need the model.
+
+    Args:
+        alg_id (str/int): the algorithm id of the model
+        filename (str): path to the model specification yaml file, to pull
+            the model data (skipped when None)
+        cred_path (str): path to the db credentials file
+        cred_group (str): name of group for db credentials file
+        pkl_path (str): the directory holding the model files
+        tbl_name (str): the table the train and test predictions were
+            written to, without the out$predictions$ prefix
+    Returns:
+        sklearn.GridSearchCV or sklearn.Pipeline: the fitted model
+        Pandas.DataFrame: the model data, or None
+        Pandas.DataFrame: the train and test predictions, with Multi-index of
+            aamc id and application year
+    """
     engine = model_data.connect_to_database(cred_path, cred_group)
-    results = model_data.get_data_for_modeling(engine,
-            tbl_name, status = 'predictions')
-    data = model_data.get_data_for_modeling(engine, tbl_name)
-    grid_search = reporting.load_model(pkl_path, tbl_name, 'rf_grid')
+    results_query = """select * from `out$predictions${tbl_name}`
+    where algorithm_id = {alg_id}""".format(tbl_name = tbl_name,
+        alg_id = int(alg_id))
+    results = pd.read_sql_query(results_query, engine,
+        index_col = ['aamc_id', 'application_year'])
+    data = None
+    if filename is not None:
+        # a read-only pull: the model is already in the algorithm table
+        with open(filename) as f:
+            model_opts = yaml.load(f)
+        data = model_data.pull_model_matrix(model_opts, engine)
+    grid_search, _ = reporting.load_model(pkl_path, alg_id)
     return grid_search, data, results
 
 
@@ -61,7 +101,6 @@ def get_categorical_and_numeric_dicts(data, encoder):
                     if col in numeric_cols}
     numeric_index = list(numeric_dict.keys())
 
-    ColInfo = namedtuple('ColInfo', ['colnames', 'mapping', 'index'])
     categorical = ColInfo(categorical_cols, categorical_dict, categorical_index)
     numeric = ColInfo(numeric_cols, numeric_dict, numeric_index)
 
@@ -95,45 +134,288 @@ def impute_numeric(data, numeric_dict, imputer, encoder):
 def encode_data(data, categorical_names):
     encoded_data = data.copy()
     le = preprocessing.LabelEncoder()
+    unseen_rows = np.zeros(data.shape[0], dtype = bool)
     for index, values in categorical_names.items():
         le.fit([str(v) for v in values])
-        col = data.iloc[:,index].astype(str)
-        encoded_data.iloc[:,index] = le.transform(col)
+        col = data.iloc[:,index].astype(object).map(str)
+        # categories not seen in training are encoded as missing, or their
+        # rows dropped if the column had no missing category
+        unseen = ~col.isin(le.classes_)
+        if unseen.any():
+            logging.warning("{} values of {} not seen in training: {}".format(
+                unseen.sum(), data.columns[index],
+                ", ".join(sorted(set(col[unseen]))[:10])))
+            if 'nan' in le.classes_:
+                col = col.where(~unseen, 'nan')
+            else:
+                unseen_rows |= unseen.values
+                col = col.where(~unseen, le.classes_[0])
+        # replace the whole column, which may be categorical
+        encoded_data[data.columns[index]] = le.transform(col)
+    if unseen_rows.any():
+        logging.warning("dropping {} rows with categories not seen in "
+            "training".format(unseen_rows.sum()))
+        encoded_data = encoded_data[~unseen_rows]
     return encoded_data.fillna(0)
 
 
-def transform_data(data, categorical_cols, colnames):
-    transformed_data = pd.DataFrame(data, columns = colnames)
-    dtypes = {col: 'category' if col in categorical_cols else 'float'
-              for col in colnames}
-    transformed_data = transformed_data.astype(dtypes)
-    encoder_new = pipeline_tools.DummyEncoder()
-    encoder_new.fit(transformed_data)
-    transformed_data = encoder_new.transform(transformed_data)
-    return transformed_data.as_matrix()
+def get_category_values(categorical):
+    """Maps the label codes of each categorical column (see encode_data) back
+    to the categories the model was trained on.
+
+    Args:
+        categorical (ColInfo): categorical column info, with the mapping
+            including the missing category (see add_missing_category)
+    Returns:
+        dict: raw column positions as keys, and numpy object arrays of the
+            category of each label code (NaN for 'nan') as values
+    """
+    category_values = {}
+    for index, categories in categorical.mapping.items():
+        by_name = {str(value): value for value in categories}
+        if 'nan' in by_name:
+            by_name['nan'] = np.nan
+        # LabelEncoder codes follow the sorted category names
+        category_values[index] = np.array(
+            [by_name[name] for name in sorted(by_name)], dtype = object)
+    return category_values
+
+
+def inverse_transform_data(data, colnames, category_values):
+    """Turns label encoded, imputed data (such as LIME's perturbation
+    samples) back into raw features that the fitted pipeline can score.
+
+    Args:
+        data (numpy.ndarray): label encoded data, n_rows x n_columns
+        colnames (list[str]): the raw column names
+        category_values (dict): label code mappings from get_category_values
+    Returns:
+        Pandas.DataFrame: the raw features
+    """
+    raw_data = pd.DataFrame(np.asarray(data, dtype = float),
+        columns = colnames)
+    for index, values in category_values.items():
+        col = colnames[index]
+        raw_data[col] = values[raw_data[col].values.astype(int)]
+    return raw_data
+
+
+def make_predict_fn(clf, categorical, colnames, compiled = True):
+    """Builds the predict_fn passed to LIME, scoring label encoded data with
+    the fitted pipeline.
+
+    Args:
+        clf (sklearn.GridSearchCV or sklearn.Pipeline): the fitted search or
+            its best pipeline
+        categorical (ColInfo): categorical column info from build_explainer
+        colnames (list[str]): the raw column names
+        compiled (bool): whether to encode with a CompiledPredictFn, or to
+            rebuild the raw features and run the whole pipeline
+    Returns:
+        callable: a function from label encoded data to class probabilities,
+            n_rows x n_classes
+    """
+    if compiled:
+        return CompiledPredictFn(clf, categorical, colnames)
+    category_values = get_category_values(categorical)
+    def predict_fn(data):
+        return _stack_proba(clf.predict_proba(inverse_transform_data(data,
+            colnames, category_values)))
+    return predict_fn
+
+
+def _stack_proba(proba):
+    if isinstance(proba, list):
+        # multiclass models predict each class separately
+        proba = np.column_stack([p[:, 1] for p in proba])
+    return proba
+
+
+class CompiledPredictFn(object):
+    """A LIME predict_fn that writes label encoded data straight into the
+    encoded matrix the steps after the encoder expect, without building
+    raw features or calling the encoder.
+
+    The label codes of each categorical column are looked up once in a table
+    from code to dummy column (built from the encoder's transformed_columns),
+    and the dummies of every categorical column are set with a single index
+    scatter. Numeric columns are copied to their encoded positions. The
+    output is the same as make_predict_fn(..., compiled = False).
+
+    Usage:
+        predict_fn = CompiledPredictFn(clf, categorical, colnames)
+        exp = explainer.explain_instance(row, predict_fn)
+
+    Args:
+        clf (sklearn.GridSearchCV or sklearn.Pipeline): the fitted search or
+            its best pipeline, with a DummyEncoder first
+        categorical (ColInfo): categorical column info from build_explainer
+        colnames (list[str]): the raw column names
+    """
+    def __init__(self, clf, categorical, colnames):
+        from sklearn.pipeline import Pipeline
+        steps = pipeline_tools.get_best_pipeline(clf).steps
+        transformed_columns = steps[0][1].transformed_columns
+        self.downstream = Pipeline(steps[1:])
+        self.n_encoded = len(transformed_columns)
+
+        category_values = get_category_values(categorical)
+        self.numeric_raw = np.array([index for index, col
+            in enumerate(colnames) if index not in category_values
+            and col in transformed_columns], dtype = int)
+        self.numeric_encoded = np.array([transformed_columns.get_loc(
+            colnames[index]) for index in self.numeric_raw], dtype = int)
+
+        # dummy column of each label code, -1 for categories not encoded
+        self.categorical_raw = np.array(sorted(category_values), dtype = int)
+        tables = []
+        for index in self.categorical_raw:
+            names = ['{}_{}'.format(colnames[index],
+                'nan' if pd.isnull(value) else value)
+                for value in category_values[index]]
+            tables.append([transformed_columns.get_loc(name)
+                if name in transformed_columns else -1 for name in names])
+        self.code_offsets = np.cumsum([0] + [len(table)
+            for table in tables])[:-1].astype(int)
+        self.code_columns = np.array([column for table in tables
+            for column in table], dtype = int)
+
+    def transform(self, data):
+        """Encodes label encoded data as the DummyEncoder would encode the
+        corresponding raw features.
+
+        Args:
+            data (numpy.ndarray): label encoded data, n_rows x n_columns
+        Returns:
+            numpy.ndarray: the encoded data, n_rows x len(transformed_columns)
+        """
+        data = np.atleast_2d(np.asarray(data, dtype = float))
+        encoded = np.zeros((data.shape[0], self.n_encoded))
+        encoded[:, self.numeric_encoded] = data[:, self.numeric_raw]
+        codes = data[:, self.categorical_raw].astype(int)
+        columns = self.code_columns[codes + self.code_offsets]
+        rows = np.broadcast_to(np.arange(data.shape[0])[:, np.newaxis],
+            columns.shape)
+        known = columns >= 0
+        encoded[rows[known], columns[known]] = 1
+        return encoded
+
+    def __call__(self, data):
+        return _stack_proba(self.downstream.predict_proba(
+            self.transform(data)))
+
+
+def benchmark_predict_fn(clf, categorical, colnames, data, n_repeats = 3):
+    """Times the pandas and compiled predict_fn on the same label encoded
+    data (such as a batch of LIME perturbation samples), and checks that the
+    probabilities agree.
+
+    Usage:
+        samples = np.tile(encoded_data.values[:1], (5000, 1))
+        benchmark_predict_fn(clf, categorical, list(encoded_data.columns),
+            samples)
+
+    Args:
+        clf (sklearn.GridSearchCV or sklearn.Pipeline): the fitted search or
+            its best pipeline
+        categorical (ColInfo): categorical column info from build_explainer
+        colnames (list[str]): the raw column names
+        data (numpy.ndarray): label encoded data
+        n_repeats (int): number of timed runs of each, the best is kept
+    Returns:
+        Pandas.DataFrame: for each predict_fn, the best time in seconds, the
+            speedup over the pandas path, and the largest absolute difference
+            from the pandas probabilities
+    """
+    results = OrderedDict()
+    for name, compiled in [('pandas', False), ('compiled', True)]:
+        predict_fn = make_predict_fn(clf, categorical, colnames,
+            compiled = compiled)
+        times = []
+        for _ in range(n_repeats):
+            start_time = time.time()
+            proba = predict_fn(data)
+            times.append(time.time() - start_time)
+        results[name] = {'seconds': min(times), 'proba': proba}
+
+    pandas_seconds, pandas_proba = results['pandas']['seconds'], \
+        results['pandas']['proba']
+    results = pd.DataFrame.from_dict(OrderedDict((name, {
+        'seconds': result['seconds'],
+        'speedup': pandas_seconds / max(result['seconds'], 1e-9),
+        'max_abs_diff': np.abs(result['proba'] - pandas_proba).max()})
+        for name, result in results.items()), orient = 'index')[
+        ['seconds', 'speedup', 'max_abs_diff']]
+    logging.info("predict_fn benchmark for {} rows:\n{}".format(
+        len(data), results.to_string()))
+    return results
 
 
 ### Running Lime
-def build_explainer(train, test, imputer, encoder, class_labels):
+def build_explainer_options(train, test, imputer, encoder, class_labels):
+    """Imputes and label encodes the data and collects the arguments of the
+    LIME explainer.
+
+    Args:
+        train (Pandas.DataFrame): raw training features
+        test (Pandas.DataFrame): raw features of the applicants to explain,
+            or None
+        imputer (sklearn.preprocessing.Imputer): the fitted imputer step
+        encoder (DummyEncoder): the fitted encoder step
+        class_labels (list[str]): the class names, as in lb.classes_
+    Returns:
+        Pandas.DataFrame: label encoded training and test data
+        dict: keyword arguments of lime_tabular.LimeTabularExplainer
+        ColInfo: categorical column info
+    """
     categorical, numeric = get_categorical_and_numeric_dicts(train, encoder)
     new_mapping = add_missing_category(train, encoder, categorical.mapping)
     categorical = categorical._replace(mapping = new_mapping)
 
     encoded_train = impute_encode(train, categorical, numeric,
                                     imputer, encoder)
-    encoded_test = impute_encode(test, categorical, numeric,
-                                    imputer, encoder)
-    encoded_data = encoded_train.append(encoded_test)
+    encoded_data = encoded_train
+    if test is not None:
+        encoded_test = impute_encode(test, categorical, numeric,
+                                        imputer, encoder)
+        encoded_data = encoded_train.append(encoded_test)
+
+    # names in label code order, as shown in the explanations
+    categorical_names = {index: [str(value) for value in values]
+        for index, values in get_category_values(categorical).items()}
+    options = {'training_data': encoded_train.values,
+        'feature_names': list(encoded_train.columns),
+        'class_names': list(class_labels),
+        'categorical_features': categorical.index,
+        'categorical_names': categorical_names,
+        'kernel_width': 3}
+    return encoded_data, options, categorical
+
+
+def make_explainer(options):
+    """Builds a LIME explainer from its options.
+
+    LIME defines the kernel and the discretizer's binning functions as
+    closures, so the explainer itself cannot be pickled. Save or send the
+    options instead (as save_explainer and explain_cohort do) and build the
+    explainer where it is used: the discretizer and the sampling statistics
+    are computed again from the same training data, so the rebuilt explainer
+    is the same.
+
+    Args:
+        options (dict): keyword arguments of
+            lime_tabular.LimeTabularExplainer, from build_explainer_options
+    Returns:
+        lime_tabular.LimeTabularExplainer: the explainer
+    """
+    from lime import lime_tabular
+    return lime_tabular.LimeTabularExplainer(**options)
 
-    explainer = lime_tabular.LimeTabularExplainer(
-        encoded_train.as_matrix(),
-        feature_names = list(encoded_train.columns),
-        class_names = class_labels,
-        categorical_features = categorical.index,
-        categorical_names = categorical.mapping,
-        kernel_width=3)
 
-    return encoded_data, explainer, categorical
+def build_explainer(train, test, imputer, encoder, class_labels):
+    encoded_data, options, categorical = build_explainer_options(
+        train, test, imputer, encoder, class_labels)
+    return encoded_data, make_explainer(options), categorical
 
 
 def impute_encode(dataset, categorical, numeric, imputer, encoder):
@@ -143,9 +425,227 @@ def impute_encode(dataset, categorical, numeric, imputer, encoder):
 
 
 def explain_instance(id, dataset, explainer,
-                     categorical, forest, n_features = 5):
+                     categorical, clf, n_features = 5):
     colnames = list(dataset.columns)
-    predict_fn = lambda X: forest.predict_proba(transform_data(X, categorical.colnames, colnames))
+    predict_fn = make_predict_fn(clf, categorical, colnames)
     row = dataset.loc[id,:]
     exp = explainer.explain_instance(row, predict_fn, num_features=n_features)
     exp.show_in_notebook(show_all=False)
+
+
+### Saving explainers with the models
+def explainer_filename(alg_id, model_tag):
+    # not matching id*_*.pkl, so the registry does not take it for a model
+    return "explainer_id{}_{}.pkl.z".format(alg_id, model_tag)
+
+
+def save_explainer(clf, X_train, label_encoder, pkl_path, alg_id, model_tag):
+    """Saves the LIME explainer options of a newly trained model (including
+    its encoded training data) next to the model, with everything needed to
+    label encode new applicants, so explanation sessions do not pull or
+    encode the training data again.
+
+    Args:
+        clf (sklearn.GridSearchCV or sklearn.Pipeline): the fitted search or
+            its best pipeline
+        X_train (Pandas.DataFrame): the raw training features
+        label_encoder (sklearn.LabelBinarizer): the label binarizer of the
+            model
+        pkl_path (str): name of the directory to store the pkl files
+        alg_id (str/int): the algorithm id of the model
+        model_tag (str): a short descriptor of the algorithm
+    Returns:
+        str: a message with the saved file name
+    """
+    encoder, imputer, _ = get_components_from_model(clf)
+    encoded_train, options, categorical = build_explainer_options(X_train,
+        None, imputer, encoder, label_encoder.classes_)
+    _, numeric = get_categorical_and_numeric_dicts(X_train, encoder)
+    artifact = {'options': options,
+        'categorical': categorical,
+        'numeric': numeric,
+        'colnames': list(encoded_train.columns)}
+
+    filename = explainer_filename(alg_id, model_tag)
+    joblib.dump(artifact, os.path.join(pkl_path, filename), compress = 3)
+    return "Written explainer to: {} in {}".format(filename, pkl_path)
+
+
+def load_explainer(pkl_path, alg_id):
+    """Loads the explainer saved with a model and builds it from its
+    options, keeping it in memory for later sessions in the same process.
+
+    Usage:
+        clf, lb = reporting.load_model(pkl_path, alg_id)
+        artifact = load_explainer(pkl_path, alg_id)
+        encoded_data = encode_for_explanation(current_data, artifact, clf)
+        explanations = explain_cohort(encoded_data, artifact['options'],
+            artifact['categorical'], clf, n_jobs = 8)
+
+    Args:
+        pkl_path (str): the directory holding the model files
+        alg_id (str/int): the algorithm id of the model
+    Returns:
+        dict: the explainer ('explainer') and its options ('options'),
+            categorical and numeric column info ('categorical', 'numeric')
+            and raw column names ('colnames')
+    """
+    filenames = fnmatch.filter(os.listdir(pkl_path),
+        explainer_filename(alg_id, '*'))
+    if not filenames:
+        raise IOError("no explainer for algorithm id {} in {}, refit with "
+            "--explainer or use build_explainer".format(alg_id, pkl_path))
+    path = os.path.join(pkl_path, filenames[0])
+    key = (os.path.abspath(path), os.path.getmtime(path))
+    if key not in _EXPLAINER_CACHE:
+        logging.info("loading explainer {}".format(filenames[0]))
+        artifact = joblib.load(path)
+        artifact['explainer'] = make_explainer(artifact['options'])
+        _EXPLAINER_CACHE[key] = artifact
+    return _EXPLAINER_CACHE[key]
+
+
+def encode_for_explanation(data, artifact, clf):
+    """Imputes and label encodes applicants with a saved explainer's
+    mappings, as build_explainer_options encodes them.
+
+    Args:
+        data (Pandas.DataFrame): raw features with Multi-index of aamc id and
+            application year, with the columns the model was trained on
+        artifact (dict): the saved explainer from load_explainer
+        clf (sklearn.GridSearchCV or sklearn.Pipeline): the fitted search or
+            its best pipeline
+    Returns:
+        Pandas.DataFrame: label encoded data for explain_cohort, with
+            categories not seen in training encoded as missing
+    """
+    encoder, imputer, _ = get_components_from_model(clf)
+    return impute_encode(data[artifact['colnames']], artifact['categorical'],
+        artifact['numeric'], imputer, encoder)
+
+
+### Explaining whole cohorts
+def _init_worker(explainer, clf, categorical, colnames):
+    """Sets up the explainer and predict_fn once per worker process."""
+    _WORKER['explainer'] = make_explainer(explainer) \
+        if isinstance(explainer, dict) else explainer
+    _WORKER['predict_fn'] = make_predict_fn(clf, categorical, colnames)
+    _WORKER['colnames'] = colnames
+
+
+def _explain_rows(keys, rows, seeds, labels, n_features, n_samples):
+    """Explains a chunk of applicants in a worker, returning the top
+    features of each as records."""
+    explainer, predict_fn = _WORKER['explainer'], _WORKER['predict_fn']
+    colnames = _WORKER['colnames']
+    records = []
+    for key, row, seed in zip(keys, rows, seeds):
+        # seeded per applicant, so results do not depend on the chunking
+        # (older versions of LIME sample from the global random state)
+        np.random.seed(seed)
+        random_state = np.random.RandomState(seed)
+        for component in [explainer, getattr(explainer, 'base', None),
+                getattr(explainer, 'discretizer', None)]:
+            if component is not None:
+                component.random_state = random_state
+        exp = explainer.explain_instance(row, predict_fn, labels = labels,
+            num_features = n_features, num_samples = n_samples)
+        for label in labels:
+            for rank, ((feature_index, weight), (condition, _)) in enumerate(
+                    zip(exp.as_map()[label], exp.as_list(label = label))):
+                records.append(tuple(key) + (exp.class_names[label],
+                    rank + 1, colnames[feature_index], condition, weight))
+    return records
+
+
+def explain_cohort(encoded_data, explainer, categorical, clf, keys = None,
+        n_features = 5, n_samples = 5000, n_jobs = 1, chunk_size = 100,
+        random_state = 1100):
+    """Explains the predictions for many applicants, spreading them over a
+    pool of processes that each set up the explainer once.
+
+    Usage:
+        encoded_data, options, categorical = build_explainer_options(
+            train.X, current_data, imputer, encoder, lb.classes_)
+        explanations = explain_cohort(encoded_data, options, categorical,
+            clf, keys = list(current_data.index), n_jobs = 8)
+
+    Args:
+        encoded_data (Pandas.DataFrame): label encoded data with Multi-index
+            of aamc id and application year, from build_explainer_options
+            or encode_for_explanation
+        explainer (lime_tabular.LimeTabularExplainer or dict): the explainer
+            options from build_explainer_options or load_explainer, or
+            (with n_jobs = 1 only, as explainers cannot be pickled) an
+            explainer from make_explainer
+        categorical (ColInfo): categorical column info from
+            build_explainer_options
+        clf (sklearn.GridSearchCV or sklearn.Pipeline): the fitted search or
+            its best pipeline
+        keys (list[tuple]): the (aamc_id, application_year) of the applicants
+            to explain, all of encoded_data by default
+        n_features (int): number of features kept per explanation
+        n_samples (int): number of perturbation samples per explanation
+        n_jobs (int): number of processes
+        chunk_size (int): number of applicants sent to a process at a time
+        random_state (int): seed for the perturbation samples
+    Returns:
+        Pandas.DataFrame: one row per applicant, class and feature rank with
+            the aamc_id, application_year, class_name, rank, feature (the
+            raw column), condition (as shown by LIME) and weight
+    """
+    rows = encoded_data if keys is None else encoded_data.loc[keys]
+    keys, rows = list(rows.index), rows.values
+    colnames = list(encoded_data.columns)
+    class_names = explainer['class_names'] if isinstance(explainer, dict) \
+        else explainer.class_names
+    n_classes = len(class_names)
+    labels = list(range(n_classes)) if n_classes > 2 else [1]
+    seeds = np.random.RandomState(random_state).randint(
+        np.iinfo(np.int32).max, size = len(keys))
+    chunks = [(keys[start:start + chunk_size], rows[start:start + chunk_size],
+        seeds[start:start + chunk_size], labels, n_features, n_samples)
+        for start in range(0, len(keys), chunk_size)]
+
+    if n_jobs != 1 and not isinstance(explainer, dict):
+        raise ValueError("pass the explainer options rather than the "
+            "explainer to explain with n_jobs = {}".format(n_jobs))
+    initargs = (explainer, clf, categorical, colnames)
+    if n_jobs == 1:
+        _init_worker(*initargs)
+        results = [_explain_rows(*chunk) for chunk in chunks]
+    else:
+        pool = multiprocessing.Pool(n_jobs, initializer = _init_worker,
+            initargs = initargs)
+        try:
+            results = pool.starmap(_explain_rows, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    logging.info("explained {} applicants".format(len(keys)))
+
+    return pd.DataFrame([record for chunk in results for record in chunk],
+        columns = list(encoded_data.index.names) + ['class_name', 'rank',
+            'feature', 'condition', 'weight'])
+
+
+def write_explanations(explanations, conn, alg_id,
+        tbl_name = 'screening_current_cohort', write_method = 'insert',
+        batch_size = 1000):
+    """Appends a cohort's explanations to the explanations table.
+
+    Args:
+        explanations (Pandas.DataFrame): the output of explain_cohort
+        conn (sqlalchemy.Engine): a connection to the MySQL database
+        alg_id (str/int): the algorithm id of the explained model
+        tbl_name (str): a name for the database table holding explanations
+        write_method (str): 'insert' or 'infile' (see bulk_write.write_frame)
+        batch_size (int): number of rows in each insert statement
+    Returns:
+        str: the name of the table in the database
+    """
+    name = "out$explanations${}".format(tbl_name)
+    explanations = explanations.assign(algorithm_id = alg_id)
+    bulk_write.write_frame(explanations, name, conn, method = write_method,
+        batch_size = batch_size, index = False)
+    return "Added to database {}: algorithm_id = {}".format(name, alg_id)
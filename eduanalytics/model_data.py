@@ -1,13 +1,15 @@
 import configparser
 import sqlalchemy
 import pandas as pd
-import string, os, re, logging
+import string, os, re, logging, time, uuid, numbers
 import yaml, json, itertools
-from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import LabelBinarizer
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from eduanalytics import feature_cache, schema
 
 def connect_to_database(credentials_path, group,
-        filename = '.my.cnf'):
+        filename = '.my.cnf', pool_size = 5, local_infile = False):
     """Read in a database credentials text file and return an engine
     connecting to the MySQL database.
 
@@ -15,6 +17,10 @@ def connect_to_database(credentials_path, group,
         credentials_path (str): path to the database credentials file
         group (str): name of the group containing the desired credentials
         filename (str): filename (without path) of the credentials file
+        pool_size (int): number of connections kept open in the engine's pool,
+            should be at least the number of concurrent queries
+        local_infile (bool): whether to allow LOAD DATA LOCAL INFILE, needed
+            for the 'infile' bulk write method
     Returns:
         sqlalchemy.Engine: a connection to the MySQL database
     """
@@ -27,12 +33,15 @@ def connect_to_database(credentials_path, group,
         port = reader.get(group, 'port'),
         dbname = reader.get(group, 'database'))
 
-    engine = sqlalchemy.create_engine(connection_string)
+    engine = sqlalchemy.create_engine(connection_string,
+        pool_size = pool_size,
+        connect_args = {'local_infile': True} if local_infile else {})
     return engine
 
 
 def convert_categorical(data):
-    """Converts binary and string columns to Pandas Categoricals.
+    """Converts binary and string columns to Pandas Categoricals. Columns that
+    are already categorical (as read with compact dtypes) are not checked.
 
     Args:
         data (Pandas.DataFrame): a dataframe containing some binary
@@ -40,9 +49,10 @@ def convert_categorical(data):
     Returns:
         Pandas.DataFrame: dataframe with mix of categoricals and numeric cols
     """
-    binary_cols = set(col for col in data if (
-        data[col].nunique() == 2 and not re.search('_[ABCDF]$', col)))
-    string_cols = set(col for col in data if data[col].dtype == 'O')
+    unchecked = [col for col in data if data[col].dtype.name != 'category']
+    string_cols = set(col for col in unchecked if data[col].dtype == 'O')
+    binary_cols = set(col for col in unchecked if col not in string_cols
+        and data[col].nunique() == 2 and not re.search('_[ABCDF]$', col))
     categoricals = binary_cols.union(string_cols)
     data_categorical = data.astype({col: 'category' for col in categoricals})
     return data_categorical
@@ -66,44 +76,248 @@ def describe_model(filename, engine):
     algorithm_name = model_opts['algorithm_name']
     algorithm_description = json.dumps(model_opts)
 
-    feature_tbls = {"'vw$features${}'".format(tbl_name): cols_to_drop
+    feature_columns = get_feature_columns(engine, model_opts['features'])
+    column_names = set(itertools.chain(*feature_columns.values()))
+
+    algorithm_details = json.dumps(list(column_names))
+
+    x = pd.DataFrame({'algorithm_name': [algorithm_name],
+            'algorithm_description': [algorithm_description],
+            'algorithm_details': [algorithm_details]})
+    # last_insert_id is per connection, so concurrent pulls (see
+    # run_and_save_model.schedule_training) each get their own id
+    with engine.begin() as conn:
+        x.to_sql('algorithm', conn, index = False, if_exists = 'append')
+        algorithm_id = pd.read_sql_query('select last_insert_id()',
+            conn).iloc[0,0]
+    return model_opts, algorithm_id
+
+
+def get_feature_columns(engine, features_dict):
+    """Looks up the columns of each feature table in the information schema,
+    leaving out the key columns and any columns excluded in the yaml file.
+
+    Args:
+        engine (sqlalchemy.Engine): a connection to the MySQL database
+        features_dict (dict(list[str])): a dictionary where the keys are the
+            names of the feature tables and the values are lists of names of
+            columns that should be excluded for each table
+    Returns:
+        OrderedDict(list[str]): full feature table names as keys, in the order
+            of the features dictionary, and the included column names for each
+            table in their table order as values
+    """
+    feature_tbls = OrderedDict(("vw$features${}".format(tbl_name), cols_to_drop)
         for tbl_name, cols_to_drop
-        in model_opts['features'].items()}
+        in features_dict.items())
 
-    column_query = """select column_name
+    column_query = """select table_name, column_name
     from information_schema.columns
     where table_name in ({feature_string})
-    and column_name not in ('aamc_id', 'application_year');""".format(
-        feature_string = ", ".join(feature_tbls.keys()))
+    and column_name not in ('aamc_id', 'application_year')
+    order by ordinal_position;""".format(
+        feature_string = ", ".join(
+            "'{}'".format(tbl) for tbl in feature_tbls.keys()))
 
     column_names = pd.read_sql_query(column_query, engine)
-    column_names = set(column_names.column_name)
-    drop_cols = set(itertools.chain(*feature_tbls.values()))
 
-    if drop_cols:
-        column_names = column_names - drop_cols
+    feature_columns = OrderedDict()
+    for feature_tbl, drop_cols in feature_tbls.items():
+        tbl_columns = column_names.column_name[
+            column_names.table_name == feature_tbl]
+        feature_columns[feature_tbl] = [col for col in tbl_columns
+            if col not in set(drop_cols or [])]
+    return feature_columns
 
-    algorithm_details = json.dumps(list(column_names))
 
-    x = pd.DataFrame({'algorithm_name': [algorithm_name],
-            'algorithm_description': [algorithm_description],
-            'algorithm_details': [algorithm_details]})
-    x.to_sql('algorithm', engine, index = False, if_exists = 'append')
+def build_feature_query(feature_columns, subquery, first_required = False,
+        key_tbl = None):
+    """Builds a single query selecting only the included feature columns from
+    every feature table, joined to the applicants returned by the subquery.
 
-    algorithm_id = pd.read_sql_query('select max(id) from algorithm',
-        engine).iloc[0,0]
-    return model_opts, algorithm_id
+    Args:
+        feature_columns (OrderedDict(list[str])): full feature table names and
+            their included columns, as returned by get_feature_columns()
+        subquery (str): a string containing the subquery giving the aamc_id and
+            application_year of the applicants of interest
+        first_required (bool): whether to keep only applicants present in the
+            first feature table (as when joining the other tables onto it)
+        key_tbl (str): optional name of a table holding the materialized keys
+            of the subquery, joined in place of the subquery
+    Returns:
+        str: a query returning one row per applicant with the key columns and
+            all included features
+    """
+    select_cols = ["k.aamc_id", "k.application_year"]
+    joins = list()
+    for index, (feature_tbl, cols) in enumerate(feature_columns.items()):
+        alias = "f{}".format(index)
+        select_cols.extend("{alias}.`{col}`".format(alias = alias, col = col)
+            for col in cols)
+        joins.append("""{join} `{feature_tbl}` {alias}
+        on {alias}.aamc_id = k.aamc_id
+        and {alias}.application_year = k.application_year""".format(
+            join = "join" if first_required and index == 0 else "left join",
+            feature_tbl = feature_tbl,
+            alias = alias))
+
+    get_features = """select {select_cols}
+    from {keys} k
+    {joins}""".format(
+        select_cols = ",\n    ".join(select_cols),
+        keys = "`{}`".format(key_tbl) if key_tbl else "({})".format(subquery),
+        joins = "\n    ".join(joins))
+    return get_features
+
+
+def pull_features_single_query(engine, features_dict, subquery,
+        first_required = False, key_tbl = None, compact = False,
+        dtype_overrides = None, memory = None):
+    """Pulls all included features for the applicants returned by the subquery
+    in one result set, so excluded columns never leave the database server.
+
+    Args:
+        engine (sqlalchemy.Engine): a connection to the mySQL database
+        features_dict (dict(list[str])): a dictionary where the keys are the
+            names of the feature tables and the values are lists of names of
+            columns that should be excluded for each table
+        subquery (str): a string containing the subquery giving the aamc_id and
+            application_year of the applicants of interest
+        first_required (bool): whether to keep only applicants present in the
+            first feature table
+        key_tbl (str): optional name of a table holding the materialized keys
+            of the subquery
+        compact (bool): whether to read the features with the compact dtypes
+            resolved from their declared types (see schema.resolve_dtypes)
+        dtype_overrides (dict): column names or patterns and the dtypes that
+            take precedence over the resolved ones
+        memory (dict): optional dictionary to be filled with the bytes of
+            each column as read and as cast, for compact reads
+    Returns:
+        pandas.DataFrame: all the included features with Multi-index of
+            aamc id and application year
+    """
+    feature_columns = get_feature_columns(engine, features_dict)
+    get_features = build_feature_query(feature_columns, subquery,
+        first_required = first_required, key_tbl = key_tbl)
+    if not compact:
+        return pd.read_sql_query(get_features, engine,
+            index_col = ['aamc_id', 'application_year'])
 
+    # every table but a required first one is left joined, so may be null
+    feature_tbls = list(feature_columns)
+    dtypes = schema.resolve_dtypes(
+        schema.get_column_types(engine, feature_tbls), dtype_overrides,
+        nullable_tables = feature_tbls[1:] if first_required
+            else feature_tbls)
+    feature_data = schema.read_sql_compact(get_features, engine, dtypes,
+        index_col = ['aamc_id', 'application_year'], memory = memory)
+    return feature_data
 
-def get_data_for_modeling(filename, engine):
+
+def build_cohort_query(model_opts, fit_or_predict):
+    """Builds the subquery giving the aamc_id and application_year of the
+    applicants in the cohort specified by the model options.
+
+    Args:
+        model_opts (dict): the model options from the model specification file
+        fit_or_predict (str): 'fit' for the historical cohort or 'predict'
+            for the current cohort
+    Returns:
+        str: the cohort subquery
+    """
+    cohort_vals = model_opts['cohorts']['included']
+    get_cohort = """select aamc_id, application_year
+        from `vw$cohorts${cohort_tbl}`
+        where {cohort_col} in ({cohort_vals})
+        and fit_or_predict = '{fit_or_predict}'""".format(
+            cohort_tbl = model_opts['cohorts']['tbl'],
+            cohort_col = model_opts['cohorts']['col'],
+            cohort_vals = ",".join(["'{}'".format(i) for i in cohort_vals]),
+            fit_or_predict = fit_or_predict)
+    return get_cohort
+
+
+def build_current_applicants_query(model_opts, algorithm_id,
+        prediction_tbl = "out$predictions$screening_current_cohort",
+        ledger_tbl = None):
+    """Builds the subquery giving the aamc_id and application_year of the
+    eligible applicants in the current cohort who do not yet have a prediction
+    for the algorithm id.
+
+    Args:
+        model_opts (dict): the model options from the model specification file
+        algorithm_id (int): the algorithm id used to generate predictions
+        prediction_tbl (str): the name of the table where previous predictions
+            have been written
+        ledger_tbl (str): optional name of the scoring ledger for the
+            prediction table (see ledger.ensure_ledger), anti-joined on its
+            primary key in place of the prediction table
+    Returns:
+        str: the subquery for applicants still to be scored
+    """
+    if ledger_tbl:
+        return """select e.aamc_id, e.application_year
+        from `vw$filtered${eligible_tbl}` e
+        left join `{ledger_tbl}` l
+        on l.algorithm_id = {alg_id}
+        and l.aamc_id = e.aamc_id
+        and l.application_year = e.application_year
+        where l.aamc_id is null
+        and (e.aamc_id, e.application_year) in
+        ({cohort_query})""".format(
+            eligible_tbl = model_opts['predictions'],
+            alg_id = algorithm_id,
+            ledger_tbl = ledger_tbl,
+            cohort_query = build_cohort_query(model_opts, 'predict'))
+
+    current_applicants_query = """select aamc_id, application_year
+        from `vw$filtered${eligible_tbl}`
+        where (aamc_id, application_year, {alg_id}) not in
+        (select aamc_id, application_year, algorithm_id
+        from `{prediction_tbl}`)
+        and (aamc_id, application_year) in
+        ({cohort_query})""".format(
+            eligible_tbl = model_opts['predictions'],
+            alg_id = algorithm_id,
+            prediction_tbl = prediction_tbl,
+            cohort_query = build_cohort_query(model_opts, 'predict'))
+    return current_applicants_query
+
+
+def build_keys_query(keys):
+    """Builds a subquery returning a literal list of applicant keys, to pull
+    features for a fixed batch of applicants.
+
+    Args:
+        keys (list[tuple]): (aamc_id, application_year) pairs
+    Returns:
+        str: a subquery giving the aamc_id and application_year of each key
+    """
+    quote = lambda value: str(value) if isinstance(value, numbers.Integral) \
+        else "'{}'".format(str(value).replace("'", "''"))
+    rows = ["select {} as aamc_id, {} as application_year".format(
+        quote(aamc_id), quote(application_year))
+        for aamc_id, application_year in keys]
+    return "\n    union all ".join(rows)
+
+
+def get_data_for_modeling(filename, engine, cache_dir = None, n_jobs = 1,
+        single_query = False, materialize = False, shared_features = None,
+        compact = False, dtype_overrides = None, memory = None):
     """Return a dataframe containing features specified by the yaml file for
     records meeting the cohort criteria specified in the yaml file.
     Includes the true outcome label from the database.
 
+    The model is added to the algorithm table (see describe_model); use
+    pull_model_matrix to pull the data of an existing model.
+
     Args:
         filename (str): path to YAML file with cohort, outcome, and
             feature specification for desired model data
         engine (sqlalchemy.Engine): a connection to the MySQL database
+        cache_dir, n_jobs, single_query, materialize, shared_features,
+            compact, dtype_overrides, memory: see pull_model_matrix
     Returns:
         Pandas.DataFrame: dataframe with Multi-index of aamc id and application year
             for applicants with known outcomes and qualifying cohort variables
@@ -111,38 +325,110 @@ def get_data_for_modeling(filename, engine):
         str: the algorithm name for the model specified by the file
     """
     model_opts, algorithm_id = describe_model(filename, engine)
+    model_data = pull_model_matrix(model_opts, engine, cache_dir = cache_dir,
+        n_jobs = n_jobs, single_query = single_query,
+        materialize = materialize, shared_features = shared_features,
+        compact = compact, dtype_overrides = dtype_overrides,
+        memory = memory)
+    return model_data, algorithm_id, model_opts['algorithm_name']
 
-    cohort_vals = model_opts['cohorts']['included']
-    get_cohort = """select aamc_id, application_year
-        from `vw$cohorts${cohort_tbl}`
-        where {cohort_col} in ({cohort_vals})
-        and fit_or_predict = 'fit'""".format(
-            cohort_tbl = model_opts['cohorts']['tbl'],
-            cohort_col = model_opts['cohorts']['col'],
-            cohort_vals = ",".join(["'{}'".format(i) for i in cohort_vals]))
 
-    get_outcomes = """select *
-        from `vw$outcomes${outcome_tbl}`
-        where (aamc_id, application_year) in
-        ({cohort_query})""".format(
-            outcome_tbl = model_opts['outcomes'],
-            cohort_query = get_cohort)
+def pull_model_matrix(model_opts, engine, cache_dir = None, n_jobs = 1,
+        single_query = False, materialize = False, shared_features = None,
+        compact = False, dtype_overrides = None, memory = None):
+    """Pulls the outcomes and features of the historical cohort of a model
+    spec, without adding the model to the algorithm table.
 
-    outcome_data = pd.read_sql_query(get_outcomes, engine,
-        index_col = ['aamc_id', 'application_year'])
+    Args:
+        model_opts (dict): the model options read from the model
+            specification file
+        engine (sqlalchemy.Engine): a connection to the MySQL database
+        cache_dir (str): optional path to a local directory caching the
+            feature tables for the historical cohort between runs
+        n_jobs (int): number of feature tables to pull concurrently
+        single_query (bool): whether to pull all feature tables in one query
+            selecting only the included columns (bypasses the cache)
+        materialize (bool): whether to materialize the cohort keys once into
+            an indexed temporary table that every query joins against (the
+            feature tables are then pulled serially on its connection)
+        shared_features (OrderedDict): feature tables already pulled for
+            several specs by pull_shared_features, used in place of pulling
+            the features again (only the outcomes are queried)
+        compact (bool): whether to read the features with the compact dtypes
+            resolved from their declared types (see schema.resolve_dtypes):
+            string columns as categoricals, and integers and floats in the
+            smallest dtype that holds them
+        dtype_overrides (dict): column names or patterns and the dtypes that
+            take precedence over the resolved ones (see schema.read_overrides)
+        memory (dict): optional dictionary to be filled with the bytes of
+            each feature column as read and as cast, for compact pulls (see
+            schema.savings_report)
+    Returns:
+        Pandas.DataFrame: dataframe with Multi-index of aamc id and application year
+            for applicants with known outcomes and qualifying cohort variables
+    """
+    get_cohort = build_cohort_query(model_opts, 'fit')
+    if compact and memory is None:
+        memory = dict()
+
+    with materialized_keys(engine, get_cohort,
+            materialize and shared_features is None) as (key_tbl, conn):
+        get_outcomes = select_for_keys(
+            "vw$outcomes${}".format(model_opts['outcomes']),
+            subquery = get_cohort, key_tbl = key_tbl)
+
+        outcome_data = pd.read_sql_query(get_outcomes, conn,
+            index_col = ['aamc_id', 'application_year'])
 
-    features = loop_through_features(engine, model_opts['features'],
-        subquery = get_cohort)
+        if shared_features is not None:
+            # the left join below keeps only the rows of this cohort
+            features = select_spec_features(shared_features,
+                model_opts['features'])
+        elif single_query:
+            features = pull_features_single_query(conn,
+                model_opts['features'], subquery = get_cohort,
+                key_tbl = key_tbl, compact = compact,
+                dtype_overrides = dtype_overrides, memory = memory)
+        else:
+            features = loop_through_features(conn, model_opts['features'],
+                subquery = get_cohort, cache_dir = cache_dir, n_jobs = n_jobs,
+                key_tbl = key_tbl, compact = compact,
+                dtype_overrides = dtype_overrides, memory = memory)
 
     model_data = outcome_data.join(features)
+    if compact:
+        model_data = restore_dtypes(model_data, features)
+        schema.log_savings(memory, model_opts['algorithm_name'])
     model_data = convert_categorical(model_data)
     logging.info("pulled training/validation data for {n} applicants in {ncol} features".format(
         n = model_data.shape[0], ncol = model_data.shape[1] - 1))
-    return model_data, algorithm_id, model_opts['algorithm_name']
+    return model_data
+
+
+def restore_dtypes(data, features):
+    """Casts joined feature columns back to the compact dtypes they were
+    pulled with, as the integers of a feature table missing some of the
+    applicants turn to float64 in the join.
+
+    Args:
+        data (Pandas.DataFrame): the joined data
+        features (list(Pandas.DataFrame) or Pandas.DataFrame): the feature
+            tables as pulled
+    Returns:
+        Pandas.DataFrame: the joined data with the pulled dtypes
+    """
+    feature_dtypes = dict((col, feature_data[col].dtype.name)
+        for feature_data in (features if isinstance(features, list)
+            else [features])
+        for col in feature_data)
+    return schema.apply_dtypes(data, feature_dtypes)
 
 
 def get_data_for_prediction(filename, engine, algorithm_id,
-        prediction_tbl = "out$predictions$screening_current_cohort"):
+        prediction_tbl = "out$predictions$screening_current_cohort",
+        n_jobs = 1, single_query = False, materialize = False,
+        shared_features = None, ledger_tbl = None, compact = False,
+        dtype_overrides = None):
     """Return a dataframe for the desired data for members of the current data
     for whom predictions have not already been generated containing the features
     specified in the model yaml file.
@@ -155,6 +441,21 @@ def get_data_for_prediction(filename, engine, algorithm_id,
             and used to generate predictions
         prediction_tbl (str): the name of the table where previous predictions
             have been written
+        n_jobs (int): number of feature tables to pull concurrently
+        single_query (bool): whether to pull all feature tables in one query
+            selecting only the included columns
+        materialize (bool): whether to materialize the keys of the applicants
+            still to be scored once into an indexed temporary table that every
+            query joins against (pulled serially on its connection)
+        shared_features (OrderedDict): feature tables already pulled for
+            several specs by pull_shared_features, from which the rows of the
+            applicants still to be scored are selected
+        ledger_tbl (str): optional name of the scoring ledger used to find the
+            applicants still to be scored (see ledger.ensure_ledger)
+        compact (bool): whether to read the features with the compact dtypes
+            they are read with for training (see pull_model_matrix)
+        dtype_overrides (dict): column names or patterns and the dtypes that
+            take precedence over the resolved ones
     Returns:
         Pandas.DataFrame: dataframe with Multi-index (aamc id, application year)
             for applicants with known outcomes and qualifying cohort variables
@@ -162,42 +463,229 @@ def get_data_for_prediction(filename, engine, algorithm_id,
     with open(filename) as f:
         model_opts = yaml.load(f)
 
-    cohort_vals = model_opts['cohorts']['included']
-    get_cohort = """select aamc_id, application_year
-        from `vw$cohorts${cohort_tbl}`
-        where {cohort_col} in ({cohort_vals})
-        and fit_or_predict = 'predict'""".format(
-            cohort_tbl = model_opts['cohorts']['tbl'],
-            cohort_col = model_opts['cohorts']['col'],
-            cohort_vals = ",".join(["'{}'".format(i) for i in cohort_vals]))
+    current_applicants_query = build_current_applicants_query(model_opts,
+        algorithm_id, prediction_tbl, ledger_tbl)
+    if shared_features is not None:
+        keys = pd.read_sql_query(current_applicants_query, engine,
+            index_col = ['aamc_id', 'application_year']).index
+        if len(keys) == 0:
+            return pd.DataFrame()
+        features = select_spec_features(shared_features,
+            model_opts['features'])
+        current_data = features[0][features[0].index.isin(keys)].join(
+            features[1:])
+        if compact:
+            current_data = restore_dtypes(current_data, features)
+        logging.info(
+            "selected new testing data for {n} applicants in {ncol} features".format(
+            n = current_data.shape[0], ncol = current_data.shape[1]))
+        return current_data
+
+    with materialized_keys(engine, current_applicants_query,
+            materialize) as (key_tbl, conn):
+        if key_tbl:
+            n_applicants = pd.read_sql_query(
+                "select count(*) from `{}`".format(key_tbl), conn).iloc[0,0]
+        else:
+            n_applicants = pd.read_sql_query(
+                current_applicants_query, conn).shape[0]
+        if n_applicants == 0:
+            return pd.DataFrame()
+
+        if single_query:
+            current_data = pull_features_single_query(conn,
+                model_opts['features'], subquery = current_applicants_query,
+                first_required = True, key_tbl = key_tbl, compact = compact,
+                dtype_overrides = dtype_overrides)
+        else:
+            features = loop_through_features(conn, model_opts['features'],
+                subquery = current_applicants_query, n_jobs = n_jobs,
+                key_tbl = key_tbl, compact = compact,
+                dtype_overrides = dtype_overrides)
+            current_data = features[0].join(features[1:])
+            if compact:
+                current_data = restore_dtypes(current_data, features)
+    logging.info(
+        "pulled new testing data for {n} applicants in {ncol} features".format(
+        n = current_data.shape[0], ncol = current_data.shape[1]))
+    return current_data
 
-    current_applicants_query = """select aamc_id, application_year
-        from `vw$filtered${eligible_tbl}`
-        where (aamc_id, application_year, {alg_id}) not in
-        (select aamc_id, application_year, algorithm_id
-        from `{prediction_tbl}`)
-        and (aamc_id, application_year) in
-        ({cohort_query})""".format(
-            eligible_tbl = model_opts['predictions'],
-            alg_id = algorithm_id,
-            prediction_tbl = prediction_tbl,
-            cohort_query = get_cohort)
-    n_applicants = pd.read_sql_query(
-        current_applicants_query, engine).shape[0]
-    if n_applicants == 0:
-        return pd.DataFrame()
 
-    features = loop_through_features(engine, model_opts['features'],
-        subquery = current_applicants_query)
+def get_data_for_keys(engine, features_dict, keys, n_jobs = 1,
+        single_query = False, compact = False, dtype_overrides = None):
+    """Return a dataframe containing the features specified in the features
+    dictionary for a fixed batch of applicants, joined as in
+    get_data_for_prediction.
 
+    Args:
+        engine (sqlalchemy.Engine): a connection to the MySQL database
+        features_dict (dict(list[str])): a dictionary where the keys are the
+            names of the feature tables and the values are lists of names of
+            columns that should be excluded for each table
+        keys (list[tuple]): (aamc_id, application_year) pairs
+        n_jobs (int): number of feature tables to pull concurrently
+        single_query (bool): whether to pull all feature tables in one query
+        compact, dtype_overrides: see get_data_for_prediction
+    Returns:
+        Pandas.DataFrame: dataframe with Multi-index (aamc id, application year)
+    """
+    keys_query = build_keys_query(keys)
+    if single_query:
+        return pull_features_single_query(engine, features_dict,
+            subquery = keys_query, first_required = True, compact = compact,
+            dtype_overrides = dtype_overrides)
+    features = loop_through_features(engine, features_dict,
+        subquery = keys_query, n_jobs = n_jobs, compact = compact,
+        dtype_overrides = dtype_overrides)
     current_data = features[0].join(features[1:])
-    logging.info(
-        "pulled new testing data for {n} applicants in {ncol} features".format(
-        n = current_data.shape[0], ncol = current_data.shape[1]))
+    if compact:
+        current_data = restore_dtypes(current_data, features)
     return current_data
 
 
-def loop_through_features(engine, features_dict, subquery):
+def plan_shared_pull(model_opts_list, subqueries):
+    """Plans a single pull of every feature table used by several model specs.
+
+    Each table is pulled once for the union of the specs' applicants, keeping
+    every column that at least one of the specs using the table includes.
+
+    Args:
+        model_opts_list (list[dict]): the model options of each spec
+        subqueries (list[str]): the subquery giving the aamc_id and
+            application_year of the applicants of interest for each spec
+    Returns:
+        OrderedDict(list[str]): a features dictionary with the union of the
+            tables and the columns excluded by all of the specs using each
+        str: a subquery giving the union of the applicants of every spec
+    """
+    features_dict = OrderedDict()
+    for model_opts in model_opts_list:
+        for tbl_name, cols_to_drop in model_opts['features'].items():
+            cols_to_drop = set(cols_to_drop or [])
+            features_dict[tbl_name] = features_dict[tbl_name] & cols_to_drop \
+                if tbl_name in features_dict else cols_to_drop
+    features_dict = OrderedDict((tbl_name, sorted(cols_to_drop))
+        for tbl_name, cols_to_drop in features_dict.items())
+
+    union_query = "\n    union\n    ".join(
+        "select aamc_id, application_year from ({query}) q{i}".format(
+            query = subquery, i = i)
+        for i, subquery in enumerate(subqueries))
+    return features_dict, union_query
+
+
+def pull_shared_features(filenames, engine, fit_or_predict = 'fit',
+        algorithm_ids = None,
+        prediction_tbl = "out$predictions$screening_current_cohort",
+        cache_dir = None, n_jobs = 1, materialize = False, ledger_tbl = None,
+        compact = False, dtype_overrides = None, memory = None):
+    """Pulls the feature tables for several model specs at once, so that specs
+    with overlapping tables (such as URM/non-URM pairs) read each table from
+    the database only once. Pass the result as shared_features to
+    get_data_for_modeling or get_data_for_prediction for each spec.
+
+    Usage:
+        shared = pull_shared_features(['all_features_non_urm.yaml',
+            'all_features_urm.yaml'], engine)
+        model_matrix, alg_id, alg_name = get_data_for_modeling(
+            'all_features_urm.yaml', engine, shared_features = shared)
+
+    Args:
+        filenames (list[str]): paths to the model specification files
+        engine (sqlalchemy.Engine): a connection to the MySQL database
+        fit_or_predict (str): 'fit' for the historical cohorts or 'predict'
+            for the applicants still to be scored in the current cohorts
+        algorithm_ids (list[int]): the algorithm id of each spec, required
+            for 'predict'
+        prediction_tbl (str): the name of the table where previous predictions
+            have been written, for 'predict'
+        cache_dir (str): optional path to a local directory caching the
+            feature tables between runs (use for 'fit' only)
+        n_jobs (int): number of feature tables to pull concurrently
+        materialize (bool): whether to materialize the union of the keys once
+            into an indexed temporary table that every query joins against
+            (pulled serially on its connection)
+        ledger_tbl (str): optional name of the scoring ledger, for 'predict'
+        compact, dtype_overrides, memory: see pull_model_matrix
+    Returns:
+        OrderedDict(pandas.DataFrame): full feature table names as keys and
+            the pulled features for all the specs' applicants as values
+    """
+    model_opts_list = []
+    for filename in filenames:
+        with open(filename) as f:
+            model_opts_list.append(yaml.load(f))
+
+    if fit_or_predict == 'fit':
+        subqueries = [build_cohort_query(model_opts, 'fit')
+            for model_opts in model_opts_list]
+    else:
+        subqueries = [build_current_applicants_query(model_opts,
+            algorithm_id, prediction_tbl, ledger_tbl)
+            for model_opts, algorithm_id
+            in zip(model_opts_list, algorithm_ids)]
+    features_dict, union_query = plan_shared_pull(model_opts_list, subqueries)
+
+    with materialized_keys(engine, union_query,
+            materialize) as (key_tbl, conn):
+        features = loop_through_features(conn, features_dict,
+            subquery = union_query, cache_dir = cache_dir, n_jobs = n_jobs,
+            key_tbl = key_tbl, compact = compact,
+            dtype_overrides = dtype_overrides, memory = memory)
+    shared_features = OrderedDict(
+        ("vw$features${}".format(tbl_name), feature_data)
+        for tbl_name, feature_data in zip(features_dict, features))
+    logging.info("pulled {n} shared feature tables for {n_specs} specs".format(
+        n = len(shared_features), n_specs = len(filenames)))
+    return shared_features
+
+
+def select_spec_features(shared_features, features_dict):
+    """Selects one spec's feature tables and columns from the shared pull.
+    Tables the spec uses in full are returned as they are, without a copy.
+
+    Args:
+        shared_features (OrderedDict(pandas.DataFrame)): the result of
+            pull_shared_features
+        features_dict (dict(list[str])): the spec's features dictionary
+    Returns:
+        list(pandas.DataFrame): the spec's feature tables in the order of its
+            features dictionary, for all the applicants in the shared pull
+    """
+    features = []
+    for tbl_name, cols_to_drop in features_dict.items():
+        feature_data = shared_features["vw$features${}".format(tbl_name)]
+        cols_to_drop = [col for col in cols_to_drop or []
+            if col in feature_data]
+        features.append(feature_data.drop(cols_to_drop, axis = 1)
+            if cols_to_drop else feature_data)
+    return features
+
+
+def iterate_key_chunks(engine, subquery, chunksize):
+    """Streams the keys returned by the subquery through a server-side cursor,
+    so that only one chunk of keys is held in memory at a time.
+
+    Args:
+        engine (sqlalchemy.Engine): a connection to the MySQL database
+        subquery (str): a string containing the subquery giving the aamc_id and
+            application_year of the applicants of interest
+        chunksize (int): the number of keys in each chunk
+    Yields:
+        list[tuple]: (aamc_id, application_year) pairs
+    """
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results = True).execute(
+            sqlalchemy.text(subquery))
+        keys = result.fetchmany(chunksize)
+        while keys:
+            yield [tuple(key) for key in keys]
+            keys = result.fetchmany(chunksize)
+
+
+def loop_through_features(engine, features_dict, subquery, cache_dir = None,
+        n_jobs = 1, timings = None, key_tbl = None, compact = False,
+        dtype_overrides = None, memory = None):
     """
     Args:
         engine (sqlalchemy.Engine): a connection to the mySQL database
@@ -207,27 +695,173 @@ def loop_through_features(engine, features_dict, subquery):
             include all features in the table)
         subquery (str): a string containing the subquery giving the aamc_id and
             application_year of the applicants of interest
+        cache_dir (str): optional path to a local directory caching each
+            feature table, only refreshed from the database when the table's
+            fingerprint for the subquery changes (use for 'fit' cohorts only)
+        n_jobs (int): number of feature tables to pull concurrently, each on
+            its own pooled connection from the engine (1 pulls serially, as
+            do pulls on a single connection)
+        timings (dict): optional dictionary to be filled with the seconds
+            spent pulling each feature table
+        key_tbl (str): optional name of a table holding the materialized keys
+            of the subquery, joined in place of evaluating the subquery again
+            for every feature table
+        compact (bool): whether to read each table with the compact dtypes
+            resolved from its declared types (see schema.resolve_dtypes)
+        dtype_overrides (dict): column names or patterns and the dtypes that
+            take precedence over the resolved ones
+        memory (dict): optional dictionary to be filled with the bytes of
+            each column as read and as cast, for compact reads
     Returns:
         list(pandas.DataFrame): a list of dataframes containing all the features
             specified in the feature dictionary for all the applicants returned
             by the given subquery
     """
-    feature_tbls = {"vw$features${}".format(tbl_name): cols_to_drop
+    feature_tbls = [("vw$features${}".format(tbl_name), cols_to_drop)
         for tbl_name, cols_to_drop
-        in features_dict.items()}
+        in features_dict.items()]
+
+    if timings is None:
+        timings = dict()
+
+    def pull(feature_tbl_and_drop_cols):
+        feature_tbl, drop_cols = feature_tbl_and_drop_cols
+        start_time = time.time()
+        feature_data = pull_feature_tbl(engine, feature_tbl, drop_cols,
+            subquery, cache_dir, key_tbl, compact = compact,
+            dtype_overrides = dtype_overrides, memory = memory)
+        timings[feature_tbl] = time.time() - start_time
+        logging.info("pulled {} in {:.1f}s".format(
+            feature_tbl, timings[feature_tbl]))
+        return feature_data
+
+    if n_jobs > 1 and not isinstance(engine, sqlalchemy.engine.Connection):
+        with ThreadPoolExecutor(max_workers = n_jobs) as executor:
+            features = list(executor.map(pull, feature_tbls))
+    else:
+        features = [pull(feature_tbl) for feature_tbl in feature_tbls]
+    return features
 
-    features = list()
-    for feature_tbl, drop_cols in feature_tbls.items():
-        get_features = """select * from `{feature_tbl}`
-        where (aamc_id, application_year) in ({query})""".format(
-            feature_tbl = feature_tbl,
-            query = subquery)
-        feature_data = pd.read_sql_query(get_features, engine,
+
+def pull_feature_tbl(engine, feature_tbl, drop_cols, subquery,
+        cache_dir = None, key_tbl = None, compact = False,
+        dtype_overrides = None, memory = None):
+    """Pulls a single feature table for the applicants returned by the subquery.
+
+    Args:
+        engine (sqlalchemy.Engine): a connection to the mySQL database
+        feature_tbl (str): full name of the feature table or view
+        drop_cols (list[str]): names of columns to exclude from the table
+        subquery (str): a string containing the subquery giving the aamc_id and
+            application_year of the applicants of interest
+        cache_dir (str): optional path to a local directory caching the table
+        key_tbl (str): optional name of a table holding the materialized keys
+            of the subquery
+        compact (bool): whether to read the table with the compact dtypes
+            resolved from its declared types (the cache keeps the tables read
+            with each set of dtypes apart)
+        dtype_overrides (dict): column names or patterns and the dtypes that
+            take precedence over the resolved ones
+        memory (dict): optional dictionary to be filled with the bytes of
+            each column as read and as cast, for compact reads
+    Returns:
+        pandas.DataFrame: the features in the table with Multi-index of
+            aamc id and application year
+    """
+    get_features = select_for_keys(feature_tbl, subquery, key_tbl)
+    dtypes = None
+    if compact:
+        dtypes = schema.resolve_dtypes(
+            schema.get_column_types(engine, [feature_tbl]), dtype_overrides)
+        fetch = lambda: schema.read_sql_compact(get_features, engine, dtypes,
+            index_col = ['aamc_id', 'application_year'], memory = memory)
+    else:
+        fetch = lambda: pd.read_sql_query(get_features, engine,
             index_col = ['aamc_id', 'application_year'])
-        if drop_cols:
-            feature_data.drop(drop_cols, axis = 1, inplace = True)
-        features.append(feature_data)
-    return features
+    if cache_dir:
+        feature_data = feature_cache.read_through(cache_dir, engine,
+            feature_tbl, subquery, fetch, key_tbl = key_tbl, dtypes = dtypes)
+    else:
+        feature_data = fetch()
+    if drop_cols:
+        feature_data.drop(drop_cols, axis = 1, inplace = True)
+        if memory is not None:
+            for col in drop_cols:
+                memory.pop(col, None)
+    return feature_data
+
+
+def select_for_keys(tbl, subquery, key_tbl = None):
+    """Builds a query selecting all columns of a table for the applicants
+    returned by the subquery, or joined to their materialized keys.
+
+    Args:
+        tbl (str): full name of the table or view
+        subquery (str): a string containing the subquery giving the aamc_id and
+            application_year of the applicants of interest
+        key_tbl (str): optional name of a table holding the materialized keys
+            of the subquery
+    Returns:
+        str: a select query for the table
+    """
+    if key_tbl:
+        return """select t.* from `{tbl}` t
+    join `{key_tbl}` k
+    on t.aamc_id = k.aamc_id
+    and t.application_year = k.application_year""".format(
+            tbl = tbl,
+            key_tbl = key_tbl)
+    return """select * from `{tbl}`
+    where (aamc_id, application_year) in ({query})""".format(
+        tbl = tbl,
+        query = subquery)
+
+
+@contextmanager
+def materialized_keys(engine, subquery, materialize = True):
+    """Materializes the (aamc_id, application_year) keys returned by the
+    subquery into a temporary table with a primary key on both columns, on a
+    connection of its own, and drops the table on exit.
+
+    A temporary table is only visible to the connection that created it, so
+    every query joining the keys must run on the yielded connection, one at a
+    time (loop_through_features pulls serially when given a connection).
+
+    Usage:
+        with materialized_keys(engine, get_cohort) as (key_tbl, conn):
+            features = loop_through_features(conn, features_dict,
+                get_cohort, key_tbl = key_tbl)
+
+    Args:
+        engine (sqlalchemy.Engine): a connection to the MySQL database
+        subquery (str): a string containing the subquery giving the aamc_id and
+            application_year of the applicants of interest
+        materialize (bool): if False, nothing is created and None is yielded
+            with the engine itself
+    Yields:
+        str: the name of the key table (or None)
+        sqlalchemy.Connection: the connection holding the key table (or the
+            engine)
+    """
+    if not materialize:
+        yield None, engine
+        return
+
+    key_tbl = "tmp$keys${}".format(uuid.uuid4().hex[:12])
+    create_keys = """create temporary table `{key_tbl}`
+    (primary key (aamc_id, application_year))
+    select distinct aamc_id, application_year
+    from ({query}) keys_query""".format(
+        key_tbl = key_tbl,
+        query = subquery)
+    with engine.connect() as conn:
+        conn.execute(sqlalchemy.text(create_keys))
+        try:
+            yield key_tbl, conn
+        finally:
+            # the pooled connection outlives this block, and its tables too
+            conn.execute(sqlalchemy.text(
+                "drop temporary table if exists `{}`".format(key_tbl)))
 
 
 def split_data(model_matrix, outcome_name = 'outcome',
@@ -247,6 +881,8 @@ def split_data(model_matrix, outcome_name = 'outcome',
         numpy.ndarray: testing target labels (if multiclass, a column for each class)
         sklearn.LabelBinarizer: transforms multiclass labels into binary dummies
     """
+    from sklearn.model_selection import train_test_split
+    from sklearn.preprocessing import LabelBinarizer
     X, y = model_matrix.drop(outcome_name, axis = 1), model_matrix[outcome_name]
     X_train, X_test, y_train, y_test = train_test_split(X, y,
             test_size = test_size, random_state = seed, stratify = y)
@@ -1,9 +1,29 @@
-from sklearn.pipeline import TransformerMixin
-from sklearn.base import BaseEstimator
+from sklearn.pipeline import TransformerMixin, Pipeline
+from sklearn.base import BaseEstimator, clone
+from sklearn.externals import joblib
 import pandas as pd
-import re, yaml, logging
+import numpy as np
+import scipy.sparse
+from collections import OrderedDict
+import os, re, math, yaml, logging
 import time, datetime
 
+# in-memory cache of fitted transformers for CachedPipeline, per process
+_TRANSFORMER_CACHE = OrderedDict()
+
+def get_best_pipeline(cv_pipeline):
+    """Returns the best fitted pipeline of a search, or the pipeline itself
+    when given a bare fitted pipeline (as saved by slim model exports).
+
+    Args:
+        cv_pipeline (sklearn.GridSearchCV or sklearn.Pipeline): a fitted search
+            object or its best fitted pipeline
+    Returns:
+        sklearn.Pipeline: the fitted pipeline
+    """
+    return getattr(cv_pipeline, 'best_estimator_', cv_pipeline)
+
+
 def extract_step_from_pipeline(cv_pipeline, step_name):
     """Extract the object corresponding to an explicitly named step from the
     modeling pipeline.
@@ -17,7 +37,7 @@ def extract_step_from_pipeline(cv_pipeline, step_name):
         obj: an object with a .fit() and .transform() method with parameters
             selected by grid search
     """
-    steps = cv_pipeline.best_estimator_.named_steps
+    steps = get_best_pipeline(cv_pipeline).named_steps
     return steps.get(step_name)
 
 
@@ -30,7 +50,7 @@ def describe_pipeline_steps(cv_pipeline):
     Returns:
         list[str]: a list of strings containing all pipeline step names
     """
-    steps = cv_pipeline.best_estimator_.named_steps
+    steps = get_best_pipeline(cv_pipeline).named_steps
     return list(steps.keys())
 
 
@@ -88,6 +108,41 @@ def get_transformed_columns(cv_pipeline):
     return encoder_step.transformed_columns
 
 
+def get_feature_groups(encoder):
+    """Maps each raw feature to the columns it is encoded into: a numeric
+    feature to its own column, a categorical feature to its dummies and NA
+    indicator.
+
+    Args:
+        encoder (DummyEncoder): a fitted encoder
+    Returns:
+        OrderedDict: raw feature names as keys, and numpy arrays of positions
+            in encoder.transformed_columns as values
+    """
+    groups = OrderedDict()
+    if hasattr(encoder, 'category_mapping_'):
+        for col, index in zip(*encoder.numeric_mapping_):
+            groups[col] = np.array([index])
+        for col, (categories, category_index, nan_index) in \
+                encoder.category_mapping_.items():
+            groups[col] = np.append(category_index, nan_index)
+        return groups
+
+    # encoders fitted before the category mapping existed: match the dummy
+    # names, longest categorical column names first
+    transformed = list(encoder.transformed_columns)
+    unmatched = np.ones(len(transformed), dtype = bool)
+    for col in sorted(encoder.columns, key = len, reverse = True):
+        prefix = '{}_'.format(col)
+        match = np.array([unmatched[i] and name.startswith(prefix)
+            for i, name in enumerate(transformed)], dtype = bool)
+        groups[col] = np.flatnonzero(match)
+        unmatched &= ~match
+    for index in np.flatnonzero(unmatched):
+        groups[transformed[index]] = np.array([index])
+    return groups
+
+
 def build_param_grid(pipeline, grid_path):
     """Looks up pipeline steps in grid options yaml file and builds the
     appropriate parameter grid for steps in the pipeline.
@@ -113,28 +168,239 @@ def build_param_grid(pipeline, grid_path):
     return param_grid
 
 
+def read_search_options(grid_path):
+    """Reads the optional search block of the grid options yaml file, which
+    selects the hyperparameter search strategy, e.g.
+
+        search:
+            strategy: halving
+            n_iter: 60
+            resource: randomforestclassifier__n_estimators
+            min_resource: 10
+            max_resource: 1000
+
+    Args:
+        grid_path: path to a yaml file containing the grid options to use
+    Returns:
+        dict: the search options (empty if the block is absent)
+    """
+    with open(grid_path, 'r') as f:
+        grid = yaml.load(f)
+    return grid.get('search') or dict()
+
+
+class SuccessiveHalvingSearch(BaseEstimator):
+    """A budgeted alternative to GridSearchCV. All candidates are scored by
+    cross-validation with a small budget of the resource, then only the best
+    1/eta are kept and scored again with eta times the resource, until one
+    candidate is left. The winner is refit on all the data with max_resource.
+
+    The resource is either an integer parameter of the pipeline (such as
+    'randomforestclassifier__n_estimators') or 'n_samples', the number of
+    training rows. The fitted object has the best_estimator_, best_params_,
+    best_score_ and cv_results_ attributes of GridSearchCV, so it can be
+    pickled and used in the same way.
+
+    Usage:
+        search = SuccessiveHalvingSearch(pipeline, param_grid,
+            resource = 'randomforestclassifier__n_estimators',
+            min_resource = 10, max_resource = 1000).fit(X_train, y_train)
+
+    Args:
+        estimator (sklearn.Pipeline): the pipeline to tune
+        param_grid (dict): parameter names and lists of values to try
+        resource (str): a parameter name of the estimator, or 'n_samples'
+        min_resource (int): the resource for the first round
+        max_resource (int): the resource for the refit (and the largest
+            resource for any round), all the rows if None for 'n_samples'
+        eta (int): the fraction of candidates kept in each round is 1/eta
+        n_candidates (int): number of candidates sampled from the grid for the
+            first round, or None to start from the full grid
+        cv (int): number of cross-validation folds
+        scoring (str): scoring metric to select candidates on
+        n_jobs (int): number of candidates to score in parallel
+        random_state (int): seed for candidate sampling and row subsampling
+    """
+    def __init__(self, estimator, param_grid,
+            resource = 'randomforestclassifier__n_estimators',
+            min_resource = 10, max_resource = None, eta = 3,
+            n_candidates = None, cv = 5, scoring = 'roc_auc', n_jobs = -1,
+            random_state = 1100):
+        self.estimator = estimator
+        self.param_grid = param_grid
+        self.resource = resource
+        self.min_resource = min_resource
+        self.max_resource = max_resource
+        self.eta = eta
+        self.n_candidates = n_candidates
+        self.cv = cv
+        self.scoring = scoring
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        from sklearn.model_selection import ParameterGrid, ParameterSampler
+        param_grid = {param: values for param, values
+            in self.param_grid.items() if param != self.resource}
+        # sampling needs fewer candidates than the grid has combinations
+        if self.n_candidates and \
+                self.n_candidates < len(ParameterGrid(param_grid)):
+            candidates = list(ParameterSampler(param_grid,
+                self.n_candidates, random_state = self.random_state))
+        else:
+            candidates = list(ParameterGrid(param_grid))
+        if self.max_resource:
+            max_resource = self.max_resource
+        elif self.resource == 'n_samples':
+            max_resource = X.shape[0]
+        elif self.resource in self.param_grid:
+            max_resource = max(self.param_grid[self.resource])
+        else:
+            max_resource = self.estimator.get_params()[self.resource]
+        row_order = np.random.RandomState(
+            self.random_state).permutation(X.shape[0])
+
+        self.cv_results_ = list()
+        resource = self.min_resource
+        n_round = 0
+        while True:
+            resource = int(min(resource, max_resource))
+            logging.info("halving round {}: {} candidates with {} = {}".format(
+                n_round, len(candidates), self.resource, resource))
+            scores = joblib.Parallel(n_jobs = self.n_jobs)(
+                joblib.delayed(_score_candidate)(self.estimator, params,
+                    self.resource, resource, X, y, row_order, self.cv,
+                    self.scoring)
+                for params in candidates)
+            self.cv_results_.extend({'round': n_round, 'params': params,
+                'resource': resource, 'mean_test_score': score}
+                for params, score in zip(candidates, scores))
+
+            n_keep = int(math.ceil(len(candidates) / float(self.eta)))
+            ranked = np.argsort(scores)[::-1][:n_keep]
+            candidates = [candidates[index] for index in ranked]
+            if len(candidates) == 1 or resource >= max_resource:
+                best_score = scores[ranked[0]]
+                break
+            resource *= self.eta
+            n_round += 1
+
+        self.best_params_ = dict(candidates[0])
+        if self.resource != 'n_samples':
+            self.best_params_[self.resource] = max_resource
+        self.best_score_ = best_score
+        self.best_estimator_ = clone(self.estimator).set_params(
+            **self.best_params_).fit(X, y)
+        return self
+
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
+
+    def predict_proba(self, X):
+        return self.best_estimator_.predict_proba(X)
+
+
+def _score_candidate(estimator, params, resource_name, resource, X, y,
+        row_order, cv, scoring):
+    """Scores one candidate of SuccessiveHalvingSearch by cross-validation."""
+    from sklearn.model_selection import cross_val_score
+    if resource_name == 'n_samples':
+        rows = np.sort(row_order[:resource])
+        X, y = X.iloc[rows], y[rows]
+    else:
+        params = dict(params, **{resource_name: resource})
+    candidate = clone(estimator).set_params(**params)
+    return cross_val_score(candidate, X, y, cv = cv, scoring = scoring).mean()
+
+
 class DummyEncoder(BaseEstimator, TransformerMixin):
     """A one-hot encoder transformer with fit and transform methods.
 
     Suitable for use in a pipeline. Adds indicator variables for NAs,
     drops dummy for first level of categorical.
 
+    With output = 'dense' or 'sparse', transform skips pd.get_dummies and
+    writes the numeric columns, dummies, and NA indicators straight into a
+    preallocated numpy array or a scipy.sparse CSR matrix, using the mapping
+    from each fitted category to its position in transformed_columns. Columns
+    are in the same order as for output = 'frame'. Categories not seen in fit
+    get zeros for every dummy of that column, as do fitted categories that are
+    absent from the data being transformed.
+
     Usage:
         d = DummyEncoder().fit(X_train)
         X_train_enc, X_test_enc = d.transform(X_train), d.transform(X_test)
+
+    Args:
+        output (str): 'frame' for a Pandas DataFrame, 'dense' for a numpy
+            array, or 'sparse' for a scipy.sparse CSR matrix
+        dtype (numpy.dtype): dtype of the dense or sparse output
     """
-    def __init__(self):
+    def __init__(self, output = 'frame', dtype = np.float32):
+        self.output = output
+        self.dtype = dtype
         self.columns = None
         self.transformed_columns = None
 
     def transform(self, X, y=None, **kwargs):
+        output = getattr(self, 'output', 'frame')
+        if output != 'frame':
+            return self.transform_array(X, sparse = output == 'sparse')
+
         transformed = pd.get_dummies(X,
             columns = self.columns,
             drop_first = False, # do not drop in transform method!
             dummy_na = True)
-        transformed = transformed.loc[:,self.transformed_columns]
+        # fitted categories absent from X (e.g. a single row) get zeros
+        transformed = transformed.reindex(
+            columns = self.transformed_columns, fill_value = 0)
         return transformed
 
+    def transform_array(self, X, sparse = False):
+        """Encodes the data with the fitted category mapping.
+
+        Args:
+            X (Pandas.DataFrame): data with the columns seen in fit
+            sparse (bool): whether to return a CSR matrix instead of an array
+        Returns:
+            numpy.ndarray or scipy.sparse.csr_matrix: the encoded data with
+                one column per entry of transformed_columns
+        """
+        n_rows, n_cols = X.shape[0], len(self.transformed_columns)
+        numeric_cols, numeric_index = self.numeric_mapping_
+        numeric = X[numeric_cols].values.astype(self.dtype)
+
+        dummy_rows, dummy_cols = list(), list()
+        for col, (categories, category_index, nan_index) in \
+                self.category_mapping_.items():
+            values = X[col]
+            codes = np.asarray(pd.Categorical(values,
+                categories = categories).codes)
+            seen = np.flatnonzero(codes >= 0)
+            missing = np.flatnonzero(pd.isnull(values).values)
+            dummy_rows.extend([seen, missing])
+            dummy_cols.extend([category_index[codes[seen]],
+                np.repeat(nan_index, missing.size)])
+        dummy_rows = np.concatenate(dummy_rows) if dummy_rows \
+            else np.empty(0, dtype = int)
+        dummy_cols = np.concatenate(dummy_cols) if dummy_cols \
+            else np.empty(0, dtype = int)
+
+        if not sparse:
+            transformed = np.zeros((n_rows, n_cols), dtype = self.dtype)
+            transformed[:, numeric_index] = numeric
+            transformed[dummy_rows, dummy_cols] = 1
+            return transformed
+
+        # keep NaN entries explicitly so they can be imputed downstream
+        numeric_rows, numeric_pos = np.nonzero(numeric != 0)
+        rows = np.concatenate([numeric_rows, dummy_rows])
+        cols = np.concatenate([numeric_index[numeric_pos], dummy_cols])
+        data = np.concatenate([numeric[numeric_rows, numeric_pos],
+            np.ones(dummy_rows.size, dtype = self.dtype)])
+        return scipy.sparse.csr_matrix((data, (rows, cols)),
+            shape = (n_rows, n_cols), dtype = self.dtype)
+
     def fit(self, X, y=None, **kwargs):
         self.columns = X.select_dtypes(
             include = ['object', 'category']).columns
@@ -144,8 +410,139 @@ class DummyEncoder(BaseEstimator, TransformerMixin):
             drop_first = False, # need to be careful about dropping this
             dummy_na = True)
         self.transformed_columns = transformed.columns
+        duplicated = self.transformed_columns[
+            self.transformed_columns.duplicated()]
+        if len(duplicated):
+            # e.g. a literal 'nan' category and the NA indicator of its column
+            raise ValueError("encoded column names are not unique: {}; "
+                "recode categories such as 'nan' that collide with the NA "
+                "indicator or another column".format(list(duplicated)))
+
+        numeric_cols = [col for col in X.columns if col not in self.columns]
+        self.numeric_mapping_ = (numeric_cols, np.array(
+            [self.transformed_columns.get_loc(col) for col in numeric_cols],
+            dtype = int))
+        self.category_mapping_ = OrderedDict()
+        for col in self.columns:
+            categories = pd.Categorical(X[col]).categories
+            category_index = np.array([self.transformed_columns.get_loc(
+                '{}_{}'.format(col, level)) for level in categories],
+                dtype = int)
+            nan_index = self.transformed_columns.get_loc('{}_nan'.format(col))
+            self.category_mapping_[col] = (categories, category_index,
+                nan_index)
+        return self
+
+
+class CachedPipeline(Pipeline):
+    """A Pipeline that caches each fitted transformer step together with its
+    output, keyed by the parameters of the steps up to and including it and a
+    hash of the input data (i.e. the cross-validation fold). Under a grid
+    search where only the final estimator's parameters vary, each fold is then
+    preprocessed once per unique preprocessing configuration.
+
+    With cache_dir = None the cache is held in memory in each process (each
+    GridSearchCV worker keeps its own); otherwise it is written with joblib to
+    cache_dir and shared between worker processes. Either way, the least
+    recently used entries are evicted once the cache exceeds max_cache_bytes.
+
+    Usage:
+        pipeline = CachedPipeline(make_pipeline(DummyEncoder(), Imputer(),
+            RandomForestClassifier()).steps, cache_dir = 'transformer_cache')
+
+    Args:
+        steps (list[tuple]): (name, transform) tuples as for Pipeline
+        cache_dir (str): directory for the on-disk cache, None for in memory
+        max_cache_bytes (int): size of the cache before eviction
+    """
+    def __init__(self, steps, cache_dir = None, max_cache_bytes = 2 * 1024**3):
+        super(CachedPipeline, self).__init__(steps)
+        self.cache_dir = cache_dir
+        self.max_cache_bytes = max_cache_bytes
+
+    def fit(self, X, y=None, **fit_params):
+        key = joblib.hash((X, y))
+        Xt = X
+        for index, (name, transform) in enumerate(self.steps[:-1]):
+            key = joblib.hash((key, name, type(transform).__name__,
+                transform.get_params()))
+            cached = self._cache_get(key)
+            if cached is None:
+                logging.info("transformer cache miss: {}".format(name))
+                transform = clone(transform)
+                Xt = transform.fit_transform(Xt, y)
+                self._cache_put(key, (transform, Xt))
+            else:
+                logging.info("transformer cache hit: {}".format(name))
+                transform, Xt = cached
+            self.steps[index] = (name, transform)
+
+        final_name, final_estimator = self.steps[-1]
+        final_params = {param.split('__', 1)[1]: value
+            for param, value in fit_params.items()
+            if param.startswith(final_name + '__')}
+        final_estimator.fit(Xt, y, **final_params)
         return self
 
+    def _cache_get(self, key):
+        if self.cache_dir is None:
+            if key not in _TRANSFORMER_CACHE:
+                return None
+            _TRANSFORMER_CACHE.move_to_end(key)
+            return _TRANSFORMER_CACHE[key][0]
+
+        path = os.path.join(self.cache_dir, '{}.pkl'.format(key))
+        try:
+            value = joblib.load(path)
+            os.utime(path, None)
+        except (IOError, OSError, EOFError):
+            # missing, or evicted by another worker while loading
+            return None
+        return value
+
+    def _cache_put(self, key, value):
+        nbytes = get_nbytes(value[1])
+        if self.cache_dir is None:
+            _TRANSFORMER_CACHE[key] = (value, nbytes)
+            while len(_TRANSFORMER_CACHE) > 1 and sum(
+                    size for _, size in _TRANSFORMER_CACHE.values()) \
+                    > self.max_cache_bytes:
+                _TRANSFORMER_CACHE.popitem(last = False)
+            return
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        joblib.dump(value, os.path.join(self.cache_dir, '{}.pkl'.format(key)))
+        paths = [os.path.join(self.cache_dir, f)
+            for f in os.listdir(self.cache_dir) if f.endswith('.pkl')]
+        try:
+            paths = sorted(paths, key = os.path.getmtime)
+            total = sum(os.path.getsize(path) for path in paths)
+            for path in paths[:-1]:
+                if total <= self.max_cache_bytes:
+                    break
+                total -= os.path.getsize(path)
+                os.remove(path)
+        except OSError:
+            # another worker evicted the same file
+            pass
+
+
+def get_nbytes(data):
+    """Returns the approximate memory size of transformed data.
+
+    Args:
+        data (Pandas.DataFrame, numpy.ndarray or scipy.sparse matrix): data
+    Returns:
+        int: the size in bytes
+    """
+    if isinstance(data, pd.DataFrame):
+        return int(data.memory_usage(deep = True).sum())
+    if scipy.sparse.issparse(data):
+        data = data.tocsr()
+        return data.data.nbytes + data.indices.nbytes + data.indptr.nbytes
+    return np.asarray(data).nbytes
+
 
 class Timer(object):
     """A Timer object that begins timing when entered and ends timing adding
@@ -0,0 +1,230 @@
+import os, re, json, time, pickle, hashlib, logging, fnmatch
+from collections import OrderedDict
+from contextlib import contextmanager
+
+INDEX_FILENAME = 'registry.json'
+
+# loaded models shared by every load in the process, least recently used first
+_MODEL_CACHE = OrderedDict()
+
+def checksum(path, blocksize = 1 << 20):
+    """Computes the sha1 digest of a file, reading it in blocks.
+
+    Args:
+        path (str): path to the file
+        blocksize (int): number of bytes read at a time
+    Returns:
+        str: the hex digest
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+@contextmanager
+def index_lock(pkl_path, timeout = 60, poll = .1):
+    """Holds a lock file next to the index while it is read and rewritten, so
+    models saved by concurrent fits do not drop each other's entries.
+
+    Args:
+        pkl_path (str): the directory holding the model files and the index
+        timeout (float): seconds to wait for the lock before taking it over
+            from a writer that has presumably died
+        poll (float): seconds between attempts to take the lock
+    """
+    lock_path = os.path.join(pkl_path, INDEX_FILENAME + '.lock')
+    start_time = time.time()
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if time.time() - start_time > timeout:
+                logging.warning('taking over stale lock {}'.format(lock_path))
+                os.remove(lock_path)
+                continue
+            time.sleep(poll)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(lock_path)
+
+
+def read_index(pkl_path):
+    """Reads the registry index of a model directory.
+
+    Args:
+        pkl_path (str): the directory holding the model files and the index
+    Returns:
+        dict: index entries keyed by algorithm id (as a string), empty if the
+            directory has no index yet
+    """
+    index_path = os.path.join(pkl_path, INDEX_FILENAME)
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path) as f:
+        return json.load(f)
+
+
+def write_index(pkl_path, index):
+    """Replaces the registry index in one step, so readers never see a
+    partially written file.
+
+    Args:
+        pkl_path (str): the directory holding the model files and the index
+        index (dict): index entries keyed by algorithm id
+    """
+    index_path = os.path.join(pkl_path, INDEX_FILENAME)
+    tmp_path = '{}.{}.tmp'.format(index_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent = 2, sort_keys = True, default = str)
+    os.replace(tmp_path, index_path)
+
+
+def register_model(pkl_path, alg_id, filename, nbytes = None,
+        metadata = None):
+    """Adds or replaces the index entry of a saved model.
+
+    Args:
+        pkl_path (str): the directory holding the model files and the index
+        alg_id (str/int): the algorithm id of the model
+        filename (str): the model file name within pkl_path
+        nbytes (int): approximate size of the loaded model in memory, used
+            to cap the in-process cache (defaults to the file size)
+        metadata (dict): training details to keep with the entry, such as the
+            algorithm name and best parameters
+    Returns:
+        dict: the new index entry
+    """
+    path = os.path.join(pkl_path, filename)
+    entry = {'filename': filename,
+        'size': os.path.getsize(path),
+        'mtime': os.path.getmtime(path),
+        'sha1': checksum(path),
+        'nbytes': nbytes or os.path.getsize(path),
+        'metadata': metadata or {}}
+    with index_lock(pkl_path):
+        index = read_index(pkl_path)
+        index[str(alg_id)] = entry
+        write_index(pkl_path, index)
+    return entry
+
+
+def rebuild_index(pkl_path):
+    """Indexes every model file in a directory (for directories of models
+    saved before the registry existed). Existing metadata is kept.
+
+    Args:
+        pkl_path (str): the directory holding the model files
+    Returns:
+        dict: the rebuilt index
+    """
+    existing = read_index(pkl_path)
+    # exports are indexed last, replacing a compressed search of the same id
+    filenames = sorted(fnmatch.filter(os.listdir(pkl_path), 'id*_*.pkl.z')) \
+        + sorted(fnmatch.filter(os.listdir(pkl_path), 'id*_*.pkl'))
+    for filename in filenames:
+        match = re.match(r'id(\w+?)_', filename)
+        if not match:
+            continue
+        alg_id = match.group(1)
+        previous = existing.get(alg_id, {})
+        register_model(pkl_path, alg_id, filename,
+            nbytes = previous.get('nbytes'),
+            metadata = previous.get('metadata'))
+    return read_index(pkl_path)
+
+
+def lookup(pkl_path, alg_id):
+    """Finds the index entry of a model, falling back to a directory scan
+    (and indexing the file found) when the model is not in the index or its
+    file has changed since it was indexed.
+
+    Args:
+        pkl_path (str): the directory holding the model files and the index
+        alg_id (str/int): the algorithm id of the model
+    Returns:
+        dict: the index entry
+    """
+    entry = read_index(pkl_path).get(str(alg_id))
+    if entry:
+        path = os.path.join(pkl_path, entry['filename'])
+        if os.path.exists(path) and os.path.getsize(path) == entry['size'] \
+                and os.path.getmtime(path) == entry['mtime']:
+            return entry
+
+    # prefer an uncompressed export over a compressed search
+    filenames = fnmatch.filter(os.listdir(pkl_path),
+        "id{}_*.pkl".format(alg_id)) or fnmatch.filter(os.listdir(pkl_path),
+        "id{}_*.pkl.z".format(alg_id))
+    if not filenames:
+        raise IOError("no model file for algorithm id {} in {}".format(
+            alg_id, pkl_path))
+    logging.info("indexing {}".format(filenames[0]))
+    return register_model(pkl_path, alg_id, filenames[0],
+        nbytes = entry.get('nbytes') if entry else None,
+        metadata = entry.get('metadata') if entry else None)
+
+
+def load(pkl_path, alg_id, loader, max_cache_bytes = 4 * 1024 ** 3):
+    """Loads a model through the in-process cache. Models are cached by their
+    path and checksum, so a retrained model under the same id is reloaded,
+    and the least recently used models are evicted once the cached models'
+    sizes add up to more than max_cache_bytes.
+
+    Cached models are shared between callers and should not be refit.
+
+    Args:
+        pkl_path (str): the directory holding the model files and the index
+        alg_id (str/int): the algorithm id of the model
+        loader (callable): a function from a file path to the loaded model
+        max_cache_bytes (int): memory cap for the cache, 0 disables caching
+    Returns:
+        object: the loaded model
+    """
+    entry = lookup(pkl_path, alg_id)
+    path = os.path.join(pkl_path, entry['filename'])
+    key = (os.path.abspath(path), entry['sha1'])
+    if key in _MODEL_CACHE:
+        _MODEL_CACHE.move_to_end(key)
+        logging.info("model cache hit: {}".format(entry['filename']))
+        return _MODEL_CACHE[key][0]
+
+    model = loader(path)
+    if entry['nbytes'] <= max_cache_bytes:
+        _MODEL_CACHE[key] = (model, entry['nbytes'])
+        while sum(size for _, size in _MODEL_CACHE.values()) \
+                > max_cache_bytes:
+            _MODEL_CACHE.popitem(last = False)
+    return model
+
+
+def clear_cache():
+    """Empties the in-process model cache."""
+    _MODEL_CACHE.clear()
+
+
+class _ByteCounter(object):
+    """A file-like object that only counts the bytes written to it."""
+    def __init__(self):
+        self.nbytes = 0
+
+    def write(self, data):
+        self.nbytes += len(data)
+
+
+def estimate_nbytes(obj):
+    """Estimates the in-memory size of a model by the size of its uncompressed
+    pickle, without holding the pickle in memory.
+
+    Args:
+        obj: the model to measure
+    Returns:
+        int: the size in bytes
+    """
+    counter = _ByteCounter()
+    pickle.dump(obj, counter, protocol = pickle.HIGHEST_PROTOCOL)
+    return counter.nbytes
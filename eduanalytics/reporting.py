@@ -1,7 +1,8 @@
 import pandas as pd
 import numpy as np
-from eduanalytics import model_data, pipeline_tools
-import os, fnmatch
+from eduanalytics import model_data, pipeline_tools, bulk_write, ledger, registry
+import os, json, yaml, logging, time
+from concurrent.futures import ThreadPoolExecutor
 from sklearn.externals import joblib
 
 def get_results(clf, X, y, lb):
@@ -81,7 +82,8 @@ def convert_binary_predictions(scores, lb, ids):
 
 
 def output_predictions(train_results, test_results, conn,
-    alg_id = -1, tbl_name = 'screening_train_val'):
+    alg_id = -1, tbl_name = 'screening_train_val',
+    write_method = 'to_sql', batch_size = 1000):
     """Write the true labels and prediction scores to a table in the database.
 
     Args:
@@ -93,6 +95,9 @@ def output_predictions(train_results, test_results, conn,
         alg_id (int): an algorithm id to store the model results by
         tbl_name (str): a name for the database table holding all results on
             the training and validation data
+        write_method (str): 'to_sql', or a bulk_write method ('insert' or
+            'infile') to write all rows in one transaction
+        batch_size (int): number of rows in each insert for bulk writes
     Returns:
         str: the name of the table in the database
     """
@@ -101,13 +106,15 @@ def output_predictions(train_results, test_results, conn,
     test_results['set'] = 'test'
     results = pd.concat([train_results, test_results])
     results['algorithm_id'] = alg_id
-    results.to_sql(name, conn, if_exists = 'append',
-        index_label = results.index.names)
+    write_results(results, name, conn, write_method, batch_size)
     return "Added to database {}: algorithm_id = {}".format(name, alg_id)
 
 
 def write_current_predictions(clf, filename, conn, label_encoder, alg_id,
-        tbl_name = 'screening_current_cohort'):
+        tbl_name = 'screening_current_cohort', n_jobs = 1,
+        single_query = False, materialize = False, chunksize = None,
+        write_method = 'to_sql', batch_size = 1000, shared_features = None,
+        use_ledger = False, compact = False, dtype_overrides = None):
     """Write out the predictions for the new testing data, only if (aamc_id,
     application_year) does not already have a prediction score for that
     algorithm_id, including the overall score (pr(invite) - pr(reject))
@@ -123,55 +130,307 @@ def write_current_predictions(clf, filename, conn, label_encoder, alg_id,
             generate the predictions
         tbl_name (str): name of table in database where predictions for all
             current applicants are written to
+        n_jobs (int): number of feature tables to pull concurrently
+        single_query (bool): whether to pull all feature tables in one query
+        materialize (bool): whether to materialize the keys of the applicants
+            still to be scored into an indexed temporary table for the
+            feature pulls
+        chunksize (int): if given, stream the applicants through
+            stream_current_predictions in chunks of this many rows
+        write_method (str): 'to_sql', or a bulk_write method ('insert' or
+            'infile') to write all rows in one transaction
+        batch_size (int): number of rows in each insert for bulk writes
+        shared_features (OrderedDict): feature tables pulled for several
+            specs at once by model_data.pull_shared_features (not used when
+            streaming in chunks)
+        use_ledger (bool): whether to find the applicants still to be scored
+            with the scoring ledger of the prediction table, creating it if
+            needed (see ledger.ensure_ledger). New predictions are recorded
+            in the ledger whenever it exists.
+        compact (bool): whether to read the features with the compact dtypes
+            of model_data.pull_model_matrix, as the model was trained with
+        dtype_overrides (dict): column names or patterns and the dtypes that
+            take precedence over the resolved ones
 
     Returns:
         str: output message confirming predictions have been written correctly 
     """
-    current_data = model_data.get_data_for_prediction(filename, conn, alg_id)
+    if chunksize:
+        return stream_current_predictions(clf, filename, conn, label_encoder,
+            alg_id, tbl_name = tbl_name, chunksize = chunksize,
+            n_jobs = n_jobs, single_query = single_query,
+            write_method = write_method, batch_size = batch_size,
+            use_ledger = use_ledger, compact = compact,
+            dtype_overrides = dtype_overrides)
+
+    name = "out$predictions${}".format(tbl_name)
+    ledger_tbl = ledger.ensure_ledger(conn, name) if use_ledger \
+        else ledger.find_ledger(conn, name)
+    current_data = model_data.get_data_for_prediction(filename, conn, alg_id,
+        prediction_tbl = name, n_jobs = n_jobs, single_query = single_query,
+        materialize = materialize, shared_features = shared_features,
+        ledger_tbl = ledger_tbl if use_ledger else None, compact = compact,
+        dtype_overrides = dtype_overrides)
     if current_data.empty:
         return "No new applicant data for algorithm_id = {}".format(alg_id)
     results = get_results(clf, current_data, y = None, lb = label_encoder)
 
+    results = add_overall_score(results, alg_id)
+    write_results(results, name, conn, write_method, batch_size,
+        ledger_tbl = ledger_tbl)
+    return "Added to database {}: algorithm_id = {}".format(name, alg_id)
+
+
+def stream_current_predictions(clf, filename, conn, label_encoder, alg_id,
+        tbl_name = 'screening_current_cohort', chunksize = 1000,
+        n_jobs = 1, single_query = False, write_method = 'to_sql',
+        batch_size = 1000, use_ledger = False, compact = False,
+        dtype_overrides = None):
+    """Write out the predictions for the new testing data in chunks, so memory
+    stays bounded by the chunk size. Keys are streamed through a server-side
+    cursor and the stages are pipelined: the features for chunk N+1 are pulled
+    while chunk N is scored and chunk N-1 is written to the database.
+
+    Args:
+        clf (sklearn.GridSearchCV/Estimator): the unpickled model estimator
+            that should be used to generate the predictions
+        filename (str): path to model specification file
+        conn (sqlalchemy.Engine): connection to the MySQL database
+        label_encoder (sklearn.LabelBinarizer): the label binarizer object
+            used to get the outcome names that correspond to predicted outcomes
+        alg_id (int): the algorithm id for the model that should be used to
+            generate the predictions
+        tbl_name (str): name of table in database where predictions for all
+            current applicants are written to
+        chunksize (int): the number of applicants scored at a time
+        n_jobs (int): number of feature tables to pull concurrently
+        single_query (bool): whether to pull all feature tables in one query
+        write_method (str): 'to_sql', or a bulk_write method ('insert' or
+            'infile') to write each chunk in one transaction
+        batch_size (int): number of rows in each insert for bulk writes
+        use_ledger (bool): whether to find the applicants still to be scored
+            with the scoring ledger of the prediction table. Each chunk is
+            recorded in the ledger as it is written whenever it exists.
+        compact, dtype_overrides: see write_current_predictions
+
+    Returns:
+        str: output message confirming predictions have been written correctly
+    """
+    with open(filename) as f:
+        model_opts = yaml.load(f)
     name = "out$predictions${}".format(tbl_name)
-    results = results.assign(algorithm_id = alg_id,
+    ledger_tbl = ledger.ensure_ledger(conn, name) if use_ledger \
+        else ledger.find_ledger(conn, name)
+
+    # the key query is a consistent read, so the rows written below do not
+    # change the keys still to be streamed
+    current_applicants_query = model_data.build_current_applicants_query(
+        model_opts, alg_id, prediction_tbl = name,
+        ledger_tbl = ledger_tbl if use_ledger else None)
+    key_chunks = model_data.iterate_key_chunks(conn,
+        current_applicants_query, chunksize)
+
+    def fetch(keys):
+        return model_data.get_data_for_keys(conn, model_opts['features'],
+            keys, n_jobs = n_jobs, single_query = single_query,
+            compact = compact, dtype_overrides = dtype_overrides)
+
+    def write(results):
+        write_results(results, name, conn, write_method, batch_size,
+            ledger_tbl = ledger_tbl)
+        return results.shape[0]
+
+    n_written = 0
+    with ThreadPoolExecutor(max_workers = 2) as executor:
+        keys = next(key_chunks, None)
+        next_data = executor.submit(fetch, keys) if keys else None
+        pending_write = None
+        while next_data is not None:
+            current_data = next_data.result()
+            keys = next(key_chunks, None)
+            next_data = executor.submit(fetch, keys) if keys else None
+
+            results = get_results(clf, current_data, y = None,
+                lb = label_encoder)
+            results = add_overall_score(results, alg_id)
+            if pending_write is not None:
+                n_written += pending_write.result()
+            pending_write = executor.submit(write, results)
+            logging.info("scored chunk of {} applicants".format(
+                results.shape[0]))
+        if pending_write is not None:
+            n_written += pending_write.result()
+
+    if n_written == 0:
+        return "No new applicant data for algorithm_id = {}".format(alg_id)
+    return "Added to database {}: algorithm_id = {}, {} applicants".format(
+        name, alg_id, n_written)
+
+
+def write_results(results, name, conn, write_method = 'to_sql',
+        batch_size = 1000, ledger_tbl = None):
+    """Appends indexed results to a table in the database, and records the
+    scored applicants in the scoring ledger in the same transaction.
+
+    Args:
+        results (Pandas.DataFrame): results with index or Multi-index
+        name (str): the name of the table in the database
+        conn (sqlalchemy.Engine): connection to the MySQL database
+        write_method (str): 'to_sql' for DataFrame.to_sql, or 'insert' or
+            'infile' for bulk_write.write_frame
+        batch_size (int): number of rows in each insert for bulk writes
+        ledger_tbl (str): optional name of the scoring ledger of the table
+            (see ledger.find_ledger)
+    """
+    with conn.begin() as transaction_conn:
+        if write_method == 'to_sql':
+            results.to_sql(name, transaction_conn, if_exists = 'append',
+                index_label = results.index.names)
+        else:
+            bulk_write.write_frame(results, name, transaction_conn,
+                method = write_method, batch_size = batch_size)
+        if ledger_tbl:
+            ledger.record_scored(transaction_conn, results, ledger_tbl,
+                batch_size)
+
+
+def add_overall_score(results, alg_id):
+    """Adds the algorithm id and the overall score (pr(invite) - pr(reject))
+    to the predictions for the current applicants.
+
+    Args:
+        results (Pandas.DataFrame): indexed prediction scores from get_results
+        alg_id (int): the algorithm id for the model used for the predictions
+    Returns:
+        Pandas.DataFrame: the results with algorithm_id and score columns
+    """
+    return results.assign(algorithm_id = alg_id,
         score = lambda x: np.round(x.predicted_invite - x.predicted_reject, 2))
-    results.to_sql(name, conn, if_exists = 'append',
-        index_label = results.index.names)
-    return "Added to database {}: algorithm_id = {}".format(name, alg_id)
 
 
-def pickle_model(clf, pkl_path, label_encoder, alg_id, model_tag):
-    """Write a sklearn object to disk in binary compressed format.
+def pickle_model(clf, pkl_path, label_encoder, alg_id, model_tag,
+        slim = False):
+    """Write a sklearn object to disk in binary compressed format, and add it
+    to the model registry index of the directory.
 
     Args:
         clf (sklearn.GridSearchCV/Estimator): the model to persist to disk
         pkl_path (str): name of the directory to store the pkl files
         tbl_name (str): shortname of the algorithm id for the model
         model_tag (str): algorithm name to tag the model with
+        slim (bool): whether to save only the best fitted pipeline and the
+            label encoder, uncompressed (see export_model)
     Returns:
         str: a message giving the path where the model has been saved
     """
+    metadata = get_search_metadata(clf, label_encoder, model_tag)
+    if slim:
+        return export_model(clf, pkl_path, label_encoder, alg_id, model_tag,
+            metadata)
+
     filename = "id{}_{}.pkl.z".format(alg_id, model_tag)
     model_plus_encoder = {'pipeline': clf, 'encoder': label_encoder}
     joblib.dump(model_plus_encoder,
         os.path.join(pkl_path, filename))
+    registry.register_model(pkl_path, alg_id, filename,
+        nbytes = registry.estimate_nbytes(model_plus_encoder),
+        metadata = {key: value for key, value in metadata.items()
+            if key != 'cv_results'})
     output = "Written compressed model to: {} in {}".format(
         filename, pkl_path)
     return output
 
 
-def load_model(pkl_path, alg_id):
-    """Load a sklearn object from disk saved in binary compressed format.
+def export_model(clf, pkl_path, label_encoder, alg_id, model_tag,
+        metadata = None):
+    """Write only the best fitted pipeline of a search and the label encoder
+    to disk, without compression, so the numpy arrays in the file can be
+    memory-mapped when loading. The search metadata (best parameters and the
+    scores of every candidate) goes in a json file of the same name.
+
+    Args:
+        clf (sklearn.GridSearchCV/Estimator): the fitted search or pipeline
+        pkl_path (str): name of the directory to store the pkl files
+        label_encoder (sklearn.LabelBinarizer): the fitted label encoder
+        alg_id (str/int): the algorithm id for the model
+        model_tag (str): algorithm name to tag the model with
+        metadata (dict): the search metadata from get_search_metadata
+    Returns:
+        str: a message giving the path where the model has been saved
+    """
+    filename = "id{}_{}.pkl".format(alg_id, model_tag)
+    model_plus_encoder = {
+        'pipeline': pipeline_tools.get_best_pipeline(clf),
+        'encoder': label_encoder}
+    joblib.dump(model_plus_encoder, os.path.join(pkl_path, filename),
+        compress = 0)
+
+    metadata = metadata or get_search_metadata(clf, label_encoder, model_tag)
+    with open(os.path.join(pkl_path, "id{}_{}.json".format(
+            alg_id, model_tag)), 'w') as f:
+        json.dump(metadata, f, indent = 2, default = str)
+    registry.register_model(pkl_path, alg_id, filename,
+        nbytes = registry.estimate_nbytes(model_plus_encoder),
+        metadata = {key: value for key, value in metadata.items()
+            if key != 'cv_results'})
+    return "Written model to: {} in {}".format(filename, pkl_path)
+
+
+def get_search_metadata(clf, label_encoder, model_tag):
+    """Summarizes a fitted search for the model registry and sidecar files.
+
+    Args:
+        clf (sklearn.GridSearchCV/Estimator): the fitted search or pipeline
+        label_encoder (sklearn.LabelBinarizer): the fitted label encoder
+        model_tag (str): algorithm name of the model
+    Returns:
+        dict: the algorithm name, search type, best parameters and score,
+            classes, save time, and the mean score of every candidate
+    """
+    cv_results = getattr(clf, 'cv_results_', None)
+    if isinstance(cv_results, dict):
+        cv_results = [{'params': params, 'mean_test_score': mean,
+            'std_test_score': std, 'rank_test_score': rank}
+            for params, mean, std, rank in zip(cv_results['params'],
+                cv_results['mean_test_score'], cv_results['std_test_score'],
+                cv_results['rank_test_score'])]
+    return {'algorithm_name': model_tag,
+        'estimator': type(clf).__name__,
+        'best_params': getattr(clf, 'best_params_', None),
+        'best_score': getattr(clf, 'best_score_', None),
+        'classes': list(label_encoder.classes_),
+        'saved': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'cv_results': cv_results}
+
+
+def load_model(pkl_path, alg_id, max_cache_bytes = 4 * 1024 ** 3,
+        mmap_mode = 'r'):
+    """Load a sklearn object from disk saved in binary compressed format, or
+    the best pipeline saved by export_model.
+
+    The file is found through the registry index of the directory, and
+    loaded models are kept in an in-process cache (see registry.load), so
+    loading the same model again does not decompress it again.
 
     Args:
         pkl_path (str): name of the directory to store the pkl files
         alg_id (str): shortname of the algorithm_id for the model
+        max_cache_bytes (int): memory cap for the in-process model cache, 0
+            to always load from disk
+        mmap_mode (str): passed to joblib.load for uncompressed exports, so
+            their arrays are shared read-only with other processes loading
+            the same file
     Returns:
-        sklearn.GridSearchCV or Estimator: uncompressed sklearn model
+        sklearn.GridSearchCV or Estimator: uncompressed sklearn model (the
+            best fitted pipeline for exports)
     """
-    pattern = "id{}_*.pkl.z".format(alg_id)
-    filename = fnmatch.filter(os.listdir(pkl_path), pattern)
-    model_plus_encoder = joblib.load(os.path.join(pkl_path, filename[0]))
+    def loader(path):
+        if path.endswith('.z'):
+            return joblib.load(path)
+        return joblib.load(path, mmap_mode = mmap_mode)
+
+    model_plus_encoder = registry.load(pkl_path, alg_id, loader,
+        max_cache_bytes = max_cache_bytes)
     clf = model_plus_encoder['pipeline']
     encoder = model_plus_encoder['encoder']
     return clf, encoder
@@ -0,0 +1,296 @@
+import sqlalchemy
+import pandas as pd
+import numpy as np
+import fnmatch, logging
+import yaml
+from collections import OrderedDict
+from contextlib import contextmanager
+
+STRING_TYPES = {'char', 'varchar', 'tinytext', 'text', 'mediumtext',
+    'longtext', 'enum', 'set'}
+
+# mysql integer types and the numpy dtypes holding them without nulls
+INTEGER_TYPES = {'tinyint': ('int8', 'uint8'),
+    'smallint': ('int16', 'uint16'),
+    'mediumint': ('int32', 'uint32'),
+    'int': ('int32', 'uint32'),
+    'integer': ('int32', 'uint32'),
+    'bigint': ('int64', 'uint64')}
+
+def null_dtype(dtype):
+    """The float dtype keeping the values of an integer dtype with nulls:
+    float32 for integers of at most 16 bits, which it holds exactly, and
+    float64 otherwise.
+
+    Args:
+        dtype (str or numpy.dtype): the integer dtype
+    Returns:
+        str: 'float32' or 'float64'
+    """
+    return 'float32' if np.dtype(dtype).itemsize <= 2 else 'float64'
+
+def get_column_types(engine, tables):
+    """Looks up the declared types of the columns of a set of tables or views
+    in the information schema.
+
+    Args:
+        engine (sqlalchemy.Engine): a connection to the MySQL database
+        tables (list[str]): full names of the tables or views
+    Returns:
+        Pandas.DataFrame: one row per column with the table_name, column_name,
+            data_type, column_type, is_nullable, numeric_precision and
+            numeric_scale, in table order
+    """
+    column_query = """select table_name, column_name, data_type, column_type,
+        is_nullable, numeric_precision, numeric_scale
+    from information_schema.columns
+    where table_name in ({table_string})
+    and column_name not in ('aamc_id', 'application_year')
+    order by ordinal_position;""".format(
+        table_string = ", ".join("'{}'".format(tbl) for tbl in tables))
+    column_types = pd.read_sql_query(column_query, engine)
+    column_types.columns = column_types.columns.str.lower()
+    return column_types
+
+
+def resolve_dtype(data_type, column_type, nullable, precision = None):
+    """Picks the most compact dtype that holds every value of a MySQL column.
+
+    String columns become categoricals, integers the smallest integer type of
+    their width (or the float of null_dtype when they may be null), FLOAT
+    columns and DECIMAL columns of at most 6 digits float32, and
+    other numeric columns float64. Other columns (such as dates) are left as
+    read.
+
+    Args:
+        data_type (str): the information schema data type, e.g. 'tinyint'
+        column_type (str): the full column type, e.g. 'tinyint(3) unsigned'
+        nullable (bool): whether the column may hold nulls
+        precision (int): the number of digits of DECIMAL columns
+    Returns:
+        str: the dtype, or None to keep the dtype pandas reads
+    """
+    data_type = data_type.lower()
+    if data_type in STRING_TYPES:
+        return 'category'
+    if data_type in INTEGER_TYPES:
+        signed, unsigned = INTEGER_TYPES[data_type]
+        dtype = unsigned if 'unsigned' in column_type.lower() else signed
+        return null_dtype(dtype) if nullable else dtype
+    if data_type == 'float':
+        return 'float32'
+    if data_type == 'decimal' and precision is not None \
+            and not pd.isnull(precision) and precision <= 6:
+        return 'float32'
+    if data_type in ('decimal', 'double', 'real'):
+        return 'float64'
+    return None
+
+
+def read_overrides(filename):
+    """Reads a yaml file of dtype overrides, mapping column names (or
+    fnmatch patterns such as 'mcat_*') to a dtype, or to null to keep the
+    dtype pandas reads.
+
+    Args:
+        filename (str): path to the yaml file
+    Returns:
+        OrderedDict: column patterns and their dtypes, in file order
+    """
+    with open(filename) as f:
+        overrides = yaml.load(f) or {}
+    return OrderedDict(overrides.items())
+
+
+def resolve_dtypes(column_types, overrides = None, nullable_tables = None):
+    """Resolves the dtype of every column of a set of tables from their
+    declared types, with the overrides taking precedence.
+
+    Args:
+        column_types (Pandas.DataFrame): the result of get_column_types
+        overrides (dict): column names or fnmatch patterns and their dtypes,
+            the first matching pattern wins
+        nullable_tables (list[str]): tables whose columns are treated as
+            nullable whatever their declaration, such as the tables left
+            joined onto the keys in a single query
+    Returns:
+        OrderedDict: column names and their dtypes (None to keep the dtype
+            pandas reads)
+    """
+    overrides = overrides or {}
+    nullable_tables = set(nullable_tables or [])
+    dtypes = OrderedDict()
+    for col in column_types.itertuples(index = False):
+        matches = [pattern for pattern in overrides
+            if fnmatch.fnmatchcase(col.column_name, pattern)]
+        if matches:
+            dtypes[col.column_name] = overrides[matches[0]]
+            continue
+        dtypes[col.column_name] = resolve_dtype(col.data_type, col.column_type,
+            nullable = col.is_nullable == 'YES'
+                or col.table_name in nullable_tables,
+            precision = col.numeric_precision)
+    return dtypes
+
+
+def cast_column(values, dtype):
+    """Casts a column to its resolved dtype. Integer columns holding nulls
+    (declared NOT NULL in a view, or introduced by a join) are cast to the
+    float of null_dtype, as nullable integer columns are resolved.
+
+    Args:
+        values (Pandas.Series): the column as read
+        dtype (str): the resolved dtype
+    Returns:
+        Pandas.Series: the cast column
+    """
+    if dtype == 'category':
+        return values if values.dtype.name == 'category' \
+            else values.astype('category')
+    dtype = np.dtype(dtype)
+    if values.dtype == dtype:
+        return values
+    if dtype.kind in 'iu' and values.isnull().any():
+        return values.astype(null_dtype(dtype))
+    return values.astype(dtype)
+
+
+def apply_dtypes(data, dtypes):
+    """Casts the columns of a dataframe to their resolved dtypes. Columns
+    without a resolved dtype are left as they are.
+
+    Args:
+        data (Pandas.DataFrame): the data as read
+        dtypes (dict): column names and their resolved dtypes
+    Returns:
+        Pandas.DataFrame: the data with compact dtypes
+    """
+    cast = OrderedDict((col, cast_column(data[col], dtypes[col])
+        if dtypes.get(col) else data[col]) for col in data)
+    return pd.DataFrame(cast, index = data.index, columns = data.columns)
+
+
+def union_categories(chunks, columns):
+    """Gives the categorical columns of every chunk the same (sorted)
+    categories, so the chunks concatenate into categoricals.
+
+    Args:
+        chunks (list[Pandas.DataFrame]): the chunks read
+        columns (list[str]): the categorical columns
+    Returns:
+        list[Pandas.DataFrame]: the chunks with unified categories
+    """
+    for col in columns:
+        categories = chunks[0][col].cat.categories
+        for chunk in chunks[1:]:
+            categories = categories.union(chunk[col].cat.categories)
+        for chunk in chunks:
+            chunk[col] = chunk[col].cat.set_categories(categories)
+    return chunks
+
+
+@contextmanager
+def connect(connectable):
+    """Yields a connection: a new one from an engine, or the given connection
+    (such as one holding a temporary table), which is left open.
+
+    Args:
+        connectable (sqlalchemy.Engine or sqlalchemy.Connection): the engine,
+            or an open connection
+    Yields:
+        sqlalchemy.Connection: the connection to execute on
+    """
+    if isinstance(connectable, sqlalchemy.engine.Connection):
+        yield connectable
+    else:
+        with connectable.connect() as conn:
+            yield conn
+
+
+def read_sql_compact(query, engine, dtypes, index_col = None,
+        chunksize = 50000, memory = None):
+    """Reads a query in chunks through a server-side cursor, casting each
+    chunk to the resolved dtypes before the next one is read, so the frame
+    pandas would read with float64 and object columns is never held whole.
+
+    Usage:
+        dtypes = resolve_dtypes(get_column_types(engine, [feature_tbl]))
+        memory = dict()
+        feature_data = read_sql_compact(get_features, engine, dtypes,
+            index_col = ['aamc_id', 'application_year'], memory = memory)
+        savings_report(memory)
+
+    Args:
+        query (str): the select query
+        engine (sqlalchemy.Engine or sqlalchemy.Connection): a connection to
+            the MySQL database
+        dtypes (dict): column names and their resolved dtypes
+        index_col (list[str]): columns to use as the index
+        chunksize (int): number of rows read at a time
+        memory (dict): optional dictionary to be filled with the dtype and
+            bytes of each column as read and as cast (see savings_report)
+    Returns:
+        Pandas.DataFrame: the query result with compact dtypes
+    """
+    read_bytes, read_dtypes = dict(), dict()
+    chunks = list()
+    with connect(engine) as conn:
+        streaming = conn.execution_options(stream_results = True)
+        for chunk in pd.read_sql_query(query, streaming,
+                index_col = index_col, chunksize = chunksize):
+            if memory is not None:
+                for col, nbytes in chunk.memory_usage(index = False,
+                        deep = True).items():
+                    read_bytes[col] = read_bytes.get(col, 0) + nbytes
+                    read_dtypes.setdefault(col, chunk[col].dtype.name)
+            chunks.append(apply_dtypes(chunk, dtypes))
+    if not chunks:
+        return apply_dtypes(pd.read_sql_query(query, engine,
+            index_col = index_col), dtypes)
+
+    union_categories(chunks, [col for col in chunks[0]
+        if all(chunk[col].dtype.name == 'category' for chunk in chunks)])
+    data = pd.concat(chunks) if len(chunks) > 1 else chunks[0]
+
+    if memory is not None:
+        for col, nbytes in data.memory_usage(index = False,
+                deep = True).items():
+            memory[col] = {'read_dtype': read_dtypes[col],
+                'dtype': data[col].dtype.name,
+                'read_bytes': read_bytes[col], 'bytes': nbytes}
+    return data
+
+
+def savings_report(memory):
+    """Summarizes the memory saved by the compact dtypes for each column.
+
+    Args:
+        memory (dict): the dictionary filled by read_sql_compact (or by
+            model_data.get_data_for_modeling)
+    Returns:
+        Pandas.DataFrame: indexed by column, with the dtype and bytes as read
+            and as cast, the bytes saved and the fraction of the bytes as read
+            that is kept, largest savings first
+    """
+    report = pd.DataFrame.from_dict(memory, orient = 'index')[
+        ['read_dtype', 'dtype', 'read_bytes', 'bytes']]
+    report['saved_bytes'] = report.read_bytes - report.bytes
+    report['fraction'] = report.bytes / report.read_bytes.astype(float)
+    report.index.name = 'column'
+    return report.sort_values('saved_bytes', ascending = False)
+
+
+def log_savings(memory, description = 'features'):
+    """Logs the total memory saved by the compact dtypes.
+
+    Args:
+        memory (dict): the dictionary filled by read_sql_compact
+        description (str): what was read, for the log message
+    """
+    if not memory:
+        return
+    read_bytes = sum(col['read_bytes'] for col in memory.values())
+    nbytes = sum(col['bytes'] for col in memory.values())
+    logging.info("compact dtypes for {}: {:.1f}MB as read, {:.1f}MB cast "
+        "({:.0%})".format(description, read_bytes / 1024.**2,
+        nbytes / 1024.**2, nbytes / float(read_bytes or 1)))
@@ -0,0 +1,472 @@
+import eduanalytics
+from eduanalytics import model_data, reporting, forest
+import pandas as pd
+import numpy as np
+import json, time, logging, threading, queue
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from argparse import ArgumentParser
+
+def load_production_models(engine, pkl_path, compiled = None):
+    """Loads every algorithm flagged is_production in the algorithm table,
+    the same set of models reported by dashboard_admissions.sql.
+
+    Args:
+        engine (sqlalchemy.Engine): a connection to the MySQL database
+        pkl_path (str): the directory holding the model files
+        compiled (str): 'vectorized' or 'native' to score with
+            forest.CompiledPipeline, or None for the fitted pipeline
+    Returns:
+        OrderedDict: algorithm id as keys, and a dict holding the model
+            ('clf'), label encoder ('lb') and model options ('model_opts')
+            as values
+    """
+    production_query = """select id, algorithm_description
+    from algorithm
+    where is_production = 1
+    order by id"""
+    algorithms = pd.read_sql_query(production_query, engine)
+
+    models = OrderedDict()
+    for alg_id, description in zip(algorithms.id,
+            algorithms.algorithm_description):
+        clf, lb = reporting.load_model(pkl_path, alg_id)
+        if compiled:
+            clf = forest.CompiledPipeline(clf, traversal = compiled)
+        models[int(alg_id)] = {'clf': clf, 'lb': lb,
+            'model_opts': json.loads(description)}
+        logging.info("loaded production model {}".format(alg_id))
+    return models
+
+
+def score_frame(clf, lb, X, alg_id):
+    """Scores applicants with the same math as write_current_predictions.
+
+    Args:
+        clf (sklearn.GridSearchCV/Estimator): the fitted model
+        lb (sklearn.LabelBinarizer): the label encoder of the model
+        X (Pandas.DataFrame): the features of the applicants
+        alg_id (int): the algorithm id of the model
+    Returns:
+        Pandas.DataFrame: predicted_* columns, algorithm_id and score, with
+            the index of X
+    """
+    results = reporting.get_results(clf, X, y = None, lb = lb)
+    return reporting.add_overall_score(results, alg_id)
+
+
+class MicroBatcher(object):
+    """Collects the scoring requests for one model that arrive close together
+    and scores them with a single predict_proba call on a worker thread.
+
+    A batch is scored as soon as it holds max_batch_rows rows, or max_wait
+    seconds after its first request arrived. Requests submitted after the
+    batcher is closed (by a reload racing a request) are scored right away
+    on the submitting thread.
+
+    Usage:
+        batcher = MicroBatcher(clf, lb, alg_id)
+        results = batcher.submit(X).result()
+
+    Args:
+        clf (sklearn.GridSearchCV/Estimator): the fitted model
+        lb (sklearn.LabelBinarizer): the label encoder of the model
+        alg_id (int): the algorithm id of the model
+        max_batch_rows (int): maximum number of rows scored at once
+        max_wait (float): seconds to wait for more requests to batch
+    """
+    def __init__(self, clf, lb, alg_id, max_batch_rows = 512,
+            max_wait = .005):
+        self.clf = clf
+        self.lb = lb
+        self.alg_id = alg_id
+        self.max_batch_rows = max_batch_rows
+        self.max_wait = max_wait
+        self.batch_sizes = deque(maxlen = 1000)
+        self._closed = False
+        self._lock = threading.Lock()
+        self._requests = queue.Queue()
+        self._worker = threading.Thread(target = self._run, daemon = True)
+        self._worker.start()
+
+    def submit(self, X):
+        """Queues the rows of X to be scored.
+
+        Args:
+            X (Pandas.DataFrame): the features of the applicants
+        Returns:
+            concurrent.futures.Future: resolves to the scores of X
+        """
+        future = Future()
+        with self._lock:
+            if not self._closed:
+                self._requests.put((X, future))
+                return future
+        self._score([(X, future)])
+        return future
+
+    def close(self):
+        """Stops the worker thread once the queued requests are scored."""
+        with self._lock:
+            self._closed = True
+            self._requests.put(None)
+
+    def _run(self):
+        while True:
+            request = self._requests.get()
+            if request is None:
+                return
+            batch = [request]
+            n_rows = batch[0][0].shape[0]
+            deadline = time.time() + self.max_wait
+            while n_rows < self.max_batch_rows:
+                try:
+                    request = self._requests.get(
+                        timeout = max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    self._requests.put(None)
+                    break
+                batch.append(request)
+                n_rows += request[0].shape[0]
+            self._score(batch)
+
+    def _score(self, batch):
+        frames = [X for X, _ in batch]
+        try:
+            # positional index, since requests may repeat applicants
+            X = pd.concat(frames, ignore_index = True) if len(frames) > 1 \
+                else frames[0]
+            results = score_frame(self.clf, self.lb, X, self.alg_id)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        self.batch_sizes.append(X.shape[0])
+        start = 0
+        for frame, future in batch:
+            scores = results.iloc[start:start + frame.shape[0]]
+            scores.index = frame.index
+            future.set_result(scores)
+            start += frame.shape[0]
+
+
+class LatencyTracker(object):
+    """Keeps the latency of the most recent requests for the metrics
+    endpoint.
+
+    Args:
+        maxlen (int): number of recent requests kept
+    """
+    def __init__(self, maxlen = 10000):
+        self.latencies = deque(maxlen = maxlen)
+        self.n_requests = 0
+        self.n_errors = 0
+        self.lock = threading.Lock()
+
+    def record(self, seconds, error = False):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.n_requests += 1
+            self.n_errors += int(error)
+
+    def summary(self):
+        """Summarizes the recent request latencies.
+
+        Returns:
+            dict: request and error counts, and the mean, median, 95th and
+                99th percentile, and maximum latency in milliseconds
+        """
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            summary = {'n_requests': self.n_requests,
+                'n_errors': self.n_errors}
+        if latencies.size:
+            summary.update({'mean_ms': latencies.mean(),
+                'p50_ms': np.percentile(latencies, 50),
+                'p95_ms': np.percentile(latencies, 95),
+                'p99_ms': np.percentile(latencies, 99),
+                'max_ms': latencies.max()})
+        return summary
+
+
+class ScoringService(object):
+    """Keeps the production models loaded and scores feature rows or
+    applicant keys on request.
+
+    Usage:
+        service = ScoringService(engine, pkl_path)
+        service.score({'algorithm_id': 12,
+            'keys': [[12345678, 2018]]})
+
+    Args:
+        engine (sqlalchemy.Engine): a connection to the MySQL database, used
+            to find the production models and to pull features for keys
+        pkl_path (str): the directory holding the model files
+        compiled (str): 'vectorized' or 'native' to score with
+            forest.CompiledPipeline, or None for the fitted pipeline
+        max_batch_rows (int): maximum number of rows scored at once
+        max_wait (float): seconds to wait for more requests to batch
+        compact (bool): whether to pull the features of keys with the compact
+            dtypes of model_data.pull_model_matrix
+    """
+    def __init__(self, engine, pkl_path, compiled = None,
+            max_batch_rows = 512, max_wait = .005, compact = False):
+        self.engine = engine
+        self.pkl_path = pkl_path
+        self.compiled = compiled
+        self.compact = compact
+        self.max_batch_rows = max_batch_rows
+        self.max_wait = max_wait
+        self.latency = LatencyTracker()
+        self.lock = threading.Lock()
+        self.models, self.batchers = OrderedDict(), dict()
+        self.reload()
+
+    def reload(self):
+        """Reloads the production models, for instance after is_production
+        changes in the algorithm table. The new models and their batchers are
+        built first and swapped in together, so the loaded models keep
+        serving requests if loading fails.
+
+        Returns:
+            list[int]: the algorithm ids of the loaded models
+        """
+        models = load_production_models(self.engine, self.pkl_path,
+            self.compiled)
+        batchers = {alg_id: MicroBatcher(model['clf'], model['lb'],
+            alg_id, self.max_batch_rows, self.max_wait)
+            for alg_id, model in models.items()}
+        with self.lock:
+            old_batchers = self.batchers
+            self.models, self.batchers = models, batchers
+        for batcher in old_batchers.values():
+            batcher.close()
+        return list(models.keys())
+
+    def score(self, request):
+        """Scores one request for one or all of the production models.
+
+        Args:
+            request (dict): 'rows' (a list of dicts of raw feature values, as
+                pulled by model_data.get_data_for_prediction, which may
+                include aamc_id and application_year) or 'keys' (a list of
+                [aamc_id, application_year] pairs to pull from the database),
+                and optionally 'algorithm_id' (all production models if
+                missing)
+        Returns:
+            dict: 'predictions', a list of records with the applicant
+                keys (or the row position), algorithm_id, predicted_* and
+                score for each applicant and model
+        """
+        with self.lock:
+            models, batchers = self.models, self.batchers
+        alg_ids = [int(request['algorithm_id'])] \
+            if request.get('algorithm_id') is not None \
+            else list(models.keys())
+        unknown = [alg_id for alg_id in alg_ids if alg_id not in models]
+        if unknown:
+            raise ValueError("not a production algorithm: {}".format(unknown))
+
+        shared_features = self.pull_key_features(request['keys'],
+            [models[alg_id]['model_opts'] for alg_id in alg_ids]) \
+            if 'keys' in request else None
+        futures = []
+        for alg_id in alg_ids:
+            X = self.get_features(request, models[alg_id]['model_opts'],
+                shared_features)
+            if X.shape[0]:
+                futures.append(batchers[alg_id].submit(X))
+        predictions = []
+        for future in futures:
+            results = future.result()
+            predictions.extend(json.loads(results.reset_index().to_json(
+                orient = 'records')))
+        return {'predictions': predictions}
+
+    def pull_key_features(self, keys, model_opts_list):
+        """Pulls every feature table used by the given models once for the
+        keys of a request, as model_data.pull_shared_features does for the
+        specs of a run.
+
+        Args:
+            keys (list[list]): [aamc_id, application_year] pairs
+            model_opts_list (list[dict]): the model options of each model
+        Returns:
+            OrderedDict(pandas.DataFrame): full feature table names as keys
+                and the pulled features for the keys as values
+        """
+        keys_query = model_data.build_keys_query(
+            [tuple(key) for key in keys])
+        features_dict, _ = model_data.plan_shared_pull(model_opts_list,
+            [keys_query])
+        features = model_data.loop_through_features(self.engine,
+            features_dict, subquery = keys_query, compact = self.compact)
+        return OrderedDict(
+            ("vw$features${}".format(tbl_name), feature_data)
+            for tbl_name, feature_data in zip(features_dict, features))
+
+    def get_features(self, request, model_opts, shared_features = None):
+        """Builds the feature frame of a request for one model.
+
+        Args:
+            request (dict): the request, see score()
+            model_opts (dict): the model options of the model
+            shared_features (OrderedDict): the feature tables pulled for the
+                keys of the request by pull_key_features
+        Returns:
+            Pandas.DataFrame: raw features indexed by applicant keys, or by
+                row position when rows come without keys
+        """
+        if 'keys' in request:
+            features = model_data.select_spec_features(shared_features,
+                model_opts['features'])
+            X = features[0].join(features[1:])
+            return model_data.restore_dtypes(X, features) if self.compact \
+                else X
+        X = pd.DataFrame(request['rows'])
+        if {'aamc_id', 'application_year'}.issubset(X.columns):
+            X = X.set_index(['aamc_id', 'application_year'])
+        X.index.names = [name or 'row' for name in X.index.names]
+        return X
+
+
+def make_handler(service):
+    """Builds the HTTP request handler class serving a ScoringService.
+
+    Endpoints:
+        POST /score: a json request as described in ScoringService.score
+        POST /reload: reload the production models
+        GET /health: the loaded algorithm ids
+        GET /metrics: request latency and batch size summaries
+
+    Args:
+        service (ScoringService): the service to expose
+    Returns:
+        type: a BaseHTTPRequestHandler subclass
+    """
+    class ScoringHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/health':
+                self.send_json(200, {'algorithm_ids': list(service.models)})
+            elif self.path == '/metrics':
+                metrics = service.latency.summary()
+                metrics['batch_rows'] = {str(alg_id): {
+                    'n_batches': len(batcher.batch_sizes),
+                    'mean_rows': float(np.mean(batcher.batch_sizes))
+                        if batcher.batch_sizes else None}
+                    for alg_id, batcher in service.batchers.items()}
+                self.send_json(200, metrics)
+            else:
+                self.send_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            start_time = time.time()
+            if self.path == '/reload':
+                try:
+                    self.send_json(200, {'algorithm_ids': service.reload()})
+                except Exception as e:
+                    logging.exception('reload failed, keeping the loaded models')
+                    self.send_json(500, {'error': str(e)})
+                return
+            if self.path != '/score':
+                self.send_json(404, {'error': 'not found'})
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length).decode('utf-8'))
+                response = service.score(request)
+                status = 200
+            except (ValueError, KeyError) as e:
+                response, status = {'error': str(e)}, 400
+            except Exception as e:
+                logging.exception('scoring request failed')
+                response, status = {'error': str(e)}, 500
+            latency = time.time() - start_time
+            service.latency.record(latency, error = status != 200)
+            response['latency_ms'] = latency * 1000
+            self.send_json(status, response)
+
+        def send_json(self, status, body):
+            data = json.dumps(body, default = str).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    return ScoringHandler
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(service, host = '127.0.0.1', port = 8765):
+    """Serves a ScoringService over HTTP until interrupted.
+
+    Args:
+        service (ScoringService): the service to expose
+        host (str): the interface to bind, local only by default
+        port (int): the port to listen on
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    logging.info("scoring service listening on {}:{}".format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main(args=None):
+    parser = ArgumentParser()
+    parser.add_argument('--credpath', dest = 'path',
+        default = eduanalytics.credentials_path,
+        help = 'Path to the db credentials file')
+    parser.add_argument('--credgroup', dest = 'group',
+        default = eduanalytics.credentials_group,
+        help = 'Name of group for db credentials file')
+    parser.add_argument('--pkldir', dest = 'pkldir',
+        default = eduanalytics.pkl_path,
+        help = 'Path to the binary compressed model files')
+    parser.add_argument('--host', dest = 'host',
+        default = '127.0.0.1',
+        help = 'Interface to bind the service to')
+    parser.add_argument('--port', dest = 'port',
+        type = int, default = 8765,
+        help = 'Port to listen on')
+    parser.add_argument('--compiled', dest = 'compiled',
+        nargs = '?', const = 'vectorized', default = None,
+        choices = ['native', 'vectorized'],
+        help = 'Score with the compiled forest (see forest.CompiledPipeline)')
+    parser.add_argument('--batchrows', dest = 'max_batch_rows',
+        type = int, default = 512,
+        help = 'Maximum number of rows scored in one batch')
+    parser.add_argument('--batchwait', dest = 'max_wait',
+        type = float, default = .005,
+        help = 'Seconds to wait for more requests to batch together')
+    parser.add_argument('--compact', dest = 'compact',
+        default = False, action = 'store_true',
+        help = 'Pull features with compact dtypes resolved from the schema')
+    args = parser.parse_args(args)
+
+    logging.basicConfig(format = "%(asctime)s\t %(message)s",
+        level = logging.INFO, datefmt = "%m/%d/%y %I:%M:%S %p")
+
+    service = ScoringService(
+        model_data.connect_to_database(args.path, args.group),
+        args.pkldir, compiled = args.compiled,
+        max_batch_rows = args.max_batch_rows, max_wait = args.max_wait,
+        compact = args.compact)
+    serve(service, args.host, args.port)
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,23 @@
 import eduanalytics
-from eduanalytics import model_data, pipeline_tools, reporting
+from eduanalytics import model_data, pipeline_tools, reporting, ledger, schema
 
-import re, os, sys, logging
+import re, os, sys, logging, time, itertools, multiprocessing
+import multiprocessing.connection
 import pandas as pd
 import numpy as np
 
-from sklearn.pipeline import make_pipeline
-from sklearn import ensemble, feature_selection, preprocessing
-from sklearn.model_selection import GridSearchCV #RandomizedSearchCV
 from argparse import ArgumentParser
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 
 def fit_pipeline(model_matrix, grid_path, pkldir,
     alg_id = 'debug', alg_name = 'screening_rf',
     scoring = 'roc_auc', # 'f1_micro',
-    write_predictions = True, path = None, group = None):
+    write_predictions = True, path = None, group = None,
+    write_method = 'to_sql', batch_size = 1000, transformer_cache = None,
+    search = None, n_iter = None, n_jobs = -1, slim = False,
+    explainer = False):
     """Train a new model over a grid search and optionally write train and test
     set predictions to the database.
 
@@ -35,19 +38,42 @@ def fit_pipeline(model_matrix, grid_path, pkldir,
         path (str): credentials path to reconnect to the database in order to
             output predictions on train and test set
         group (str): credentials group to reconnect to the database
+        write_method (str): 'to_sql', 'insert' or 'infile' for writing the
+            train and test set predictions (see reporting.write_results)
+        batch_size (int): number of rows in each insert for bulk writes
+        transformer_cache (str): 'memory' or a directory path to cache fitted
+            preprocessing steps across the grid (see CachedPipeline), or
+            None to refit them for every grid point
+        search (str): 'grid' (exhaustive), 'random' (n_iter sampled
+            candidates) or 'halving' (successive halving), overriding the
+            strategy in the search block of the grid yaml
+        n_iter (int): number of candidates for 'random' and 'halving',
+            overriding n_iter in the grid yaml
+        n_jobs (int): number of cores for the search, -1 for all of them
+        slim (bool): whether to save only the best fitted pipeline,
+            uncompressed, with the search metadata in a json file
+            (see reporting.export_model)
+        explainer (bool): whether to save a LIME explainer built from the
+            training data next to the model (see lime.save_explainer)
     Returns:
         (GridSearchCV, LabelBinarizer)
     """
+    # imported here so that predict-only runs do not load the estimators
+    from sklearn.pipeline import make_pipeline
+    from sklearn import ensemble, feature_selection, preprocessing
 
     pipeline = make_pipeline(pipeline_tools.DummyEncoder(),
             preprocessing.Imputer(),
             feature_selection.VarianceThreshold(),
             ensemble.RandomForestClassifier(random_state = 1100))
+    if transformer_cache:
+        pipeline = pipeline_tools.CachedPipeline(pipeline.steps,
+            cache_dir = None if transformer_cache == 'memory'
+            else transformer_cache)
     param_grid = pipeline_tools.build_param_grid(pipeline, grid_path)
-    grid_search = GridSearchCV(pipeline, n_jobs = -1, cv = 5,
-        param_grid = param_grid, scoring = scoring,
-        # verbose output suppressed during multiprocessing
-        verbose = 1) # show folds and model fits as they complete
+    grid_search = build_search(pipeline, param_grid,
+        pipeline_tools.read_search_options(grid_path),
+        scoring = scoring, search = search, n_iter = n_iter, n_jobs = n_jobs)
 
     # Adjust test_size for debugging runs
     X_train, X_test, y_train, y_test, lb = model_data.split_data(
@@ -58,17 +84,256 @@ def fit_pipeline(model_matrix, grid_path, pkldir,
         grid_search.fit(X_train, y_train)
 
     logging.info(reporting.pickle_model(grid_search,
-        pkldir, lb, alg_id, model_tag = alg_name))
+        pkldir, lb, alg_id, model_tag = alg_name, slim = slim))
+    if explainer:
+        from eduanalytics import lime
+        logging.info(lime.save_explainer(grid_search, X_train, lb,
+            pkldir, alg_id, alg_name))
 
     if write_predictions:
-        engine = model_data.connect_to_database(path, group)
+        engine = model_data.connect_to_database(path, group,
+            local_infile = write_method == 'infile')
         train_results = reporting.get_results(grid_search, X_train, y_train, lb)
         test_results = reporting.get_results(grid_search, X_test, y_test, lb)
         logging.info(reporting.output_predictions(
-            train_results, test_results, engine, alg_id = alg_id))
+            train_results, test_results, engine, alg_id = alg_id,
+            write_method = write_method, batch_size = batch_size))
     return grid_search, lb
 
 
+def build_search(pipeline, param_grid, search_opts, scoring = 'roc_auc',
+        search = None, n_iter = None, n_jobs = -1):
+    """Builds the hyperparameter search object for the pipeline.
+
+    Args:
+        pipeline (sklearn.Pipeline): the modeling pipeline
+        param_grid (dict): parameter options from build_param_grid
+        search_opts (dict): the search block of the grid options yaml file
+        scoring (str): scoring metric for the search
+        search (str): 'grid', 'random' or 'halving', overrides search_opts
+        n_iter (int): number of candidates, overrides search_opts
+        n_jobs (int): number of cores for the search, -1 for all of them
+    Returns:
+        GridSearchCV, RandomizedSearchCV or SuccessiveHalvingSearch: the
+            unfitted search object
+    """
+    from sklearn.model_selection import GridSearchCV, RandomizedSearchCV, \
+        ParameterGrid
+    strategy = search or search_opts.get('strategy', 'grid')
+    n_iter = n_iter or search_opts.get('n_iter')
+    logging.info('using {} search'.format(strategy))
+
+    if strategy == 'grid':
+        return GridSearchCV(pipeline, n_jobs = n_jobs, cv = 5,
+            param_grid = param_grid, scoring = scoring,
+            # verbose output suppressed during multiprocessing
+            verbose = 1) # show folds and model fits as they complete
+    elif strategy == 'random':
+        # the sampler cannot draw more candidates than the grid has
+        n_iter = min(n_iter or 20, len(ParameterGrid(param_grid)))
+        return RandomizedSearchCV(pipeline, n_jobs = n_jobs, cv = 5,
+            param_distributions = param_grid, n_iter = n_iter,
+            scoring = scoring, random_state = 1100, verbose = 1)
+    elif strategy == 'halving':
+        return pipeline_tools.SuccessiveHalvingSearch(pipeline, param_grid,
+            resource = search_opts.get('resource',
+                'randomforestclassifier__n_estimators'),
+            min_resource = search_opts.get('min_resource', 10),
+            max_resource = search_opts.get('max_resource'),
+            eta = search_opts.get('eta', 3),
+            n_candidates = n_iter, cv = 5, scoring = scoring, n_jobs = n_jobs)
+    raise ValueError('unknown search strategy: {}'.format(strategy))
+
+
+def pull_model_data(dyaml, args, shared_features = None):
+    """Pulls the model matrix for one model spec with the data options from
+    the command line.
+
+    Args:
+        dyaml (str): path to the model data yaml file
+        args (argparse.Namespace): the parsed command line arguments
+        shared_features (OrderedDict): feature tables already pulled for all
+            the specs (see model_data.pull_shared_features)
+    Returns:
+        (pandas.DataFrame, int, str): model matrix, algorithm id and name
+    """
+    return model_data.get_data_for_modeling(
+        filename = dyaml,
+        # by default, sqlalchemy.create_engine has no default timeout
+        engine = model_data.connect_to_database(args.path, args.group,
+            pool_size = max(5, args.fetch_jobs)),
+        cache_dir = args.cache_dir, n_jobs = args.fetch_jobs,
+        single_query = args.single_query,
+        materialize = args.materialize, shared_features = shared_features,
+        compact = args.compact, dtype_overrides = dtype_overrides(args))
+
+
+def dtype_overrides(args):
+    """Reads the dtype overrides named on the command line, if any.
+
+    Args:
+        args (argparse.Namespace): the parsed command line arguments
+    Returns:
+        OrderedDict: column patterns and their dtypes, or None
+    """
+    if not args.dtype_path:
+        return None
+    return schema.read_overrides(args.dtype_path)
+
+
+def fit_options(args):
+    """Collects the fit_pipeline keyword arguments from the command line.
+
+    Args:
+        args (argparse.Namespace): the parsed command line arguments
+    Returns:
+        dict: keyword arguments for fit_pipeline
+    """
+    return dict(path = args.path, group = args.group,
+        write_method = args.write_method, batch_size = args.batch_size,
+        transformer_cache = args.transformer_cache,
+        search = args.search, n_iter = args.n_iter, slim = args.slim,
+        explainer = args.explainer)
+
+
+def timed_pull(dyaml, args, shared_features = None):
+    """Runs pull_model_data and records how long the pull took.
+
+    Returns:
+        (pandas.DataFrame, int, str, float): model matrix, algorithm id and
+            name, and the pull time in seconds
+    """
+    start_time = time.time()
+    model_matrix, alg_id, alg_name = pull_model_data(dyaml, args,
+        shared_features)
+    return model_matrix, alg_id, alg_name, time.time() - start_time
+
+
+def fit_worker(model_matrix, grid_path, pkldir, alg_id, alg_name, options):
+    """Entry point of a scheduled fit process. The fitted search is saved by
+    fit_pipeline to the pickle directory, so nothing is returned."""
+    logging.basicConfig(format = "%(asctime)s\t %(message)s",
+        level = logging.DEBUG, datefmt = "%m/%d/%y %I:%M:%S %p")
+    fit_pipeline(model_matrix, grid_path, pkldir, alg_id, alg_name,
+        **options)
+
+
+def submit_next(pool, pulls, upcoming, args, shared_features = None):
+    """Submits the pull of the next spec, if any, to the pull thread pool.
+
+    Args:
+        pool (ThreadPoolExecutor): the pull thread pool
+        pulls (collections.deque): (yaml path, future) pairs of the submitted
+            pulls, in spec order
+        upcoming (iterator): the yaml paths of the specs not yet submitted
+        args (argparse.Namespace): the parsed command line arguments
+        shared_features (OrderedDict): see schedule_training
+    """
+    dyaml = next(upcoming, None)
+    if dyaml is not None:
+        pulls.append((dyaml, pool.submit(timed_pull, dyaml, args,
+            shared_features)))
+
+
+def schedule_training(data_yamls, args, n_cores = None, n_concurrent = 2,
+        shared_features = None):
+    """Trains a model for each spec, overlapping the database pulls of the
+    upcoming specs with the fitting of the current ones.
+
+    Pulls run on a thread pool. The first n_concurrent start with the
+    scheduler, and each later one starts when an earlier model matrix is
+    handed to its fit, so at most n_concurrent pulled matrices wait in memory
+    for a fit slot. Each fit runs in its own (non-daemon) process so that its search can still use
+    multiprocessing, and the core budget is split evenly between the fits
+    running at the same time.
+
+    Usage:
+        timings = schedule_training(['all_features_non_urm.yaml',
+            'all_features_urm.yaml'], args, n_cores = 16, n_concurrent = 2)
+
+    Args:
+        data_yamls (list[str]): paths to the model data yaml files
+        args (argparse.Namespace): the parsed command line arguments
+        n_cores (int): total number of cores to use for fitting, defaults to
+            all of the machine's cores
+        n_concurrent (int): maximum number of searches fitting at once, also
+            the number of concurrent database pulls
+        shared_features (OrderedDict): feature tables already pulled for all
+            the specs, so each spec only pulls its outcomes
+    Returns:
+        pandas.DataFrame: pull, wait and fit seconds and the exit status for
+            each spec, indexed by the yaml file path
+    """
+    n_cores = n_cores or multiprocessing.cpu_count()
+    n_concurrent = max(1, min(n_concurrent, len(data_yamls), n_cores))
+    cores_per_fit = max(1, n_cores // n_concurrent)
+    logging.info('scheduling {} specs, {} at a time with {} cores each'.format(
+        len(data_yamls), n_concurrent, cores_per_fit))
+
+    timings = OrderedDict()
+    running = {}
+
+    def reap(block):
+        sentinels = [process.sentinel for process in running]
+        if not sentinels:
+            return
+        ready = multiprocessing.connection.wait(sentinels,
+            timeout = None if block else 0)
+        for process in [process for process in running
+                if process.sentinel in ready]:
+            process.join()
+            dyaml, start_time = running.pop(process)
+            timings[dyaml]['fit_seconds'] = time.time() - start_time
+            timings[dyaml]['status'] = 'ok' if process.exitcode == 0 \
+                else 'failed ({})'.format(process.exitcode)
+            logging.info('finished fitting {} in {:.1f}s: {}'.format(dyaml,
+                timings[dyaml]['fit_seconds'], timings[dyaml]['status']))
+
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers = n_concurrent) as pool:
+        # at most n_concurrent pulls are in flight or waiting for a fit slot,
+        # so finished model matrices do not pile up in memory
+        upcoming = iter(data_yamls)
+        pulls = deque((dyaml, pool.submit(timed_pull, dyaml, args,
+            shared_features))
+            for dyaml in itertools.islice(upcoming, n_concurrent))
+        while pulls:
+            dyaml, pull = pulls.popleft()
+            waited = time.time()
+            try:
+                model_matrix, alg_id, alg_name, pull_seconds = pull.result()
+            except Exception:
+                logging.exception('failed to pull data for {}'.format(dyaml))
+                timings[dyaml] = {'status': 'pull failed'}
+                submit_next(pool, pulls, upcoming, args, shared_features)
+                continue
+            while len(running) >= n_concurrent:
+                reap(block = True)
+            timings[dyaml] = {'alg_id': alg_id, 'alg_name': alg_name,
+                'pull_seconds': pull_seconds,
+                'wait_seconds': time.time() - waited}
+
+            process = multiprocessing.Process(target = fit_worker,
+                args = (model_matrix, args.grid_path, args.pkldir, alg_id,
+                alg_name, dict(fit_options(args), n_jobs = cores_per_fit)))
+            process.start()
+            running[process] = (dyaml, time.time())
+            del model_matrix
+            submit_next(pool, pulls, upcoming, args, shared_features)
+            reap(block = False)
+    while running:
+        reap(block = True)
+
+    timings = pd.DataFrame.from_dict(timings, orient = 'index').reindex(
+        data_yamls)
+    logging.info('trained {} specs in {:.1f}s, sum of stages {:.1f}s\n{}'.format(
+        len(data_yamls), time.time() - start_time,
+        timings.filter(regex = 'pull_seconds|fit_seconds').sum().sum(),
+        timings.to_string()))
+    return timings
+
+
+
 def main(args=None):
     parser = ArgumentParser()
     parser.add_argument('--dyaml', dest = 'data_yaml',
@@ -86,6 +351,71 @@ def main(args=None):
     parser.add_argument('--pkldir', dest = 'pkldir',
         default = eduanalytics.pkl_path,
         help = 'Path to store binary compressed model files')
+    parser.add_argument('--cachedir', dest = 'cache_dir',
+        default = None,
+        help = 'Path to cache historical feature tables between fits')
+    parser.add_argument('--fetchjobs', dest = 'fetch_jobs',
+        type = int, default = 1,
+        help = 'Number of feature tables to pull from the db concurrently')
+    parser.add_argument('--singlequery', dest = 'single_query',
+        default = False, action = 'store_true',
+        help = 'Pull only the included feature columns in one joined query')
+    parser.add_argument('--materialize', dest = 'materialize',
+        default = False, action = 'store_true',
+        help = 'Materialize cohort keys into an indexed temporary table for '
+        'each pull (pulls its feature tables serially)')
+    parser.add_argument('--sharedpull', dest = 'shared_pull',
+        default = False, action = 'store_true',
+        help = 'Pull each feature table once for all of the --dyaml specs')
+    parser.add_argument('--compact', dest = 'compact',
+        default = False, action = 'store_true',
+        help = 'Read features with compact dtypes resolved from the schema')
+    parser.add_argument('--dtypes', dest = 'dtype_path',
+        default = None,
+        help = 'Path to a yaml file of dtype overrides for --compact')
+    parser.add_argument('--ledger', dest = 'use_ledger',
+        default = False, action = 'store_true',
+        help = 'Find applicants still to be scored with the scoring ledger')
+    parser.add_argument('--compiled', dest = 'compiled',
+        nargs = '?', const = 'vectorized', default = None,
+        choices = ['native', 'vectorized'],
+        help = 'Score with the compiled forest (see forest.CompiledPipeline)')
+    parser.add_argument('--chunksize', dest = 'chunksize',
+        type = int, default = None,
+        help = 'Stream new predictions in chunks of this many applicants')
+    parser.add_argument('--writemethod', dest = 'write_method',
+        default = 'to_sql', choices = ['to_sql', 'insert', 'infile'],
+        help = 'How predictions are written to the db')
+    parser.add_argument('--batchsize', dest = 'batch_size',
+        type = int, default = 1000,
+        help = 'Rows per insert statement for bulk writes')
+    parser.add_argument('--transformercache', dest = 'transformer_cache',
+        default = None,
+        help = "'memory' or a directory to cache fitted preprocessing steps")
+    parser.add_argument('--search', dest = 'search',
+        default = None, choices = ['grid', 'random', 'halving'],
+        help = 'Hyperparameter search strategy (default from grid yaml)')
+    parser.add_argument('--niter', dest = 'n_iter',
+        type = int, default = None,
+        help = 'Number of candidates for random or halving search')
+    parser.add_argument('--schedule', dest = 'schedule',
+        default = False, action = 'store_true',
+        help = 'Overlap data pulls and fits of the --dyaml specs')
+    parser.add_argument('--cores', dest = 'n_cores',
+        type = int, default = None,
+        help = 'Total cores for scheduled fits (default all cores)')
+    parser.add_argument('--concurrent', dest = 'n_concurrent',
+        type = int, default = 2,
+        help = 'Number of scheduled searches to fit at the same time')
+    parser.add_argument('--timingpath', dest = 'timing_path',
+        default = None,
+        help = 'Path to write the per-spec timing summary of a schedule')
+    parser.add_argument('--slim', dest = 'slim',
+        default = False, action = 'store_true',
+        help = 'Save only the best pipeline, uncompressed for memory-mapping')
+    parser.add_argument('--explainer', dest = 'explainer',
+        default = False, action = 'store_true',
+        help = 'Save a LIME explainer with each model (see lime.save_explainer)')
     parser.add_argument('--fit', dest = 'train_model',
         default = False, action = 'store_true',
         help = 'Train the model from scratch')
@@ -102,31 +432,77 @@ def main(args=None):
 
     #engine = model_data.connect_to_database(args.path, args.group)
 
-    if args.train_model:
+    data_yamls = args.data_yaml
+    shared_features = None
+    if args.train_model and args.shared_pull:
+        shared_features = model_data.pull_shared_features(args.data_yaml,
+            model_data.connect_to_database(args.path, args.group,
+                pool_size = max(5, args.fetch_jobs)),
+            cache_dir = args.cache_dir, n_jobs = args.fetch_jobs,
+            materialize = args.materialize, compact = args.compact,
+            dtype_overrides = dtype_overrides(args))
+
+    if args.train_model and args.schedule:
+        timings = schedule_training(args.data_yaml, args,
+            n_cores = args.n_cores, n_concurrent = args.n_concurrent,
+            shared_features = shared_features)
+        if args.timing_path:
+            timings.to_csv(args.timing_path)
+        fitted = timings[timings['status'] == 'ok']
+        data_yamls = list(fitted.index)
+        alg_id_list = [int(alg_id) for alg_id in fitted.get('alg_id', [])]
+        if args.predict_new:
+            pipelines = [reporting.load_model(args.pkldir, alg_id)
+                for alg_id in alg_id_list]
+    elif args.train_model:
         alg_id_list = []
         pipelines = []
         for dyaml in args.data_yaml:
-            model_matrix, alg_id, alg_name = model_data.get_data_for_modeling(
-                filename = dyaml,
-                # by default, sqlalchemy.create_engine has no default timeout
-                engine = model_data.connect_to_database(args.path, args.group))
+            model_matrix, alg_id, alg_name = pull_model_data(dyaml, args,
+                shared_features)
             alg_id_list.append(alg_id)
             pipelines.append(
                 fit_pipeline(model_matrix, args.grid_path,
-                args.pkldir, alg_id, alg_name,
-                path = args.path, group = args.group))
+                args.pkldir, alg_id, alg_name, **fit_options(args)))
     else:
         alg_id_list = args.alg_id
         pipelines = [reporting.load_model(args.pkldir, alg_id)
             for alg_id in alg_id_list]
 
+    shared_features = None
+    if args.predict_new and args.shared_pull and not args.chunksize:
+        engine = model_data.connect_to_database(args.path, args.group,
+            pool_size = max(5, args.fetch_jobs))
+        shared_features = model_data.pull_shared_features(data_yamls, engine,
+            fit_or_predict = 'predict', algorithm_ids = alg_id_list,
+            n_jobs = args.fetch_jobs, materialize = args.materialize,
+            compact = args.compact, dtype_overrides = dtype_overrides(args),
+            ledger_tbl = ledger.ensure_ledger(engine,
+                "out$predictions$screening_current_cohort")
+                if args.use_ledger else None)
+
+    if args.predict_new and args.compiled:
+        from eduanalytics import forest
+        pipelines = [(forest.CompiledPipeline(pipeline[0],
+            traversal = args.compiled), pipeline[1])
+            for pipeline in pipelines]
+
     if args.predict_new:
         for pipeline, dyaml, alg_id in zip(
-                pipelines, args.data_yaml, alg_id_list):
+                pipelines, data_yamls, alg_id_list):
             logging.info(reporting.write_current_predictions(
                 pipeline[0], filename = dyaml,
-                conn = model_data.connect_to_database(args.path, args.group),
-                label_encoder = pipeline[1], alg_id = alg_id))
+                conn = model_data.connect_to_database(args.path, args.group,
+                    pool_size = max(5, args.fetch_jobs),
+                    local_infile = args.write_method == 'infile'),
+                label_encoder = pipeline[1], alg_id = alg_id,
+                n_jobs = args.fetch_jobs, single_query = args.single_query,
+                materialize = args.materialize, chunksize = args.chunksize,
+                write_method = args.write_method,
+                batch_size = args.batch_size,
+                shared_features = shared_features,
+                use_ledger = args.use_ledger, compact = args.compact,
+                dtype_overrides = dtype_overrides(args)))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,82 @@
+import sqlalchemy
+import io
+import pandas as pd
+import numpy as np
+from sqlalchemy.pool import StaticPool
+from eduanalytics import bulk_write
+
+def sqlite_engine():
+    """An in-memory SQLite database shared by every connection of the
+    engine."""
+    return sqlalchemy.create_engine('sqlite://',
+        connect_args = {'check_same_thread': False}, poolclass = StaticPool)
+
+
+def test_write_frame_insert_round_trip():
+    index = pd.MultiIndex.from_arrays([[101, 102, 103, 104],
+        [2015, 2015, 2016, 2016]], names = ['aamc_id', 'application_year'])
+    frame = pd.DataFrame({'pred_prob': [.25, .5, np.nan, .75],
+        'label': ['a', 'b', None, 'd'],
+        'model_id': [1, 1, 2, 2]}, index = index,
+        columns = ['pred_prob', 'label', 'model_id'])
+    engine = sqlite_engine()
+
+    bulk_write.write_frame(frame, 'out$predictions', engine,
+        method = 'insert', batch_size = 3)
+
+    result = pd.read_sql_query("select * from `out$predictions` "
+        "order by aamc_id", engine,
+        index_col = ['aamc_id', 'application_year'])
+    pd.testing.assert_frame_equal(result, frame, check_dtype = False)
+
+
+def test_write_frame_appends_in_batches():
+    frame = pd.DataFrame({'aamc_id': range(10), 'score': np.arange(10.)})
+    engine = sqlite_engine()
+
+    bulk_write.write_frame(frame, 'scores', engine, method = 'insert',
+        batch_size = 4, index = False)
+    bulk_write.write_frame(frame, 'scores', engine, method = 'insert',
+        batch_size = 4, index = False)
+
+    result = pd.read_sql_query("select * from scores", engine)
+    assert result.shape[0] == 20
+    pd.testing.assert_frame_equal(result.iloc[10:].reset_index(drop = True),
+        frame, check_dtype = False)
+
+
+def test_write_infile_escapes_strings_and_marks_nulls():
+    frame = pd.DataFrame({'aamc_id': [101, 102, 103],
+        'comment': ['tab\there', 'back\\slash', None],
+        'pred_prob': [.25, np.nan, 1.]},
+        columns = ['aamc_id', 'comment', 'pred_prob'])
+    f = io.StringIO()
+
+    bulk_write.write_infile(frame, f)
+
+    assert f.getvalue().split('\n') == [
+        '101\ttab\\there\t0.25',
+        '102\tback\\\\slash\t\\N',
+        '103\t\\N\t1.0',
+        '']
+
+
+class CapturingConnection(object):
+    """Stands in for a MySQL connection, keeping the LOAD DATA statement and
+    the contents of the file it reads."""
+    def execute(self, statement):
+        self.statement = str(statement)
+        path = self.statement.split("infile '")[1].split("'")[0]
+        with open(path, newline = '') as f:
+            self.contents = f.read()
+
+
+def test_load_data_infile_temp_file():
+    frame = pd.DataFrame({'aamc_id': [101, 102],
+        'comment': ['a\tb\\c', np.nan]}, columns = ['aamc_id', 'comment'])
+    conn = CapturingConnection()
+
+    bulk_write.load_data_infile(frame, 'out$predictions', conn)
+
+    assert conn.contents == '101\ta\\tb\\\\c\n102\t\\N\n'
+    assert "escaped by '\\\\'" in conn.statement
@@ -0,0 +1,29 @@
+import numpy as np
+from eduanalytics import evaluation
+
+def test_precision_recall_at_k_matches_thresholding():
+    rng = np.random.RandomState(0)
+    # scores rounded to two places, so many are tied
+    y_score = np.round(rng.beta(2, 5, 503), 2)
+    y_true = (rng.rand(503) < y_score).astype(int)
+    k = np.arange(1, 101) / 100.
+
+    metrics = evaluation.precision_recall_at_k(y_true, y_score, k = k)
+
+    for fraction, row in zip(k, metrics.itertuples()):
+        binary = evaluation.generate_binary_at_k(y_score, fraction * 100)
+        n_selected = binary.sum()
+        true_positives = (binary * y_true).sum()
+        assert row.n_selected == n_selected
+        if n_selected:
+            assert np.isclose(row.precision, true_positives / float(n_selected))
+        assert np.isclose(row.recall, true_positives / float(y_true.sum()))
+
+
+def test_generate_binary_at_k_selects_everyone_at_100_percent():
+    y_score = np.array([.9, .5, .5, .1])
+
+    np.testing.assert_array_equal(
+        evaluation.generate_binary_at_k(y_score, 100), [1, 1, 1, 1])
+    np.testing.assert_array_equal(
+        evaluation.generate_binary_at_k(y_score, .5), [1, 0, 0, 0])
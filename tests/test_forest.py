@@ -0,0 +1,77 @@
+import pandas as pd
+import numpy as np
+import pytest
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import LabelBinarizer
+from sklearn.feature_selection import VarianceThreshold
+from sklearn.ensemble import RandomForestClassifier
+from eduanalytics import forest
+from eduanalytics.pipeline_tools import DummyEncoder
+try:
+    from sklearn.preprocessing import Imputer
+except ImportError:
+    from sklearn.impute import SimpleImputer as Imputer
+
+def make_features(n_rows = 300, seed = 0):
+    """Numeric and categorical features with missing values."""
+    rng = np.random.RandomState(seed)
+    X = pd.DataFrame({'mcat': rng.normal(500, 10, n_rows),
+        'gpa': rng.uniform(2, 4, n_rows),
+        'constant': np.ones(n_rows),
+        'state': rng.choice(['NY', 'NJ', 'CT'], n_rows).astype(object),
+        'degree': rng.choice(['BS', 'BA', None], n_rows)},
+        columns = ['mcat', 'gpa', 'constant', 'state', 'degree'])
+    X.loc[rng.rand(n_rows) < .1, 'gpa'] = np.nan
+    X.loc[rng.rand(n_rows) < .1, 'state'] = None
+    return X
+
+
+def fit_pipeline(X, y):
+    pipeline = make_pipeline(DummyEncoder(), Imputer(), VarianceThreshold(),
+        RandomForestClassifier(n_estimators = 20, max_depth = 6,
+            random_state = 0))
+    return pipeline.fit(X, y)
+
+
+@pytest.mark.parametrize('traversal', ['vectorized', 'native'])
+def test_compiled_binary_forest_matches_pipeline(traversal):
+    X = make_features()
+    y = (X.mcat + 20 * X.gpa.fillna(3) > 560).astype(int)
+    pipeline = fit_pipeline(X, y)
+    X_new = make_features(seed = 1)
+
+    compiled = forest.CompiledPipeline(pipeline, batch_size = 64,
+        traversal = traversal)
+
+    np.testing.assert_allclose(compiled.predict_proba(X_new),
+        pipeline.predict_proba(X_new))
+
+
+@pytest.mark.parametrize('traversal', ['vectorized', 'native'])
+def test_compiled_multi_output_forest_matches_pipeline(traversal):
+    X = make_features()
+    labels = np.where(X.mcat > 505, 'invite',
+        np.where(X.state == 'NY', 'hold', 'reject'))
+    lb = LabelBinarizer().fit(labels)
+    pipeline = fit_pipeline(X, lb.transform(labels))
+    X_new = make_features(seed = 1)
+
+    compiled = forest.CompiledPipeline(pipeline, batch_size = 64,
+        traversal = traversal)
+
+    expected, proba = pipeline.predict_proba(X_new), \
+        compiled.predict_proba(X_new)
+    assert len(proba) == len(expected) == len(lb.classes_)
+    for output, expected_output in zip(proba, expected):
+        np.testing.assert_allclose(output, expected_output)
+
+
+def test_contributions_sum_to_probabilities():
+    X = make_features()
+    y = (X.mcat > 500).astype(int)
+    compiled = forest.CompiledPipeline(fit_pipeline(X, y))
+
+    bias, contributions = compiled.predict_contributions(X)
+
+    np.testing.assert_allclose(bias[0] + contributions.sum(axis = 1)[:, 0],
+        compiled.predict_proba(X), atol = 1e-6)
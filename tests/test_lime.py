@@ -0,0 +1,68 @@
+import pandas as pd
+import numpy as np
+import pytest
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import LabelBinarizer
+from sklearn.feature_selection import VarianceThreshold
+from sklearn.ensemble import RandomForestClassifier
+from eduanalytics import lime
+from eduanalytics.pipeline_tools import DummyEncoder
+try:
+    from sklearn.preprocessing import Imputer
+except ImportError:
+    from sklearn.impute import SimpleImputer as Imputer
+
+def make_features(n_rows = 300, seed = 0):
+    """Numeric and categorical features with missing values, with the
+    categoricals as pandas categoricals as pulled for modeling."""
+    rng = np.random.RandomState(seed)
+    X = pd.DataFrame({'mcat': rng.normal(500, 10, n_rows),
+        'gpa': rng.uniform(2, 4, n_rows),
+        'state': rng.choice(['NY', 'NJ', 'CT'], n_rows).astype(object),
+        'degree': rng.choice(['BS', 'BA', None], n_rows)},
+        columns = ['mcat', 'gpa', 'state', 'degree'])
+    X.loc[rng.rand(n_rows) < .1, 'gpa'] = np.nan
+    X.loc[rng.rand(n_rows) < .1, 'state'] = None
+    for col in ['state', 'degree']:
+        X[col] = X[col].astype('category')
+    return X
+
+
+def make_perturbations(X, categorical, n_samples = 500, seed = 1):
+    """Random label encoded samples, covering every label code of each
+    categorical column (including the code of 'nan')."""
+    rng = np.random.RandomState(seed)
+    samples = np.column_stack([rng.normal(500, 10, n_samples),
+        rng.uniform(2, 4, n_samples),
+        np.zeros(n_samples), np.zeros(n_samples)])
+    for index, categories in categorical.mapping.items():
+        samples[:, index] = rng.randint(len(categories), size = n_samples)
+    return samples
+
+
+@pytest.mark.parametrize('multi_output', [False, True])
+def test_compiled_predict_fn_matches_pandas(multi_output):
+    X = make_features()
+    if multi_output:
+        labels = np.where(X.mcat > 505, 'invite',
+            np.where(X.state == 'NY', 'hold', 'reject'))
+        y = LabelBinarizer().fit_transform(labels)
+    else:
+        y = (X.mcat > 500).astype(int)
+    pipeline = make_pipeline(DummyEncoder(), Imputer(), VarianceThreshold(),
+        RandomForestClassifier(n_estimators = 20, max_depth = 6,
+            random_state = 0)).fit(X, y)
+    encoder = pipeline.steps[0][1]
+    categorical, _ = lime.get_categorical_and_numeric_dicts(X, encoder)
+    categorical = categorical._replace(mapping = lime.add_missing_category(
+        X, encoder, categorical.mapping))
+    colnames = list(X.columns)
+    samples = make_perturbations(X, categorical)
+
+    compiled = lime.make_predict_fn(pipeline, categorical, colnames,
+        compiled = True)(samples)
+    expected = lime.make_predict_fn(pipeline, categorical, colnames,
+        compiled = False)(samples)
+
+    assert compiled.shape == expected.shape
+    np.testing.assert_allclose(compiled, expected)
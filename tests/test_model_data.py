@@ -0,0 +1,45 @@
+import sqlalchemy
+import pandas as pd
+import numpy as np
+import pytest
+from collections import OrderedDict
+from eduanalytics import model_data
+
+@pytest.fixture
+def engine(tmp_path):
+    """A SQLite database file holding three feature tables and the keys of
+    a cohort, read by several pooled connections at once."""
+    engine = sqlalchemy.create_engine('sqlite:///{}'.format(
+        tmp_path / 'features.db'))
+    rng = np.random.RandomState(0)
+    keys = pd.DataFrame({'aamc_id': np.arange(200),
+        'application_year': np.repeat([2015, 2016], 100)})
+    for tbl_name in ['mcat', 'gpa', 'experiences']:
+        features = keys.copy()
+        for col in range(4):
+            features['{}_{}'.format(tbl_name, col)] = rng.normal(size = 200)
+        features['{}_flag'.format(tbl_name)] = rng.choice(['Y', 'N'], 200)
+        features.to_sql('vw$features${}'.format(tbl_name), engine,
+            index = False)
+    keys.iloc[::2].to_sql('cohort$keys', engine, index = False)
+    return engine
+
+
+def test_parallel_pull_matches_serial(engine):
+    features_dict = OrderedDict([('mcat', []), ('gpa', ['gpa_3']),
+        ('experiences', ['experiences_flag'])])
+    get_cohort = "select aamc_id, application_year from `cohort$keys`"
+
+    serial = model_data.loop_through_features(engine, features_dict,
+        get_cohort, n_jobs = 1, key_tbl = 'cohort$keys')
+    parallel = model_data.loop_through_features(engine, features_dict,
+        get_cohort, n_jobs = 3, key_tbl = 'cohort$keys')
+
+    assert len(serial) == len(parallel) == len(features_dict)
+    for serial_data, parallel_data in zip(serial, parallel):
+        assert serial_data.shape[0] == 100
+        pd.testing.assert_frame_equal(serial_data.sort_index(),
+            parallel_data.sort_index())
+    pd.testing.assert_frame_equal(
+        pd.concat(serial, axis = 1).sort_index(),
+        pd.concat(parallel, axis = 1).sort_index())
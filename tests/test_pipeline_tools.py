@@ -0,0 +1,37 @@
+import pandas as pd
+import numpy as np
+import pytest
+from eduanalytics.pipeline_tools import DummyEncoder
+
+def make_features():
+    return pd.DataFrame({'mcat': [500., np.nan, 510., 495.],
+        'state': ['NY', 'NJ', None, 'CT'],
+        'degree': ['BS', None, 'BA', 'BS']},
+        columns = ['mcat', 'state', 'degree'])
+
+
+@pytest.mark.parametrize('output', ['dense', 'sparse'])
+def test_array_output_matches_frame(output):
+    X_train = make_features()
+    # unseen categories, missing values, and fitted categories left out
+    X_new = pd.DataFrame({'mcat': [np.nan, 520.],
+        'state': ['PA', None],
+        'degree': ['MD', 'BS']}, columns = ['mcat', 'state', 'degree'])
+    expected = DummyEncoder(output = 'frame').fit(X_train).transform(X_new)
+
+    encoder = DummyEncoder(output = output).fit(X_train)
+    transformed = encoder.transform(X_new)
+    if output == 'sparse':
+        transformed = transformed.toarray()
+
+    assert list(encoder.transformed_columns) == list(expected.columns)
+    np.testing.assert_array_equal(transformed,
+        expected.values.astype(np.float32))
+
+
+def test_nan_category_collision_raises():
+    X_train = make_features()
+    X_train.loc[0, 'state'] = 'nan'
+
+    with pytest.raises(ValueError, match = 'state_nan'):
+        DummyEncoder(output = 'dense').fit(X_train)